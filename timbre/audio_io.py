@@ -0,0 +1,227 @@
+import os
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import librosa
+import soundfile as sf
+from constants import AUDIO_FORMAT, AUDIO_SUBTYPE, AUDIO_DTYPE
+
+
+# overlapped I/O (see prefetch and AudioWriter):
+# number of files read ahead of the one being processed
+PREFETCH_DEPTH = 2
+# number of outputs that may be waiting to be written while the next files are processed
+WRITE_BEHIND = 4
+
+# file extension of each storage format (see constants.AUDIO_FORMAT)
+AUDIO_EXTENSIONS = {"WAV": ".wav", "FLAC": ".flac"}
+
+
+def load_audio(path, mono=False, duration=None):
+    """
+    Load an audio file at its native sample rate, optionally reading only its leading region.
+    Matches librosa.load(path, sr=None, mono=mono), but only decodes the frames that are needed.
+
+    :param path: (str) path of the audio file to load
+    :param mono: (bool) whether to mix down stereo files to mono
+    :param duration: (float) if given, the max length (in seconds) to read from the beginning of the file
+    :return: (tuple) audio array (channels first if stereo) as float32, native sample rate
+    """
+    with sf.SoundFile(path) as f:
+        sr = f.samplerate
+
+        # number of frames to decode, -1 reads the whole file
+        frames = -1
+        if duration is not None:
+            frames = min(int(duration * sr), f.frames)
+
+        y = f.read(frames=frames, dtype="float32", always_2d=False).T
+
+    if mono:
+        y = librosa.to_mono(y)
+
+    return y, sr
+
+
+def audio_ext(audio_format=AUDIO_FORMAT):
+    """
+    :param audio_format: (str) storage format, "WAV" or "FLAC"
+    :return: (str) file extension of the format
+    """
+    if audio_format not in AUDIO_EXTENSIONS:
+        raise ValueError(f"Unknown audio format {audio_format}!")
+    return AUDIO_EXTENSIONS[audio_format]
+
+
+def is_audio_file(file):
+    """
+    :param file: (str) name of a file
+    :return: (bool) whether the file is in one of the storage formats the stages read
+    """
+    return file.endswith(tuple(AUDIO_EXTENSIONS.values()))
+
+
+def storage_params(audio_format=AUDIO_FORMAT, subtype=AUDIO_SUBTYPE):
+    """
+    Get the storage settings to record in a manifest with the parameters of a stage,
+    after checking that the format can store the sample format, so that a misconfigured
+    run fails when it starts rather than on its first write.
+
+    :param audio_format: (str) storage format of the outputs
+    :param subtype: (str) sample format of the outputs
+    :return: (dict) the settings that differ from 16 bit WAV, since outputs
+                    written before the storage was configurable are 16 bit WAV
+    """
+    audio_ext(audio_format)
+    if not sf.check_format(audio_format, subtype):
+        raise ValueError(f"{audio_format} files cannot store {subtype} samples, "
+                         f"use one of {sorted(sf.available_subtypes(audio_format))}!")
+    params = {}
+    if audio_format != "WAV":
+        params["audio_format"] = audio_format
+    if subtype != "PCM_16":
+        params["subtype"] = subtype
+    return params
+
+
+def read_audio(path, dtype=AUDIO_DTYPE):
+    """
+    Read an audio file at its native sample rate.
+
+    :param path: (str) path of the audio file
+    :param dtype: (str) dtype to decode to, "float32" or "float64"
+    :return: (tuple) audio array (channels first if stereo), native sample rate
+    """
+    # read as (num_samples, num_channels)
+    y, sr = sf.read(path, dtype=dtype)
+    return y.T, sr
+
+
+def audio_length(path):
+    """
+    Get the length of an audio file from its header, e.g. to sort files by length.
+
+    :param path: (str) path of the audio file
+    :return: (int) number of samples per channel, 0 if the file cannot be read
+             (it then fails on its own when it is processed)
+    """
+    try:
+        return sf.info(path).frames
+    except Exception:
+        return 0
+
+
+def write_audio(path, y, sr, subtype=AUDIO_SUBTYPE):
+    """
+    Write an audio array to a temporary file next to path and then rename it into place,
+    so that an interrupted write never leaves a partial file at path.
+
+    :param path: (str) path of the audio file to write, its extension sets the format (see audio_ext)
+    :param y: (np.array) audio array (channels first if stereo)
+    :param sr: (int) sample rate
+    :param subtype: (str) sample format, e.g. "PCM_16", "PCM_24" or "FLOAT" (see constants.AUDIO_SUBTYPE)
+    """
+    root, ext = os.path.splitext(path)
+    tmp_path = f"{root}.{os.getpid()}.{threading.get_ident()}.tmp{ext}"
+    sf.write(tmp_path, y.T, sr, subtype=subtype)
+    os.replace(tmp_path, path)
+
+
+def read_item(item):
+    """
+    Get the name, audio and sample rate of an item of a stream of audio.
+
+    :param item: (str or tuple) path of an audio file, read at its native sample rate,
+                                or (name, audio array (channels first if stereo), sample rate)
+    :return: (tuple) name (the file name for a path), audio array (channels first if stereo), sample rate
+    """
+    if isinstance(item, str):
+        y, sr = read_audio(item)
+        return os.path.basename(item), y, sr
+
+    name, y, sr = item
+    return name, y, sr
+
+
+def prefetch(items, load, depth=PREFETCH_DEPTH):
+    """
+    Load the items of a stream ahead of their use, on background threads, so that reading the
+    next files overlaps with processing the current one.
+
+    At most depth loads are in flight or waiting to be used at a time, which bounds the memory
+    held by files that were read ahead. Errors raised by load are raised by future.result(),
+    so that the caller can handle them per item.
+
+    :param items: (iterable) items to load, e.g. paths of audio files
+    :param load: (function) function that loads an item, run on a background thread
+    :param depth: (int) number of items loaded ahead, if 0, each item is loaded when it is reached
+    :return: (generator) (item, future of the loaded item) pairs, in the order of the items
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max(1, depth)) as pool:
+        pending = collections.deque()
+        try:
+            while True:
+                # keep depth loads ahead of the item being used, plus the item itself
+                while len(pending) <= depth:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        break
+                    pending.append((item, pool.submit(load, item)))
+                if not pending:
+                    return
+                yield pending.popleft()
+        finally:
+            # the caller stopped early, do not read the rest
+            for _, future in pending:
+                future.cancel()
+
+
+class AudioWriter:
+    """
+    Write-behind for audio files: arrays are written by a background thread (see write_audio)
+    while the caller goes on to the next file.
+
+    At most max_pending writes are queued at a time, write blocks once the queue is full,
+    which bounds the memory held by outputs that have not been written yet.
+    Writes are done in the order they were queued.
+    """
+
+    def __init__(self, max_pending=WRITE_BEHIND):
+        """
+        :param max_pending: (int) number of writes that may be queued at once
+        """
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+
+    def write(self, path, y, sr, subtype=AUDIO_SUBTYPE):
+        """
+        Queue an audio array to be written (see write_audio).
+
+        :param path: (str) path of the audio file to write, its extension sets the format
+        :param y: (np.array) audio array (channels first if stereo), it must not be modified afterwards
+        :param sr: (int) sample rate
+        :param subtype: (str) sample format
+        :return: (Future) future of the write, its result() raises the error if the write failed
+        """
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(write_audio, path, y, sr, subtype)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def close(self):
+        """
+        Wait for the queued writes to finish.
+        """
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
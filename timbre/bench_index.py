@@ -0,0 +1,116 @@
+import time
+import numpy as np
+from embedding_index import EmbeddingIndex, PCA_DIM, NUM_PROBES, TOP_K
+
+
+# synthetic corpus: pooled vectors of clips by a number of singers, clustered around each singer
+NUM_CLIPS = 50000
+NUM_SINGERS = 2000
+POOLED_DIM = 1024
+
+# number of queries to time and to measure recall on
+NUM_QUERIES = 500
+
+
+def make_vectors(num_clips=NUM_CLIPS, num_singers=NUM_SINGERS, dim=POOLED_DIM, seed=0):
+    """
+    Make pooled vectors of a synthetic corpus, with clips of the same singer close together.
+
+    :param num_clips: (int) number of clips
+    :param num_singers: (int) number of singers (clusters)
+    :param dim: (int) width of the pooled vectors
+    :param seed: (int) random seed
+    :return: (list, np.array) names of the clips and their pooled vectors, of shape (num_clips, dim)
+    """
+    rng = np.random.default_rng(seed)
+    # OpenL3 embeddings have most of their variance in a few directions
+    basis = rng.standard_normal((64, dim)).astype(np.float32)
+    singers = rng.standard_normal((num_singers, 64)).astype(np.float32)
+    singer = rng.integers(num_singers, size=num_clips)
+    latent = singers[singer] + 0.5 * rng.standard_normal((num_clips, 64)).astype(np.float32)
+    vectors = latent @ basis + 0.5 * rng.standard_normal((num_clips, dim)).astype(np.float32)
+    names = [f"Singer{s:04d}_Song{i:05d}_Emb_512.npy" for i, s in enumerate(singer)]
+    return names, vectors
+
+
+def recall(idx, exact_idx):
+    """
+    Fraction of the exact nearest neighbors found by a search.
+
+    :param idx: (np.array) rows found for each query, of shape (num_queries, k)
+    :param exact_idx: (np.array) rows of the exact nearest neighbors, of shape (num_queries, k)
+    :return: (float) recall@k
+    """
+    return float(np.mean([len(np.intersect1d(a, b)) / len(b) for a, b in zip(idx, exact_idx)]))
+
+
+def bench_index(num_clips=NUM_CLIPS, num_queries=NUM_QUERIES, k=TOP_K, pca_dim=PCA_DIM, num_probes=NUM_PROBES):
+    """
+    Compare the build time, size, query latency and recall of the exact and approximate search modes.
+
+    Recall is measured against exact search over the same (projected) vectors in float32,
+    so it shows what approximate search and int8 storage lose, not what PCA loses.
+
+    :param num_clips: (int) number of clips in the synthetic corpus
+    :param num_queries: (int) number of queries
+    :param k: (int) number of nearest neighbors per query
+    :param pca_dim: (int) number of principal components to keep, if None, keep the pooled vectors
+    :param num_probes: (int) number of lists scored per query by approximate search
+    :return: (list) list of dicts with the results of each case
+    """
+    names, vectors = make_vectors(num_clips)
+    print(f"Benchmarking on {num_clips} clips x {vectors.shape[1]} dimensions, {num_queries} queries, top {k}.")
+
+    cases = [("exact float32", False, True),
+             ("exact int8", True, True),
+             ("approximate float32", False, False),
+             ("approximate int8", True, False)]
+    indexes = {}
+    results = []
+    exact_idx = None
+    for name, quantize, exact in cases:
+        if (quantize, "index") not in indexes:
+            start = time.perf_counter()
+            indexes[(quantize, "index")] = EmbeddingIndex.build(names, vectors, pca_dim=pca_dim, quantize=quantize)
+            indexes[(quantize, "build")] = time.perf_counter() - start
+        index = indexes[(quantize, "index")]
+        queries = np.stack([index.vector(n) for n in index.names[:num_queries]])
+        # search results are rows of the index, compare clip names since the two indexes may order rows differently
+        row_names = np.array(index.names)
+
+        # warm up
+        index.search(queries[:1], k=k, exact=exact, num_probes=num_probes)
+
+        # one query at a time
+        start = time.perf_counter()
+        for query in queries:
+            index.search(query[None], k=k, exact=exact, num_probes=num_probes)
+        latency = (time.perf_counter() - start) / len(queries) * 1000
+
+        # all queries at once
+        start = time.perf_counter()
+        idx, _ = index.search(queries, k=k, exact=exact, num_probes=num_probes)
+        batched = (time.perf_counter() - start) / len(queries) * 1000
+
+        found = row_names[idx]
+        if exact_idx is None:
+            # exact float32 search is the reference
+            exact_idx = dict(zip(index.names[:num_queries], found))
+        reference = np.stack([exact_idx[n] for n in index.names[:num_queries]])
+
+        results.append({"case": name, "build_sec": indexes[(quantize, "build")],
+                        "size_mb": index.vectors.nbytes / 2 ** 20,
+                        "latency_ms": latency, "batched_ms": batched, "recall": recall(found, reference)})
+
+    # print a summary table
+    print(f"{'case':>20} {'build s':>8} {'size MB':>8} {'ms/query':>9} {'batched':>8} {'recall@' + str(k):>9}")
+    for r in results:
+        print(f"{r['case']:>20} {r['build_sec']:>8.2f} {r['size_mb']:>8.1f} {r['latency_ms']:>9.3f} "
+              f"{r['batched_ms']:>8.3f} {r['recall']:>9.3f}")
+
+    return results
+
+
+if __name__ == '__main__':
+    # run function
+    bench_index()
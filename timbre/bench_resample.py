@@ -0,0 +1,144 @@
+import os
+import time
+import argparse
+import numpy as np
+import librosa
+from audio_io import is_audio_file
+
+
+# resampling filters to compare, any res_type of librosa.resample
+RES_TYPES = ["soxr_vhq", "soxr_hq", "soxr_mq", "soxr_lq", "polyphase", "kaiser_best", "kaiser_fast", "fft"]
+
+# filter every other filter is compared against
+REFERENCE = "soxr_vhq"
+
+# number of files from the input directory to resample
+NUM_FILES = 16
+
+# settings of the spectra the error is measured on
+N_FFT = 2048
+HOP_LENGTH = 512
+# magnitudes are floored at this level (in dB relative to the peak) so that silence does not dominate
+FLOOR_DB = -80.0
+
+
+def log_spectrum(y):
+    """
+    Compute the log magnitude spectrogram of an audio array, floored relative to its peak.
+
+    :param y: (np.array) audio array
+    :return: (np.array) log magnitude spectrogram in dB
+    """
+    S = np.abs(librosa.stft(y, n_fft=N_FFT, hop_length=HOP_LENGTH))
+    return librosa.amplitude_to_db(S, ref=np.max, top_db=-FLOOR_DB)
+
+
+def spectral_error(y, y_ref):
+    """
+    Measure how far a resampled audio array is from the reference resampling of the same audio.
+
+    :param y: (np.array) resampled audio array
+    :param y_ref: (np.array) reference resampled audio array
+    :return: (dict) signal to error ratio (dB), log spectral distance (dB), and mean absolute
+                    log spectral error (dB) in the top 10% of the band, where the filters differ most
+    """
+    # the filters can disagree on the output length by a sample
+    n = min(y.shape[-1], y_ref.shape[-1])
+    y = y[..., :n]
+    y_ref = y_ref[..., :n]
+
+    err = y - y_ref
+    snr = 10 * np.log10(np.sum(y_ref ** 2) / max(np.sum(err ** 2), 1e-20))
+
+    S = log_spectrum(y)
+    S_ref = log_spectrum(y_ref)
+    diff = S - S_ref
+
+    # root mean square over frequency, mean over frames (and channels)
+    lsd = np.mean(np.sqrt(np.mean(diff ** 2, axis=-2)))
+
+    # top 10% of the band, just below the new Nyquist frequency
+    top = int(0.9 * diff.shape[-2])
+    hf_err = np.mean(np.abs(diff[..., top:, :]))
+
+    return {"snr_db": float(snr), "lsd_db": float(lsd), "hf_err_db": float(hf_err)}
+
+
+def bench_resample(in_dir, target_sr, res_types=RES_TYPES, num_files=NUM_FILES, reference=REFERENCE):
+    """
+    Compare the speed and spectral error of resampling filters on audio files.
+
+    :param in_dir: (str) directory of audio files to resample
+    :param target_sr: (int) sample rate to resample to
+    :param res_types: (list) resampling filters to compare, any res_type of librosa.resample
+    :param num_files: (int) number of files from the input directory to resample
+    :param reference: (str) filter every other filter is compared against
+    :return: (list) list of dicts with the timings and errors of each filter
+    """
+    file_list = sorted(file for file in os.listdir(in_dir) if is_audio_file(file))[:num_files]
+
+    # decode every file once, outside of the timed region
+    print(f"Loading {len(file_list)} files...")
+    audio = [librosa.load(os.path.join(in_dir, file), sr=None, mono=False) for file in file_list]
+    audio_dur = sum(y.shape[-1] / sr for y, sr in audio)
+    print(f"Benchmarking on {len(file_list)} files ({audio_dur:.1f} seconds of audio) -> {target_sr} Hz.")
+
+    # reference outputs
+    refs = [librosa.resample(y, orig_sr=sr, target_sr=target_sr, res_type=reference) for y, sr in audio]
+
+    results = []
+    for res_type in res_types:
+        # warm up, so that one-off setup is not timed
+        y, sr = audio[0]
+        try:
+            librosa.resample(y[..., :sr], orig_sr=sr, target_sr=target_sr, res_type=res_type)
+        except ModuleNotFoundError as e:
+            # e.g. the kaiser filters need resampy
+            print(f"Skipping {res_type}: {str(e).splitlines()[0]}")
+            continue
+
+        elapsed = 0.0
+        errors = []
+        for (y, sr), y_ref in zip(audio, refs):
+            start = time.perf_counter()
+            y_hat = librosa.resample(y, orig_sr=sr, target_sr=target_sr, res_type=res_type)
+            elapsed += time.perf_counter() - start
+            if res_type != reference:
+                errors.append(spectral_error(y_hat, y_ref))
+
+        result = {"res_type": res_type, "seconds": elapsed, "audio_sec_per_sec": audio_dur / elapsed}
+        for key in ["snr_db", "lsd_db", "hf_err_db"]:
+            result[key] = float(np.mean([e[key] for e in errors])) if errors else None
+        results.append(result)
+
+    # print a summary table
+    print(f"{'res_type':>12} {'seconds':>10} {'audio s/s':>10} {'speedup':>8} "
+          f"{'SNR dB':>8} {'LSD dB':>8} {'HF err dB':>10}")
+    base = next((r["seconds"] for r in results if r["res_type"] == "soxr_hq"), results[0]["seconds"])
+    for r in results:
+        if r["snr_db"] is None:
+            errors = f"{'(reference)':>28}"
+        else:
+            errors = f"{r['snr_db']:>8.1f} {r['lsd_db']:>8.3f} {r['hf_err_db']:>10.3f}"
+        print(f"{r['res_type']:>12} {r['seconds']:>10.2f} {r['audio_sec_per_sec']:>10.1f} "
+              f"{base / r['seconds']:>7.1f}x {errors}")
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the speed and error of resampling filters.")
+    parser.add_argument("--stems-dir", default=None,
+                        help="separated vocal stems, resampled 44100 -> 22050 as in postprocess")
+    parser.add_argument("--choruses-dir", default=None,
+                        help="choruses at their native sample rate, resampled to 44100 as in preprocess")
+    parser.add_argument("--num-files", type=int, default=NUM_FILES, help="number of files to resample")
+    args = parser.parse_args()
+    if args.stems_dir is None and args.choruses_dir is None:
+        parser.error("give at least one of --stems-dir and --choruses-dir")
+
+    # run function
+    if args.stems_dir is not None:
+        bench_resample(args.stems_dir, 22050, num_files=args.num_files)
+    if args.choruses_dir is not None:
+        bench_resample(args.choruses_dir, 44100, num_files=args.num_files)
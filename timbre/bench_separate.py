@@ -0,0 +1,71 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import soundfile as sf
+from separate import separate
+from audio_io import is_audio_file
+
+
+# (number of workers, torch threads per worker) splits to compare
+SPLITS = [(1, 32), (2, 16), (4, 8), (8, 4), (16, 2), (32, 1)]
+
+# number of files from the input directory to separate for each split
+NUM_FILES = 64
+
+
+def bench_separate(in_dir, splits, num_files=NUM_FILES, model_name='htdemucs'):
+    """
+    Measure the throughput of cpu source separation for different splits of the cores into
+    worker processes and torch threads per worker.
+
+    :param in_dir: (str) directory of audio files to run source separation model on (e.g. the standardized choruses)
+    :param splits: (list) list of (number of workers, threads per worker) tuples to compare
+    :param num_files: (int) number of files from the input directory to separate for each split
+    :param model_name: (str) name of the pretrained demucs model to use
+    :return: (list) list of dicts with the timings of each split
+    """
+    # copy a fixed subset of the files so that every split separates the same audio
+    file_list = sorted(file for file in os.listdir(in_dir) if is_audio_file(file))[:num_files]
+    audio_dur = sum(sf.info(os.path.join(in_dir, file)).duration for file in file_list)
+    print(f"Benchmarking on {len(file_list)} files ({audio_dur:.1f} seconds of audio).")
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bench_in_dir = os.path.join(tmp_dir, "in")
+        os.makedirs(bench_in_dir)
+        for file in file_list:
+            shutil.copy(os.path.join(in_dir, file), bench_in_dir)
+
+        for workers, threads in splits:
+            bench_out_dir = os.path.join(tmp_dir, f"out_{workers}x{threads}")
+
+            # model loading happens inside the timed region, as it does in a real run
+            start = time.perf_counter()
+            separate(bench_in_dir, bench_out_dir, model_name=model_name, gpu=False, force=True,
+                     workers=workers, threads=threads)
+            elapsed = time.perf_counter() - start
+
+            results.append({"workers": workers, "threads": threads, "seconds": elapsed,
+                            "files_per_sec": len(file_list) / elapsed,
+                            "audio_sec_per_sec": audio_dur / elapsed})
+            shutil.rmtree(bench_out_dir)
+
+    # print a summary table
+    print(f"{'workers':>8} {'threads':>8} {'seconds':>10} {'files/s':>10} {'audio s/s':>10}")
+    for r in results:
+        print(f"{r['workers']:>8} {r['threads']:>8} {r['seconds']:>10.1f} "
+              f"{r['files_per_sec']:>10.3f} {r['audio_sec_per_sec']:>10.2f}")
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare splits of the cores for cpu source separation.")
+    parser.add_argument("in_dir", help="directory of audio files to separate, e.g. the standardized choruses")
+    parser.add_argument("--num-files", type=int, default=NUM_FILES, help="number of files to separate per split")
+    args = parser.parse_args()
+
+    # run function
+    bench_separate(args.in_dir, SPLITS, num_files=args.num_files)
@@ -0,0 +1,94 @@
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import soundfile as sf
+from audio_io import read_audio, write_audio, audio_ext, is_audio_file
+
+
+# storage formats to compare, (format, sample format)
+FORMATS = [("WAV", "PCM_16"), ("WAV", "PCM_24"), ("WAV", "FLOAT"), ("FLAC", "PCM_16"), ("FLAC", "PCM_24")]
+
+# dtypes to decode to
+DTYPES = ["float32", "float64"]
+
+# number of files from the input directory to write and read back
+NUM_FILES = 16
+
+
+def bench_storage(in_dir, formats=FORMATS, dtypes=DTYPES, num_files=NUM_FILES, tmp_dir=None):
+    """
+    Compare the size, write and read speed, and error of the storage formats of intermediate audio.
+
+    Every file is decoded once, then written in each format and read back in each dtype.
+    The error is measured against the decoded input in float64, so it is the quantization error
+    of the format (16 bit formats are lossless for 16 bit inputs).
+
+    :param in_dir: (str) directory of audio files to write in each format
+    :param formats: (list) storage formats to compare, list of (format, sample format)
+    :param dtypes: (list) dtypes to decode to, e.g. "float32" and "float64"
+    :param num_files: (int) number of files from the input directory to write and read back
+    :param tmp_dir: (str) directory of where to write the files, if None, a temporary directory
+    :return: (list) list of dicts with the size, timings and error of each format
+    """
+    file_list = sorted(file for file in os.listdir(in_dir) if is_audio_file(file))[:num_files]
+
+    # decode every file once, outside of the timed region
+    print(f"Loading {len(file_list)} files...")
+    audio = [read_audio(os.path.join(in_dir, file), dtype="float64") for file in file_list]
+    audio_dur = sum(y.shape[-1] / sr for y, sr in audio)
+    print(f"Benchmarking on {len(file_list)} files ({audio_dur:.1f} seconds of audio).")
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as out_dir:
+        for audio_format, subtype in formats:
+            paths = [os.path.join(out_dir, f"{i}_{subtype}{audio_ext(audio_format)}") for i in range(len(audio))]
+
+            start = time.perf_counter()
+            for path, (y, sr) in zip(paths, audio):
+                write_audio(path, y, sr, subtype=subtype)
+            write_sec = time.perf_counter() - start
+            size = sum(os.path.getsize(path) for path in paths)
+
+            result = {"format": audio_format, "subtype": subtype, "size_mb": size / 2 ** 20, "write_sec": write_sec}
+            for dtype in dtypes:
+                # warm up the page cache, so that decoding is timed rather than the disk
+                read_audio(paths[0], dtype=dtype)
+                start = time.perf_counter()
+                decoded = [read_audio(path, dtype=dtype)[0] for path in paths]
+                result[f"read_sec_{dtype}"] = time.perf_counter() - start
+                result[f"mb_{dtype}"] = sum(y.nbytes for y in decoded) / 2 ** 20
+                result[f"max_err_{dtype}"] = max(float(np.max(np.abs(y_hat - y))) for y_hat, (y, _) in
+                                                 zip(decoded, audio))
+            results.append(result)
+
+            for path in paths:
+                os.remove(path)
+
+    # print a summary table
+    base = next((r["size_mb"] for r in results if (r["format"], r["subtype"]) == ("WAV", "PCM_16")),
+                results[0]["size_mb"])
+    header = f"{'format':>14} {'size MB':>8} {'ratio':>6} {'write s':>8}"
+    for dtype in dtypes:
+        header += f" {'read s ' + dtype:>15} {'MB ' + dtype:>11} {'max err':>9}"
+    print(header)
+    for r in results:
+        line = (f"{r['format'] + ' ' + r['subtype']:>14} {r['size_mb']:>8.1f} {r['size_mb'] / base:>6.2f} "
+                f"{r['write_sec']:>8.2f}")
+        for dtype in dtypes:
+            line += f" {r['read_sec_' + dtype]:>15.2f} {r['mb_' + dtype]:>11.1f} {r['max_err_' + dtype]:>9.1e}"
+        print(line)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the storage formats of intermediate audio.")
+    parser.add_argument("in_dir", help="directory of audio files, e.g. the separated vocal stems, "
+                                       "the largest intermediates of the pipeline")
+    parser.add_argument("--num-files", type=int, default=NUM_FILES, help="number of files to write and read back")
+    args = parser.parse_args()
+
+    # run function
+    bench_storage(args.in_dir, num_files=args.num_files)
@@ -0,0 +1,131 @@
+import timeit
+import numpy as np
+from utils import normalize_data, trim_audio, fade_in_out, process_batch
+
+
+# audio to benchmark on: 20 second clips, as produced by postprocess
+SAMPLE_RATE = 44100
+DURATION = 20.0
+
+# number of timed calls per function
+NUM_CALLS = 50
+
+# number of clips in the batch benchmark
+NUM_CLIPS = 256
+
+
+def normalize_data_reference(x):
+    """
+    Previous implementation of utils.normalize_data, kept as a baseline.
+    """
+    z = (x - np.mean(x)) / np.std(x)
+    q = 2 * ((z - np.min(z)) / (np.max(z) - np.min(z))) - 1
+    return q
+
+
+def fade_in_out_reference(audio, sr, duration=0.5):
+    """
+    Previous implementation of utils.fade_in_out, kept as a baseline.
+    """
+    num_samples = audio.shape[-1]
+    fade_length = int(duration * sr)
+    fade_in = np.linspace(0.0, 1.0, fade_length)
+    fade_out = np.linspace(1.0, 0.0, fade_length)
+    full_amp = np.ones((num_samples - 2 * fade_length))
+    fade_curve = np.concatenate((fade_in, full_amp, fade_out))
+    return audio * fade_curve
+
+
+def time_call(func, num_calls=NUM_CALLS):
+    """
+    Time a function call.
+
+    :param func: (function) function with no arguments to time
+    :param num_calls: (int) number of calls to average over
+    :return: (float) best average time per call in milliseconds, over 3 repeats
+    """
+    return min(timeit.repeat(func, number=num_calls, repeat=3)) / num_calls * 1000
+
+
+def bench_utils(sr=SAMPLE_RATE, duration=DURATION):
+    """
+    Compare the audio utilities against their previous implementations.
+
+    :param sr: (int) sample rate of the benchmark audio
+    :param duration: (float) length of the benchmark audio in seconds
+    :return: (list) list of dicts with the timings of each case
+    """
+    rng = np.random.default_rng(0)
+    num_samples = int(sr * duration)
+    cases = {
+        "mono float32": rng.uniform(-0.5, 0.5, num_samples).astype(np.float32),
+        "mono float64": rng.uniform(-0.5, 0.5, num_samples),
+        "stereo float32": rng.uniform(-0.5, 0.5, (2, num_samples)).astype(np.float32),
+    }
+
+    results = []
+    for case, y in cases.items():
+        buf = np.empty_like(y)
+        timings = {
+            "normalize_data (reference)": time_call(lambda: normalize_data_reference(y)),
+            "normalize_data": time_call(lambda: normalize_data(y)),
+            "normalize_data (out=)": time_call(lambda: normalize_data(y, out=buf)),
+            "fade_in_out (reference)": time_call(lambda: fade_in_out_reference(y, sr)),
+            "fade_in_out": time_call(lambda: fade_in_out(y, sr)),
+            "fade_in_out (in place)": time_call(lambda: fade_in_out(buf, sr, out=buf)),
+        }
+
+        # check that the results match the reference implementations
+        norm_err = np.max(np.abs(normalize_data(y) - normalize_data_reference(y)))
+        fade_err = np.max(np.abs(fade_in_out(y, sr) - fade_in_out_reference(y, sr)))
+
+        print(f"--- {case} ({num_samples} samples)")
+        for name, ms in timings.items():
+            print(f"{name:>28}: {ms:8.3f} ms")
+        print(f"{'normalize_data speedup':>28}: {timings['normalize_data (reference)'] / timings['normalize_data']:8.1f}x")
+        print(f"{'fade_in_out speedup':>28}: {timings['fade_in_out (reference)'] / timings['fade_in_out']:8.1f}x")
+        print(f"{'max abs difference':>28}: normalize {norm_err:.2e}, fade {fade_err:.2e}")
+        print(f"{'output dtype':>28}: {normalize_data(y).dtype} (reference {normalize_data_reference(y).dtype}), "
+              f"{fade_in_out(y, sr).dtype} (reference {fade_in_out_reference(y, sr).dtype})")
+
+        results.append({"case": case, "num_samples": num_samples, "timings_ms": timings,
+                        "normalize_max_abs_diff": float(norm_err), "fade_max_abs_diff": float(fade_err)})
+
+    return results
+
+
+def bench_batch(num_clips=NUM_CLIPS, sr=22050, duration=DURATION):
+    """
+    Compare normalizing, trimming and fading a batch of clips in one call against doing it clip by clip.
+
+    :param num_clips: (int) number of clips in the batch
+    :param sr: (int) sample rate of the benchmark audio
+    :param duration: (float) length the clips are trimmed to in seconds
+    :return: (dict) timings of the batched and per-clip versions
+    """
+    # clips slightly longer than the trim duration, as after resampling in postprocess
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-0.5, 0.5, (num_clips, int(sr * (duration + 0.5)))).astype(np.float32)
+
+    def per_clip():
+        return np.stack([fade_in_out(trim_audio(normalize_data(x), sr, duration), sr) for x in X])
+
+    def batched():
+        return process_batch(X, sr, trim_dur=duration, normalize=True, fade=True)
+
+    timings = {"per clip": time_call(per_clip, num_calls=3), "batched": time_call(batched, num_calls=3)}
+    exact = np.array_equal(per_clip(), batched())
+
+    print(f"--- batch of {num_clips} clips ({duration} seconds at {sr} Hz)")
+    for name, ms in timings.items():
+        print(f"{name:>28}: {ms:8.3f} ms ({ms / num_clips:.3f} ms per clip)")
+    print(f"{'speedup':>28}: {timings['per clip'] / timings['batched']:8.1f}x")
+    print(f"{'identical results':>28}: {exact}")
+
+    return {"num_clips": num_clips, "timings_ms": timings, "identical": bool(exact)}
+
+
+if __name__ == '__main__':
+    # run functions
+    bench_utils()
+    bench_batch()
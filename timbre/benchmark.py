@@ -0,0 +1,387 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import multiprocessing
+import numpy as np
+import soundfile as sf
+from constants import RES_TYPE
+from profiling import PROFILE_NAME
+
+
+# stages that can be benchmarked, in the order they run
+# each stage reads the output of the closest previous stage that ran, or a synthetic corpus
+STAGES = ["preprocess", "separate", "postprocess", "extract_mfccs", "extract_embeddings", "utils"]
+
+# default synthetic corpus: 8 stereo 30 second clips at 44.1 kHz
+NUM_FILES = 8
+DURATION = 30.0
+SAMPLE_RATE = 44100
+NUM_CHANNELS = 2
+
+# relative change in throughput or memory against the baseline that counts as a regression
+TOLERANCE = 0.1
+
+# sample rates of the final stems, the same as postprocess
+FINAL_SRS = [22050, 44100]
+
+# smoke check: a tiny corpus, run through each stage on its own and through all stages together
+SMOKE_NUM_FILES = 2
+SMOKE_DURATION = 2.0
+
+
+def synth_voice(rng, num_samples, sr):
+    """
+    Synthesize a voice-like signal: a harmonic tone with a wandering pitch, vibrato and
+    a syllable-rate amplitude envelope, over a quiet noise floor.
+
+    :param rng: (np.random.Generator) random number generator
+    :param num_samples: (int) length of the signal in samples
+    :param sr: (int) sample rate of the signal
+    :return: (np.array) signal as float32, with a peak amplitude of 0.5
+    """
+    t = np.arange(num_samples) / sr
+
+    # pitch wanders within half an octave around a base frequency, with a 5.5 Hz vibrato
+    f0 = rng.uniform(110, 440) * 2 ** (0.25 * np.sin(2 * np.pi * rng.uniform(0.05, 0.3) * t))
+    f0 *= 1 + 0.01 * np.sin(2 * np.pi * 5.5 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / sr
+
+    # harmonics with a 1/k rolloff
+    y = np.zeros(num_samples)
+    for k in range(1, 9):
+        y += np.sin(k * phase) / k
+
+    # syllable-rate envelope and noise floor
+    y *= 0.2 + 0.8 * np.sin(np.pi * rng.uniform(2, 4) * t) ** 2
+    y += 0.05 * rng.standard_normal(num_samples)
+
+    return (0.5 * y / np.max(np.abs(y))).astype(np.float32)
+
+
+def make_corpus(out_dir, num_files=NUM_FILES, duration=DURATION, sr=SAMPLE_RATE, num_channels=NUM_CHANNELS,
+                seed=0):
+    """
+    Write a synthetic corpus of WAV files, named like the real choruses (<singer>_<song>_chorus.wav).
+
+    :param out_dir: (str) directory of where to save the WAV files
+    :param num_files: (int) number of files
+    :param duration: (float) length of each file in seconds
+    :param sr: (int) sample rate of the files
+    :param num_channels: (int) 1 for mono files, 2 for stereo files
+    :param seed: (int) seed of the random number generator, the same seed gives the same corpus
+    :return: (float) total duration of the corpus in seconds
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    num_samples = int(duration * sr)
+
+    for i in range(num_files):
+        channels = [synth_voice(rng, num_samples, sr) for _ in range(num_channels)]
+        y = np.stack(channels, axis=1) if num_channels > 1 else channels[0]
+        sf.write(os.path.join(out_dir, f"Singer{i:04d}_Song{i:04d}_chorus.wav"), y, sr)
+
+    return num_files * num_samples / sr
+
+
+def make_standin_separation_model(path):
+    """
+    Save a randomly initialized Hybrid Transformer Demucs model, as a stand-in for the pretrained one.
+    It has the same architecture, so it takes the same time and memory to run, but the pretrained
+    weights do not have to be downloaded.
+
+    :param path: (str) path of where to save the model
+    """
+    import torch
+    from demucs.htdemucs import HTDemucs
+
+    torch.manual_seed(0)
+    model = HTDemucs(sources=["drums", "bass", "other", "vocals"], samplerate=44100, segment=7.8)
+    model.eval()
+    torch.save(model, path)
+
+
+def run_stage(stage, in_dir, out_dir, workers, model_name, res_type=RES_TYPE):
+    """
+    Run a stage on a directory of WAV files with profiling, in the current process.
+    Meant to be run in a fresh process for each stage, so that the peak memory is the stage's own.
+
+    :param stage: (str) name of the stage
+    :param in_dir: (str) directory of WAV files to process
+    :param out_dir: (str) directory of where to save the outputs of the stage
+    :param workers: (int) number of worker processes of the stage
+    :param model_name: (str) separation model, name of a pretrained model or path of a saved model
+    :param res_type: (str) resampling filter of preprocess and postprocess (see constants.RES_TYPE)
+    :return: (dict) summary of the run (see profiling.RunProfile.close),
+                    or {"skipped": reason} if the dependencies of the stage are not installed
+    """
+    # the stages are imported here so that each stage only loads its own dependencies
+    try:
+        if stage == "preprocess":
+            from preprocess import preprocess
+            preprocess(in_dir, out_dir, target_sr=44100, to_mono=False, normalize=False, fade=True,
+                       workers=workers, force=True, profile=True, res_type=res_type)
+        elif stage == "separate":
+            from separate import separate
+            separate(in_dir, out_dir, model_name=model_name, gpu=False, force=True, workers=workers,
+                     profile=True)
+        elif stage == "postprocess":
+            from postprocess import postprocess
+            postprocess(in_dir, [os.path.join(out_dir, str(sr)) for sr in FINAL_SRS], target_sr=FINAL_SRS,
+                        to_mono=True, trim_dur=20.0, normalize=True, fade=True, workers=workers, force=True,
+                        profile=True, res_type=res_type)
+            out_dir = os.path.join(out_dir, str(FINAL_SRS[0]))
+        elif stage == "extract_mfccs":
+            from extract_mfccs import extract_mfccs
+            # a fresh mel spectrogram cache, so that every spectrogram is computed
+            extract_mfccs(in_dir, out_dir, force=True, cache_dir=os.path.join(out_dir, "cache"), profile=True)
+        elif stage == "extract_embeddings":
+            from extract_embeddings import extract_embeddings, BATCH_SIZE, FRAME_BATCH_SIZE
+            extract_embeddings(in_dir, out_dir, batch_size=BATCH_SIZE, frame_batch_size=FRAME_BATCH_SIZE,
+                               force=True, profile=True)
+        else:
+            raise ValueError(f"Unknown stage {stage}!")
+    except ImportError as e:
+        return {"skipped": str(e)}
+
+    # the run summary is the last line of the profile
+    with open(os.path.join(out_dir, PROFILE_NAME), "r") as f:
+        return json.loads(f.readlines()[-1])
+
+
+def run_utils():
+    """
+    Benchmark the audio utilities in the current process.
+
+    :return: (dict) time per call (in milliseconds) of each utility and case
+    """
+    from bench_utils import bench_utils, bench_batch
+
+    timings = {}
+    for case in bench_utils():
+        for name, ms in case["timings_ms"].items():
+            timings[f"{name} [{case['case']}]"] = ms
+    batch = bench_batch()
+    for name, ms in batch["timings_ms"].items():
+        timings[f"process_batch {name} [{batch['num_clips']} clips]"] = ms
+    return {"timings_ms": timings}
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Compare benchmark results against a baseline.
+
+    A stage regresses if its audio-seconds/sec drop, or its peak memory grows, by more than the tolerance.
+    A utility regresses if its time per call grows by more than the tolerance.
+
+    :param results: (dict) benchmark results, from benchmark
+    :param baseline: (dict) benchmark results to compare against
+    :param tolerance: (float) relative change that counts as a regression
+    :return: (list) descriptions of the regressions
+    """
+    if results["config"] != baseline["config"]:
+        print("Warning: the baseline was run with a different configuration, the comparison may not be meaningful.")
+
+    regressions = []
+    print(f"{'stage':>20} {'audio s/s':>10} {'baseline':>10} {'change':>8} "
+          f"{'peak MiB':>10} {'baseline':>10} {'change':>8}")
+    for stage, r in results["stages"].items():
+        b = baseline["stages"].get(stage)
+        if b is None or "skipped" in r or "skipped" in b:
+            continue
+        speed = r["audio_sec_per_sec"] / b["audio_sec_per_sec"] - 1
+        memory = r["peak_rss_mb"] / b["peak_rss_mb"] - 1
+        print(f"{stage:>20} {r['audio_sec_per_sec']:>10.2f} {b['audio_sec_per_sec']:>10.2f} {speed:>+8.1%} "
+              f"{r['peak_rss_mb']:>10.1f} {b['peak_rss_mb']:>10.1f} {memory:>+8.1%}")
+        if speed < -tolerance:
+            regressions.append(f"{stage}: throughput {speed:+.1%}")
+        if memory > tolerance:
+            regressions.append(f"{stage}: peak memory {memory:+.1%}")
+
+    if "utils" in results and "utils" in baseline:
+        for name, ms in results["utils"]["timings_ms"].items():
+            b_ms = baseline["utils"]["timings_ms"].get(name)
+            if b_ms is not None and ms / b_ms - 1 > tolerance:
+                regressions.append(f"{name}: time per call {ms / b_ms - 1:+.1%}")
+
+    if regressions:
+        print(f"{len(regressions)} regressions against the baseline:")
+        for regression in regressions:
+            print(f"--- {regression}")
+    else:
+        print("No regressions against the baseline.")
+
+    return regressions
+
+
+def benchmark(stages=STAGES, num_files=NUM_FILES, duration=DURATION, sr=SAMPLE_RATE, num_channels=NUM_CHANNELS,
+              workers=1, pretrained=False, res_type=RES_TYPE, work_dir=None):
+    """
+    Time the stages on a synthetic corpus.
+
+    Each stage runs with profiling in a fresh process, and reports its wall time, files/sec,
+    audio-seconds/sec (of the input audio), time per phase and peak memory.
+    Runs offline on the cpu: unless pretrained is True, the separation model is a randomly
+    initialized stand-in with the architecture of the pretrained one. The OpenL3 weights are
+    part of the openl3 package. Stages whose dependencies are not installed are skipped.
+
+    :param stages: (list) names of the stages to run (see STAGES)
+    :param num_files: (int) number of files in the corpus
+    :param duration: (float) length of each file in seconds
+    :param sr: (int) sample rate of the corpus
+    :param num_channels: (int) 1 for a mono corpus, 2 for a stereo corpus
+    :param workers: (int) number of worker processes of each stage
+    :param pretrained: (bool) whether to separate with the pretrained model instead of the stand-in
+    :param res_type: (str) resampling filter of preprocess and postprocess (see constants.RES_TYPE)
+    :param work_dir: (str) directory of the corpus and stage outputs, if None, a temporary directory
+    :return: (dict) configuration, system and results of each stage
+    """
+    config = {"num_files": num_files, "duration": duration, "sr": sr, "num_channels": num_channels,
+              "workers": workers, "pretrained": pretrained, "res_type": res_type}
+    results = {
+        "config": config,
+        "system": {"cpus": len(os.sched_getaffinity(0)), "platform": platform.platform(),
+                   "python": platform.python_version()},
+        "started_at": time.time(),
+        "stages": {},
+    }
+
+    tmp_dir = None
+    if work_dir is None:
+        tmp_dir = tempfile.mkdtemp(prefix="timbre_bench_")
+        work_dir = tmp_dir
+
+    try:
+        corpus_dir = os.path.join(work_dir, "corpus")
+        print(f"Writing a synthetic corpus of {num_files} files to {corpus_dir}...")
+        make_corpus(corpus_dir, num_files=num_files, duration=duration, sr=sr, num_channels=num_channels)
+
+        # every stage runs in a fresh process
+        context = multiprocessing.get_context("spawn")
+        in_dirs = {"preprocess": corpus_dir}
+        model_name = "htdemucs"
+        for stage in [stage for stage in STAGES if stage in stages and stage != "utils"]:
+            out_dir = os.path.join(work_dir, stage)
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+            # input of the stage: output of the closest previous stage that ran, or the corpus
+            # the feature stages read mono final stems, if postprocess did not run, a mono corpus at
+            # the sample rate of the stems stands in for them
+            if stage in ("separate", "postprocess"):
+                in_dir = in_dirs.get("separate", in_dirs.get("preprocess", corpus_dir))
+            elif stage in ("extract_mfccs", "extract_embeddings"):
+                key, stem_sr = ("mfccs", FINAL_SRS[0]) if stage == "extract_mfccs" else ("embeddings", FINAL_SRS[1])
+                if key not in in_dirs:
+                    in_dirs[key] = os.path.join(work_dir, f"stems_{stem_sr}")
+                    print(f"Writing a mono corpus at {stem_sr} Hz to {in_dirs[key]}, in place of the final stems...")
+                    make_corpus(in_dirs[key], num_files=num_files, duration=duration, sr=stem_sr, num_channels=1)
+                in_dir = in_dirs[key]
+            else:
+                in_dir = corpus_dir
+
+            print(f"=== {stage} ===")
+            with context.Pool(1) as pool:
+                if stage == "separate" and not pretrained:
+                    model_name = os.path.join(work_dir, "standin_htdemucs.th")
+                    try:
+                        pool.apply(make_standin_separation_model, (model_name,))
+                    except ImportError as e:
+                        results["stages"][stage] = {"skipped": str(e)}
+                        print(f"Skipped {stage}: {e}")
+                        continue
+                summary = pool.apply(run_stage, (stage, in_dir, out_dir, workers, model_name, res_type))
+            results["stages"][stage] = summary
+            if "skipped" in summary:
+                print(f"Skipped {stage}: {summary['skipped']}")
+                continue
+
+            # outputs of the stage that later stages read
+            if stage == "preprocess":
+                in_dirs["preprocess"] = out_dir
+            elif stage == "separate":
+                in_dirs["separate"] = out_dir
+            elif stage == "postprocess":
+                in_dirs["mfccs"] = os.path.join(out_dir, str(FINAL_SRS[0]))
+                in_dirs["embeddings"] = os.path.join(out_dir, str(FINAL_SRS[1]))
+
+        if "utils" in stages:
+            print("=== utils ===")
+            results["utils"] = run_utils()
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # print a summary table
+    print(f"{'stage':>20} {'seconds':>10} {'files/s':>10} {'audio s/s':>10} {'peak MiB':>10}  slowest phase")
+    for stage, r in results["stages"].items():
+        if "skipped" in r:
+            print(f"{stage:>20} skipped ({r['skipped']})")
+            continue
+        slowest = max(r["phases"].items(), key=lambda p: p[1], default=("-", 0.0))
+        print(f"{stage:>20} {r['wall_sec']:>10.1f} {r['files_per_sec']:>10.3f} {r['audio_sec_per_sec']:>10.2f} "
+              f"{r['peak_rss_mb']:>10.1f}  {slowest[0]} ({slowest[1]:.1f}s)")
+
+    return results
+
+
+def smoke(num_channels=NUM_CHANNELS, workers=1):
+    """
+    Smoke check the benchmark on a tiny corpus: run each stage on its own, so that each stage
+    also runs on the corpus that stands in for skipped upstream stages, then all stages together.
+    A stage that crashes raises, stages whose dependencies are not installed are skipped.
+
+    :param num_channels: (int) 1 for a mono corpus, 2 for a stereo corpus
+    :param workers: (int) number of worker processes of each stage
+    """
+    runs = [[stage] for stage in STAGES if stage != "utils"] + [[stage for stage in STAGES if stage != "utils"]]
+    for stages in runs:
+        print(f"Smoke check of {', '.join(stages)}...")
+        benchmark(stages=stages, num_files=SMOKE_NUM_FILES, duration=SMOKE_DURATION, num_channels=num_channels,
+                  workers=workers)
+    print(f"Smoke check passed ({len(runs)} runs).")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the stages on a synthetic corpus.")
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES, help="stages to run")
+    parser.add_argument("--num-files", type=int, default=NUM_FILES, help="number of files in the corpus")
+    parser.add_argument("--duration", type=float, default=DURATION, help="length of each file in seconds")
+    parser.add_argument("--sr", type=int, default=SAMPLE_RATE, help="sample rate of the corpus")
+    parser.add_argument("--channels", type=int, default=NUM_CHANNELS, choices=[1, 2], help="number of channels")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes of each stage")
+    parser.add_argument("--pretrained", action="store_true",
+                        help="separate with the pretrained model instead of the stand-in (downloads the weights)")
+    parser.add_argument("--res-type", default=RES_TYPE, help="resampling filter of preprocess and postprocess")
+    parser.add_argument("--work-dir", default=None, help="directory of the corpus and outputs (kept)")
+    parser.add_argument("--output", default=None, help="path of where to save the results as JSON")
+    parser.add_argument("--baseline", default=None, help="path of results to compare against")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="relative change that is a regression")
+    parser.add_argument("--smoke", action="store_true",
+                        help="only smoke check each stage on its own and all stages together on a tiny corpus")
+    args = parser.parse_args()
+
+    if args.smoke:
+        # run function
+        smoke(num_channels=args.channels, workers=args.workers)
+        sys.exit(0)
+
+    # run function
+    bench_results = benchmark(stages=args.stages, num_files=args.num_files, duration=args.duration, sr=args.sr,
+                              num_channels=args.channels, workers=args.workers, pretrained=args.pretrained,
+                              res_type=args.res_type, work_dir=args.work_dir)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(bench_results, f, indent=2)
+        print(f"Results saved to {args.output}.")
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline_results = json.load(f)
+        # exit with an error if anything regressed, e.g. to fail a ci job
+        if compare(bench_results, baseline_results, tolerance=args.tolerance):
+            sys.exit(1)
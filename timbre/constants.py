@@ -1,3 +1,35 @@
 # constants for Short Time Fourier Transform
 HOP_LENGTH = 256
 N_FFT = 4096
+
+# constants for Mel-Frequency Cepstral Coefficients
+NUM_MFCC = 13
+# FFT window length of the mel spectrogram the MFCCs are computed from
+# (the librosa default, which the MFCCs have always been computed with)
+# the mel cache keys its entries on the FFT length, so the MFCCs share their spectrograms with the
+# MFCC plots and the timbre statistics, but not with the spectrogram plots (N_FFT)
+MFCC_N_FFT = 2048
+
+# on-disk cache of mel spectrograms shared by feature extraction and plotting
+# the stage scripts use it when they are run on their own, the stage functions only use a cache if given one
+MEL_CACHE_DIR = "/scratch/rn2214/cache/mel"
+MEL_CACHE_MAX_BYTES = 20 * 1024 ** 3
+
+# resampling filter of preprocess and postprocess, any res_type of librosa.resample, e.g.:
+#     "soxr_vhq", "soxr_hq" (the librosa default), "soxr_mq", "soxr_lq": soxr quality tiers
+#     "polyphase": scipy.signal.resample_poly, fast for integer ratios such as 44100 -> 22050
+#     "kaiser_best", "kaiser_fast", "fft"
+# see bench_resample.py for the speed and spectral error of each on our stems
+# files processed before the resampler was configurable used the librosa default, and manifests
+# only record the resampler of files processed with another one
+LIBROSA_RES_TYPE = "soxr_hq"
+RES_TYPE = LIBROSA_RES_TYPE
+
+# storage of the audio written by preprocess, separate, postprocess and pipeline:
+#     AUDIO_FORMAT:  "WAV" or "FLAC" (lossless, the same samples in about half the space)
+#     AUDIO_SUBTYPE: "PCM_16" (what sf.write has always written), "PCM_24", or "FLOAT" (32 bit float, WAV only)
+# and the dtype soundfile decodes audio to, float32 like librosa.load, half the memory of float64
+# see bench_storage.py for the size and read/write speed of each on our stems
+AUDIO_FORMAT = "WAV"
+AUDIO_SUBTYPE = "PCM_16"
+AUDIO_DTYPE = "float32"
@@ -0,0 +1,458 @@
+import os
+import time
+import numpy as np
+from feature_store import FeatureStore
+
+
+# set input and output paths
+# store of OpenL3 embedding frames written by extract_embeddings
+STORE_DIR = "/scratch/rn2214/data/embeddings_512/all_embeddings_512"
+INDEX_PATH = "/scratch/rn2214/data/embeddings_512/embedding_index.npz"
+
+# how the frames of a clip are pooled into a single vector:
+# "mean", "meanstd" (mean and standard deviation, concatenated) or "max"
+POOLING = "meanstd"
+
+# number of principal components to keep, if None, keep the pooled vectors as they are,
+# and number of vectors the components are fitted on
+PCA_DIM = 128
+PCA_SAMPLES = 20000
+
+# whether to store the vectors as int8 (4x smaller, scores are slightly less exact)
+QUANTIZE = False
+
+# approximate search: number of lists (clusters) the vectors are split into, if None, sqrt(num_clips),
+# and number of lists closest to the query that are searched
+NUM_LISTS = None
+NUM_PROBES = 8
+
+# number of k-means iterations used to find the lists, and number of vectors per list to train on
+KMEANS_ITERS = 20
+KMEANS_SAMPLES_PER_LIST = 64
+
+# number of nearest neighbors to return
+TOP_K = 10
+
+# number of queries (exact search) or database rows scored together, bounds the size of the score matrix
+BATCH_SIZE = 1024
+
+
+def pool_frames(x, pooling=POOLING):
+    """
+    Pool the embedding frames of a clip into a single vector.
+
+    :param x: (np.array) embedding frames, of shape (num_frames, dim)
+    :param pooling: (str) "mean", "meanstd" or "max"
+    :return: (np.array) pooled vector, of length dim, or 2 * dim for "meanstd"
+    """
+    x = np.asarray(x, dtype=np.float32)
+    if pooling == "mean":
+        return x.mean(axis=0)
+    if pooling == "meanstd":
+        return np.concatenate((x.mean(axis=0), x.std(axis=0)))
+    if pooling == "max":
+        return x.max(axis=0)
+    raise ValueError(f"Unknown pooling {pooling}!")
+
+
+def pool_store(store, pooling=POOLING):
+    """
+    Pool the embedding frames of every clip of a FeatureStore.
+
+    If the clips were already pooled when they were extracted (see embedding_reduce), their vectors
+    are loaded as they are, and pooling is ignored (see store_pooling).
+
+    :param store: (FeatureStore) store of embedding frames, e.g. written by extract_embeddings
+    :param pooling: (str) "mean", "meanstd" or "max"
+    :return: (list, np.array) names of the clips and their pooled vectors, of shape (num_clips, pooled dim)
+    """
+    names, offsets = store.item_offsets()
+    data = store.array()
+    if store.attrs.get("pooling") is not None:
+        # one row per clip
+        return names, np.asarray(data[offsets[:, 0]], dtype=np.float32).reshape(-1, store.dim)
+    # clips without frames cannot be pooled
+    keep = offsets[:, 1] > offsets[:, 0]
+    names = [name for name, k in zip(names, keep) if k]
+    vectors = np.stack([pool_frames(data[start:end], pooling) for start, end in offsets[keep]]) if names \
+        else np.zeros((0, store.dim * (2 if pooling == "meanstd" else 1)), dtype=np.float32)
+    return names, vectors
+
+
+def store_pooling(store, pooling=POOLING):
+    """
+    :param store: (FeatureStore) store of embedding frames or of pooled vectors
+    :param pooling: (str) how the frames of the clips are pooled, if they are not already
+    :return: (str) how the vectors returned by pool_store(store, pooling) are pooled
+    """
+    return store.attrs.get("pooling") or pooling
+
+
+def l2_normalize(x):
+    """
+    Scale vectors to unit length, so that dot products are cosine similarities.
+
+    :param x: (np.array) vectors, of shape (num_vectors, dim)
+    :return: (np.array) normalized vectors
+    """
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+def top_k(scores, k):
+    """
+    Find the highest scores of each row of a score matrix, without sorting whole rows.
+
+    :param scores: (np.array) scores, of shape (num_queries, num_candidates)
+    :param k: (int) number of scores to keep per row
+    :return: (np.array, np.array) columns of the k highest scores of each row and the scores, best first
+    """
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.zeros((len(scores), 0), dtype=np.int64), np.zeros((len(scores), 0), dtype=np.float32)
+    idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-part, axis=1, kind="stable")
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+
+def kmeans(x, num_clusters, num_iters=KMEANS_ITERS, samples_per_cluster=KMEANS_SAMPLES_PER_LIST, seed=0):
+    """
+    Cluster unit vectors with spherical k-means, on a random sample of them.
+
+    :param x: (np.array) unit vectors, of shape (num_vectors, dim)
+    :param num_clusters: (int) number of clusters
+    :param num_iters: (int) number of iterations
+    :param samples_per_cluster: (int) number of vectors per cluster to train on
+    :param seed: (int) seed of the random sample and initial centroids
+    :return: (np.array) unit centroids, of shape (num_clusters, dim)
+    """
+    rng = np.random.default_rng(seed)
+    num_samples = min(len(x), num_clusters * samples_per_cluster)
+    train = np.ascontiguousarray(x[np.sort(rng.choice(len(x), num_samples, replace=False))])
+    centroids = train[rng.choice(len(train), num_clusters, replace=False)].copy()
+
+    for _ in range(num_iters):
+        assign = nearest_centroids(train, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, train)
+        counts = np.bincount(assign, minlength=num_clusters)
+        # move empty clusters to random vectors
+        empty = counts == 0
+        sums[empty] = train[rng.choice(len(train), int(empty.sum()))]
+        centroids = l2_normalize(sums)
+    return centroids
+
+
+def nearest_centroids(x, centroids, num=1, batch_size=BATCH_SIZE):
+    """
+    Find the centroids closest to each vector.
+
+    :param x: (np.array) unit vectors, of shape (num_vectors, dim)
+    :param centroids: (np.array) unit centroids, of shape (num_clusters, dim)
+    :param num: (int) number of centroids to find per vector
+    :param batch_size: (int) number of vectors scored together
+    :return: (np.array) closest centroid of each vector, or the num closest, best first, if num > 1
+    """
+    out = np.zeros((len(x), num), dtype=np.int64)
+    for start in range(0, len(x), batch_size):
+        scores = x[start:start + batch_size] @ centroids.T
+        out[start:start + batch_size] = top_k(scores, num)[0]
+    return out[:, 0] if num == 1 else out
+
+
+class EmbeddingIndex:
+    """
+    Nearest neighbor index of OpenL3 embeddings pooled per clip, for timbre similarity search.
+
+    The pooled vectors are (optionally) projected onto their principal components, scaled to unit
+    length so that similarity is the cosine similarity, and (optionally) stored as int8.
+    Two search modes are supported:
+        exact:       every clip is scored, as one matrix product per batch of queries
+        approximate: the clips are split into lists by k-means (an inverted file index) and only the
+                     num_probes lists with the centroids closest to the query are scored
+
+    Build an index with EmbeddingIndex.from_store(...) or EmbeddingIndex.build(names, vectors),
+    save it with index.save(path) and reload it with EmbeddingIndex.load(path).
+    """
+
+    def __init__(self, names, vectors, mean=None, components=None, scale=None, centroids=None, lists=None,
+                 pooling=POOLING):
+        """
+        Use build, from_store or load instead of creating an index directly.
+
+        :param names: (list) names of the clips
+        :param vectors: (np.array) unit vectors of the clips (float32, or int8 if scale is given),
+                                   ordered by list if the index has lists
+        :param mean: (np.array) mean of the pooled vectors, if the vectors were projected
+        :param components: (np.array) principal components, of shape (pooled dim, dim), if the vectors were projected
+        :param scale: (np.array) scale of each dimension of the int8 vectors, if they are quantized
+        :param centroids: (np.array) unit centroids of the lists, for approximate search
+        :param lists: (np.array) start row of each list and the end row of the last one, for approximate search
+        :param pooling: (str) how the frames of a clip were pooled
+        """
+        self.names = list(names)
+        self.vectors = vectors
+        self.mean = mean
+        self.components = components
+        self.scale = scale
+        self.centroids = centroids
+        self.lists = lists
+        self.pooling = pooling
+        self._index = {name: i for i, name in enumerate(self.names)}
+
+    @classmethod
+    def build(cls, names, vectors, pca_dim=PCA_DIM, quantize=QUANTIZE, num_lists=NUM_LISTS, approximate=True,
+              pooling=POOLING):
+        """
+        Build an index of pooled vectors.
+
+        :param names: (list) names of the clips
+        :param vectors: (np.array) pooled vectors of the clips, of shape (num_clips, pooled dim)
+        :param pca_dim: (int) number of principal components to keep, if None, keep the pooled vectors
+        :param quantize: (bool) whether to store the vectors as int8
+        :param num_lists: (int) number of lists for approximate search, if None, sqrt(num_clips)
+        :param approximate: (bool) whether to split the vectors into lists for approximate search
+        :param pooling: (str) how the frames of a clip were pooled
+        :return: (EmbeddingIndex) index
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        names = list(names)
+        if len(names) != len(vectors):
+            raise ValueError("There must be one vector per name!")
+        if len(vectors) == 0:
+            raise ValueError("Cannot build an index of no vectors!")
+
+        mean = components = scale = centroids = lists = None
+        if pca_dim is not None and pca_dim < vectors.shape[1]:
+            # principal components of (a random sample of) the pooled vectors,
+            # from the eigenvectors of their covariance
+            rng = np.random.default_rng(0)
+            sample = vectors[np.sort(rng.choice(len(vectors), min(len(vectors), PCA_SAMPLES), replace=False))]
+            mean = sample.mean(axis=0)
+            centered = sample - mean
+            cov = (centered.T @ centered) / max(len(sample) - 1, 1)
+            eigvals, eigvecs = np.linalg.eigh(cov.astype(np.float64))
+            components = eigvecs[:, ::-1][:, :pca_dim].astype(np.float32)
+            vectors = (vectors - mean) @ components
+        vectors = l2_normalize(vectors).astype(np.float32)
+
+        if approximate:
+            if num_lists is None:
+                num_lists = int(np.sqrt(len(vectors)))
+            num_lists = max(1, min(num_lists, len(vectors)))
+            centroids = kmeans(vectors, num_lists)
+            # store the vectors of each list contiguously
+            assign = nearest_centroids(vectors, centroids)
+            order = np.argsort(assign, kind="stable")
+            vectors = vectors[order]
+            names = [names[i] for i in order]
+            lists = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=num_lists)))).astype(np.int64)
+
+        if quantize:
+            # symmetric per-dimension scale, so that the int8 range covers each dimension
+            scale = np.maximum(np.abs(vectors).max(axis=0), 1e-12) / 127
+            vectors = np.round(vectors / scale).astype(np.int8)
+            scale = scale.astype(np.float32)
+
+        return cls(names, vectors, mean=mean, components=components, scale=scale, centroids=centroids,
+                   lists=lists, pooling=pooling)
+
+    @classmethod
+    def from_store(cls, store_dir, pooling=POOLING, **kwargs):
+        """
+        Build an index of the clips of a FeatureStore of embedding frames.
+
+        :param store_dir: (str) directory of the store, e.g. written by extract_embeddings
+        :param pooling: (str) how the frames of a clip are pooled, "mean", "meanstd" or "max",
+                              unless they were already pooled when they were extracted
+        :param kwargs: pca_dim, quantize, num_lists and approximate, as in build
+        :return: (EmbeddingIndex) index
+        """
+        store = FeatureStore(store_dir)
+        names, vectors = pool_store(store, pooling)
+        return cls.build(names, vectors, pooling=store_pooling(store, pooling), **kwargs)
+
+    def save(self, path):
+        """
+        Save the index as a single .npz file.
+
+        :param path: (str) path of the index file
+        """
+        arrays = {"names": np.array(self.names, dtype=str), "vectors": self.vectors,
+                  "pooling": np.array(self.pooling)}
+        for key in ["mean", "components", "scale", "centroids", "lists"]:
+            if getattr(self, key) is not None:
+                arrays[key] = getattr(self, key)
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index saved with save.
+
+        :param path: (str) path of the index file
+        :return: (EmbeddingIndex) index
+        """
+        with np.load(path) as data:
+            kwargs = {key: data[key] for key in ["mean", "components", "scale", "centroids", "lists"]
+                      if key in data}
+            return cls(data["names"].tolist(), data["vectors"], pooling=str(data["pooling"]), **kwargs)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    @property
+    def dim(self):
+        """
+        :return: (int) width of the indexed vectors
+        """
+        return self.vectors.shape[1]
+
+    def transform(self, pooled):
+        """
+        Map pooled vectors to the space of the index (projection and normalization).
+
+        :param pooled: (np.array) pooled vectors, of shape (num_vectors, pooled dim), or a single vector
+        :return: (np.array) unit vectors, of shape (num_vectors, dim)
+        """
+        x = np.atleast_2d(np.asarray(pooled, dtype=np.float32))
+        if self.components is not None:
+            x = (x - self.mean) @ self.components
+        return l2_normalize(x).astype(np.float32)
+
+    def vector(self, name):
+        """
+        :param name: (str) name of a clip
+        :return: (np.array) unit vector of the clip, in the space of the index
+        """
+        x = self.vectors[self._index[name]].astype(np.float32)
+        if self.scale is not None:
+            x *= self.scale
+        return x
+
+    def _scores(self, queries, start, end):
+        # dot products with rows start to end, int8 rows are scaled through the queries
+        rows = self.vectors[start:end]
+        if self.scale is not None:
+            return (queries * self.scale) @ rows.T.astype(np.float32)
+        return queries @ rows.T
+
+    def _search_exact(self, queries, k, batch_size):
+        # keep the k best of each batch of rows, then the k best of those
+        best_idx, best_scores = [], []
+        for start in range(0, len(self.vectors), batch_size * 16):
+            idx, scores = top_k(self._scores(queries, start, start + batch_size * 16), k)
+            best_idx.append(idx + start)
+            best_scores.append(scores)
+        idx, scores = np.concatenate(best_idx, axis=1), np.concatenate(best_scores, axis=1)
+        cols, scores = top_k(scores, k)
+        return np.take_along_axis(idx, cols, axis=1), scores
+
+    def _search_approximate(self, queries, k, num_probes):
+        num_probes = min(num_probes, len(self.centroids))
+        probes = nearest_centroids(queries, self.centroids, num=num_probes).reshape(len(queries), num_probes)
+        out_idx = np.full((len(queries), k), -1, dtype=np.int64)
+        out_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, (query, lists) in enumerate(zip(queries, probes)):
+            # rows of the probed lists
+            rows = np.concatenate([np.arange(self.lists[j], self.lists[j + 1]) for j in lists])
+            if len(rows) == 0:
+                continue
+            vectors = self.vectors[rows]
+            if self.scale is not None:
+                scores = vectors.astype(np.float32) @ (query * self.scale)
+            else:
+                scores = vectors @ query
+            cols, best = top_k(scores[None], k)
+            out_idx[i, :cols.shape[1]] = rows[cols[0]]
+            out_scores[i, :cols.shape[1]] = best[0]
+        return out_idx, out_scores
+
+    def search(self, queries, k=TOP_K, exact=False, num_probes=NUM_PROBES, batch_size=BATCH_SIZE):
+        """
+        Find the clips most similar to query vectors already in the space of the index (see transform).
+
+        :param queries: (np.array) unit query vectors, of shape (num_queries, dim)
+        :param k: (int) number of clips to return per query
+        :param exact: (bool) whether to score every clip, even if the index has lists for approximate search
+        :param num_probes: (int) approximate search: number of lists scored per query
+        :param batch_size: (int) exact search: number of queries scored together
+        :return: (np.array, np.array) rows of the k most similar clips of each query, of shape (num_queries, k),
+                                      and their cosine similarities, best first,
+                                      rows are -1 where approximate search found fewer than k clips
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        k = min(k, len(self))
+        if k == 0:
+            return np.zeros((len(queries), 0), dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32)
+        if exact or self.lists is None:
+            results = [self._search_exact(queries[start:start + batch_size], k, batch_size)
+                       for start in range(0, len(queries), batch_size)]
+            if not results:
+                return np.zeros((0, k), dtype=np.int64), np.zeros((0, k), dtype=np.float32)
+            return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+        return self._search_approximate(queries, k, num_probes)
+
+    def similar(self, names, k=TOP_K, **kwargs):
+        """
+        Find the clips most similar to clips of the index, leaving out the clips themselves.
+
+        :param names: (str or list) name(s) of the query clip(s)
+        :param k: (int) number of clips to return per query
+        :param kwargs: exact, num_probes and batch_size, as in search
+        :return: (list) for each query, a list of (name, cosine similarity) pairs, best first
+        """
+        if isinstance(names, str):
+            names = [names]
+        queries = np.stack([self.vector(name) for name in names]) if names else np.zeros((0, self.dim))
+        idx, scores = self.search(queries, k=k + 1, **kwargs)
+        results = []
+        for name, row_idx, row_scores in zip(names, idx, scores):
+            results.append([(self.names[i], float(s)) for i, s in zip(row_idx, row_scores)
+                            if i >= 0 and self.names[i] != name][:k])
+        return results
+
+
+def build_index(store_dir, index_path, pooling=POOLING, pca_dim=PCA_DIM, quantize=QUANTIZE, num_lists=NUM_LISTS):
+    """
+    Build a similarity index of the clips of a store of embedding frames and save it.
+
+    :param store_dir: (str) directory of the store, e.g. written by extract_embeddings
+    :param index_path: (str) path of where to save the index
+    :param pooling: (str) how the frames of a clip are pooled, "mean", "meanstd" or "max",
+                          unless they were already pooled when they were extracted
+    :param pca_dim: (int) number of principal components to keep, if None, keep the pooled vectors
+    :param quantize: (bool) whether to store the vectors as int8
+    :param num_lists: (int) number of lists for approximate search, if None, sqrt(num_clips)
+    :return: (EmbeddingIndex) index
+    """
+    store = FeatureStore(store_dir)
+    pooling = store_pooling(store, pooling)
+    print(f"Pooling the embedding frames of each clip ({pooling})...")
+    start = time.perf_counter()
+    names, vectors = pool_store(store, pooling)
+    print(f"Pooled {len(names)} clips in {time.perf_counter() - start:.1f} seconds.")
+
+    print("Building index...")
+    start = time.perf_counter()
+    index = EmbeddingIndex.build(names, vectors, pca_dim=pca_dim, quantize=quantize, num_lists=num_lists,
+                                 pooling=pooling)
+    num_lists = 0 if index.lists is None else len(index.lists) - 1
+    print(f"Built an index of {len(index)} clips x {index.dim} dimensions ({index.vectors.dtype}, "
+          f"{num_lists} lists) in {time.perf_counter() - start:.1f} seconds.")
+
+    # create the output directory if it does not already exist
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    index.save(index_path)
+    print(f"Saved index to {index_path}.")
+    return index
+
+
+if __name__ == '__main__':
+    # run function
+    build_index(STORE_DIR, INDEX_PATH)
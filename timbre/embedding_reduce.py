@@ -0,0 +1,245 @@
+import os
+import numpy as np
+from feature_store import FeatureStore, STALE_FRACTION
+from embedding_index import pool_frames
+
+
+# reductions applied to the OpenL3 embedding frames of each clip as they are extracted (see extract_embeddings)
+# how the frames of a clip are pooled into a single vector: "mean", "meanstd" or "max",
+# if None, keep one row per frame
+POOLING = None
+
+# number of principal components to keep, if None, keep every dimension,
+# and number of rows the components are fitted on, the rows that follow are projected as they arrive
+PCA_DIM = None
+PCA_FIT_ROWS = 20000
+
+# dtype the reduced rows are stored as, "float32" or "float16" (half the size)
+DTYPE = "float32"
+
+# name of the file the principal components are saved to, in the directory of the reduced store
+PCA_NAME = "pca.npz"
+
+
+def reduction_params(pooling=POOLING, pca_dim=PCA_DIM, dtype=DTYPE):
+    """
+    Get the reductions to record with the parameters of a run, and as the attributes of a reduced store.
+
+    :param pooling: (str) how the frames of a clip are pooled, if None, keep the frames
+    :param pca_dim: (int) number of principal components to keep, if None, keep every dimension
+    :param dtype: (str) dtype the reduced rows are stored as
+    :return: (dict) the reductions that are applied, empty if the frames are stored as they are
+    """
+    params = {}
+    if pooling is not None:
+        params["pooling"] = pooling
+    if pca_dim is not None:
+        params["pca_dim"] = pca_dim
+    if dtype != "float32":
+        params["dtype"] = dtype
+    return params
+
+
+def reduced_store_name(embedding_size, pooling=POOLING, pca_dim=PCA_DIM, dtype=DTYPE):
+    """
+    Get the name of the store of reduced embeddings, e.g. all_embeddings_512_meanstd_pca128_f16.
+
+    :param embedding_size: (int) width of the embedding frames
+    :param pooling: (str) how the frames of a clip are pooled, if None, keep the frames
+    :param pca_dim: (int) number of principal components to keep, if None, keep every dimension
+    :param dtype: (str) dtype the reduced rows are stored as
+    :return: (str) name of the store, the name of the store of frames if nothing is reduced
+    """
+    name = f"all_embeddings_{embedding_size}"
+    if pooling is not None:
+        name += f"_{pooling}"
+    if pca_dim is not None:
+        name += f"_pca{pca_dim}"
+    if dtype != "float32":
+        name += "_f" + dtype[-2:]
+    return name
+
+
+class IncrementalPCA:
+    """
+    Principal components of a stream of vectors, fitted without holding the vectors in memory.
+
+    partial_fit accumulates the count, sum and sum of outer products of the vectors (in float64),
+    which is all that the covariance needs, then fit takes the eigenvectors of the covariance.
+    """
+
+    def __init__(self, dim, mean=None, components=None):
+        """
+        :param dim: (int) width of the vectors
+        :param mean: (np.array) mean of the vectors, if already fitted
+        :param components: (np.array) principal components, of shape (dim, num_components), if already fitted
+        """
+        self.dim = dim
+        self.count = 0
+        self.sum = np.zeros(dim, dtype=np.float64)
+        self.scatter = np.zeros((dim, dim), dtype=np.float64)
+        self.mean = mean
+        self.components = components
+
+    @property
+    def fitted(self):
+        """
+        :return: (bool) whether the components have been fitted (or loaded)
+        """
+        return self.components is not None
+
+    def partial_fit(self, x):
+        """
+        Accumulate the statistics of a batch of vectors.
+
+        :param x: (np.array) vectors, of shape (num_vectors, dim)
+        """
+        x = np.asarray(x, dtype=np.float64).reshape(-1, self.dim)
+        self.count += len(x)
+        self.sum += x.sum(axis=0)
+        self.scatter += x.T @ x
+
+    def fit(self, num_components):
+        """
+        Fit the principal components to the vectors accumulated so far.
+
+        :param num_components: (int) number of principal components to keep
+        """
+        count = max(self.count, 1)
+        mean = self.sum / count
+        cov = (self.scatter - count * np.outer(mean, mean)) / max(count - 1, 1)
+        eigvals, eigvecs = np.linalg.eigh(cov)
+        self.mean = mean.astype(np.float32)
+        self.components = eigvecs[:, ::-1][:, :num_components].astype(np.float32)
+
+    def transform(self, x):
+        """
+        :param x: (np.array) vectors, of shape (num_vectors, dim)
+        :return: (np.array) vectors projected onto the principal components, of shape (num_vectors, num_components)
+        """
+        return (np.asarray(x, dtype=np.float32) - self.mean) @ self.components
+
+    def save(self, path):
+        """
+        Save the fitted components as a .npz file.
+
+        :param path: (str) path of the file
+        """
+        with open(path, "wb") as f:
+            np.savez(f, mean=self.mean, components=self.components)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load components saved with save.
+
+        :param path: (str) path of the file
+        :return: (IncrementalPCA) fitted PCA
+        """
+        with np.load(path) as data:
+            return cls(len(data["mean"]), mean=data["mean"], components=data["components"])
+
+
+class EmbeddingReducer:
+    """
+    Write reduced embeddings of clips to a FeatureStore as they are extracted, so that downstream
+    consumers load compact vectors rather than the full frame sequences.
+
+    The frames of each clip are pooled (optionally), projected onto principal components (optionally)
+    and cast to the dtype of the store. The principal components are fitted incrementally on the first
+    fit_rows rows: until then, clips are held back (already pooled, so they are small) and written when
+    the components are fitted. The components are saved next to the store (pca.npz) and reused by later
+    runs, so every row of a store is projected the same way. Delete the store to fit them again.
+    """
+
+    def __init__(self, path, dim, pooling=POOLING, pca_dim=PCA_DIM, dtype=DTYPE, fit_rows=PCA_FIT_ROWS,
+                 pca_path=None):
+        """
+        :param path: (str) directory of the reduced store, created if it does not already exist
+        :param dim: (int) width of the embedding frames
+        :param pooling: (str) how the frames of a clip are pooled, "mean", "meanstd" or "max",
+                              if None, keep one row per frame
+        :param pca_dim: (int) number of principal components to keep, if None, keep every dimension
+        :param dtype: (str) dtype the reduced rows are stored as, "float32" or "float16"
+        :param fit_rows: (int) number of rows the principal components are fitted on
+        :param pca_path: (str) path of principal components to project with if they exist, e.g. those of the merged
+                               store when the store is a shard (see shard.py), if None, those of the store itself
+        """
+        self.pooling = pooling
+        self.pca_dim = pca_dim
+        self.fit_rows = fit_rows
+        pooled_dim = dim * (2 if pooling == "meanstd" else 1)
+        out_dim = pooled_dim if pca_dim is None else min(pca_dim, pooled_dim)
+
+        attrs = {"embedding_size": dim, **reduction_params(pooling, pca_dim, dtype)}
+        self.store = FeatureStore(path, dim=out_dim, timestamps=pooling is None, dtype=dtype, attrs=attrs)
+        if self.store.attrs != attrs:
+            raise ValueError(f"The store at {path} was reduced with {self.store.attrs}, not {attrs}!")
+
+        self.pca = None
+        self._pending = []
+        if pca_dim is not None:
+            own_path = os.path.join(path, PCA_NAME)
+            for load_path in [pca_path, own_path]:
+                if load_path is not None and os.path.exists(load_path):
+                    self.pca = IncrementalPCA.load(load_path)
+                    if not os.path.exists(own_path):
+                        # keep the components with the store
+                        self.pca.save(own_path)
+                    break
+            else:
+                self.pca = IncrementalPCA(pooled_dim)
+
+    def __contains__(self, name):
+        return name in self.store
+
+    def append(self, name, emb, ts=None):
+        """
+        Reduce the embedding frames of a clip and append them to the store.
+
+        :param name: (str) name of the clip
+        :param emb: (np.array) embedding frames, of shape (num_frames, dim)
+        :param ts: (np.array) timestamp of each frame
+        """
+        if self.pooling is not None:
+            x = pool_frames(emb, self.pooling)[None]
+            ts = None
+        else:
+            x = np.asarray(emb, dtype=np.float32)
+
+        if self.pca is None or self.pca.fitted:
+            self._write(name, x, ts)
+            return
+
+        # hold the clip back until the principal components are fitted
+        self.pca.partial_fit(x)
+        self._pending.append((name, x, ts))
+        if self.pca.count >= self.fit_rows:
+            self._fit()
+
+    def _fit(self):
+        self.pca.fit(self.pca_dim)
+        self.pca.save(os.path.join(self.store.path, PCA_NAME))
+        for name, x, ts in self._pending:
+            self._write(name, x, ts)
+        self._pending = []
+
+    def _write(self, name, x, ts):
+        if self.pca is not None:
+            x = self.pca.transform(x)
+        self.store.append(name, x, ts)
+
+    def close(self):
+        """
+        Write the clips still held back, fitting the principal components on them if needed, and close the store.
+        """
+        if self._pending:
+            self._fit()
+        self.store.close()
+        self.store.compact(STALE_FRACTION)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,85 +1,343 @@
 import os
+import time
+import itertools
+import traceback
 import numpy as np
-import openl3
-import soundfile as sf
 import pickle
 from tqdm import tqdm
+from audio_io import read_item, prefetch, is_audio_file, audio_length
+from shard import select_shard, shard_path, shard_manifest, shard_args, merged_names, mark_done
+from feature_store import FeatureStore, STALE_FRACTION
+from embedding_reduce import (EmbeddingReducer, reduction_params, reduced_store_name, POOLING, PCA_DIM, PCA_FIT_ROWS,
+                              DTYPE, PCA_NAME)
+from models import get_embedding_model, ModelClient
+from parallel import report_failures
+from profiling import phase, add_audio, reset, collect, RunProfile, PROFILE_NAME
 
 
 # set hyperparameters
 INPUT_REPRESENTATION = "mel256"
 EMBEDDING_SIZE = 512
 
+# hop size (in seconds) between embedding frames
+HOP_SIZE = 0.1
+
+# number of clips sent to the model together
+BATCH_SIZE = 16
+
+# number of frames per forward pass of the model (within a batch of clips)
+FRAME_BATCH_SIZE = 32
+
 
 # set input and output directories
 INPUT_DIR = "/scratch/rn2214/data/final_stems_44100"
 OUTPUT_DIR = f"/scratch/rn2214/data/embeddings_{EMBEDDING_SIZE}"
 
 
-def extract_embeddings(in_dir, out_dir):
+def embedding_name(file):
+    """
+    Get the name of the embedding file for a WAV file.
+
+    :param file: (str) name of the WAV file
+    :return: (str) name of the embedding file
+    """
+    s = file.split("_")
+    return f"{s[0]}_{s[1]}_Emb_{EMBEDDING_SIZE}.npy"
+
+
+def load_embedding_model():
+    """
+    Load the pretrained OpenL3 model with the hyperparameters of this module,
+    or get it from the models already loaded by the current process.
+
+    :return: (keras.Model) OpenL3 audio embedding model
+    """
+    return get_embedding_model(INPUT_REPRESENTATION, "music", EMBEDDING_SIZE)
+
+
+def iter_embeddings(items, model=None, batch_size=1, frame_batch_size=FRAME_BATCH_SIZE, hop_size=HOP_SIZE):
+    """
+    Lazily compute the OpenL3 embedding frames of each item of a stream of audio.
+
+    Items are sent to the model batch_size at a time, while the next batch is read on background
+    threads (see audio_io.prefetch), so at most two batches of audio are held in memory at a time.
+
+    :param items: (iterable) paths of audio files and/or (name, audio array, sample rate) tuples,
+                             audio arrays are channels first if stereo
+    :param model: (keras.Model) OpenL3 model, if None, load it with load_embedding_model
+    :param batch_size: (int) number of items to send to the model at once
+    :param frame_batch_size: (int) number of frames per forward pass of the model
+    :param hop_size: (float) hop size (in seconds) between embedding frames
+    :return: (generator) (name, (embedding frames, timestamps), error) for each item, in the order of the items,
+                         the name of a path is its file name, a file that cannot be read or embedded fails on
+                         its own with the traceback as error (and None in place of the embeddings),
+                         error is None if the item succeeded
+    """
+    # openl3 (tensorflow) is only imported when a model is run (see models.py)
+    import openl3
+
+    if model is None:
+        model = load_embedding_model()
+
+    def embed(audio_list, sr_list):
+        return openl3.get_audio_embedding(audio_list, sr_list, model=model, hop_size=hop_size,
+                                          batch_size=frame_batch_size, verbose=False)
+
+    # read the next batch in the background while the current one is embedded
+    inputs = prefetch(items, read_item, depth=batch_size)
+    try:
+        while True:
+            # time spent waiting for the background reads
+            # openl3 expects audio arrays as (num_samples, num_channels)
+            names, audio_list, sr_list, errors = [], [], [], []
+            with phase("read"):
+                for item, future in itertools.islice(inputs, batch_size):
+                    try:
+                        name, y, sr = future.result()
+                        names.append(name)
+                        audio_list.append(y.T)
+                        sr_list.append(sr)
+                        errors.append(None)
+                    except Exception:
+                        names.append(os.path.basename(item) if isinstance(item, str) else item[0])
+                        audio_list.append(None)
+                        sr_list.append(None)
+                        errors.append(traceback.format_exc())
+            if not names:
+                break
+
+            # extract embeddings for the whole batch
+            # a clip that fails fails on its own, the rest of the batch is embedded
+            ok = [i for i, error in enumerate(errors) if error is None]
+            emb_batch, ts_batch = [None] * len(names), [None] * len(names)
+            with phase("inference"):
+                try:
+                    if ok:
+                        embs, tss = embed([audio_list[i] for i in ok], [sr_list[i] for i in ok])
+                        for i, emb, ts in zip(ok, embs, tss):
+                            emb_batch[i], ts_batch[i] = emb, ts
+                except Exception:
+                    # find the clips that fail on their own
+                    for i in ok:
+                        try:
+                            (emb_batch[i],), (ts_batch[i],) = embed([audio_list[i]], [sr_list[i]])
+                        except Exception:
+                            errors[i] = traceback.format_exc()
+            durations = [len(y) / sr if y is not None else 0.0 for y, sr in zip(audio_list, sr_list)]
+            del audio_list
+
+            for name, emb, ts, error, duration in zip(names, emb_batch, ts_batch, errors, durations):
+                if error is not None:
+                    yield name, None, error
+                    continue
+                add_audio(duration)
+                yield name, (emb, ts), None
+    finally:
+        inputs.close()
+
+
+def extract_embeddings(in_dir, out_dir, batch_size=1, frame_batch_size=FRAME_BATCH_SIZE, force=False,
+                       write_pickle=True, profile=False, server=None, hop_size=HOP_SIZE, pooling=POOLING,
+                       pca_dim=PCA_DIM, dtype=DTYPE, keep_frames=False, pca_fit_rows=PCA_FIT_ROWS, shard=None,
+                       num_shards=1):
     """
     Extract OpenL3 audio embeddings from vocal stem WAV files.
 
+    With batch_size > 1, clips are grouped by length and each group is sent to the model
+    as a single list, while the next group is read from disk on a background thread.
+
+    The embedding frames and timestamps of all files are appended to a FeatureStore in the
+    output directory as they are computed, and can be loaded with FeatureStore(path).get(name).
+
+    With any of pooling, pca_dim or a float16 dtype, the frames are reduced as they are computed
+    (see embedding_reduce.EmbeddingReducer) and only the reduced rows are stored, in a FeatureStore
+    named after the reductions (e.g. all_embeddings_512_meanstd_pca128_f16), unless keep_frames is True.
+    A store of pooled clips has one row per clip, and can be loaded as a single (num_clips, dim) array
+    with FeatureStore(path).array() or indexed directly with embedding_index.build_index.
+
+    Files that were already processed with the same contents and parameters, according to
+    the manifest kept in the output directory, are not recomputed unless force is True.
+
     :param in_dir: (str) directory of WAV files to extract embeddings from
     :param out_dir: (str) directory of where to save the extracted embeddings
+    :param batch_size: (int) number of clips to send to the model at once
+    :param frame_batch_size: (int) number of frames per forward pass of the model
+    :param force: (bool) whether to reprocess files that were already processed
+    :param write_pickle: (bool) whether to also dump all embeddings, timestamps, and file names
+                                as a single pickle file
+    :param profile: (bool) whether to append per-file phase timings and a summary of the run
+                           to the profile file in the output directory (see profiling.RunProfile),
+                           with batch_size > 1, the read and inference time of a batch is counted on its first clip
+    :param server: (str or tuple) if given, address of a model server that keeps the model loaded
+                                  (see model_server.py), batches of files are sent to it instead of
+                                  loading the model in this run
+    :param hop_size: (float) hop size (in seconds) between embedding frames, larger hops compute and store fewer frames
+    :param pooling: (str) how the frames of a clip are pooled into a single vector, "mean", "meanstd" or "max",
+                          if None, keep one row per frame
+    :param pca_dim: (int) number of principal components to project the (pooled) rows onto, fitted incrementally
+                          on the first pca_fit_rows rows, if None, keep every dimension
+    :param dtype: (str) dtype the reduced rows are stored as, "float32" or "float16"
+    :param keep_frames: (bool) when the embeddings are reduced, whether to also store the full frames
+                               (without reductions, the frames are always stored)
+    :param pca_fit_rows: (int) number of rows the principal components are fitted on
+    :param shard: (int) shard of the input files to process, from 0 to num_shards - 1 (see shard.py)
+    :param num_shards: (int) number of shards the input files are split into, if 1, process every file
     """
     # get all of the files in the input directory
     print("Loading list of files...")
     file_list = os.listdir(in_dir)
     print(f"There are {len(file_list)} files in the input directory.")
+    if num_shards > 1:
+        file_list = select_shard(file_list, shard, num_shards)
+        print(f"{len(file_list)} of them are in shard {shard} of {num_shards}.")
+
+    # only process wav files
+    file_list = [file for file in file_list if is_audio_file(file)]
 
     # create the output directory if it does not already exist
     print("Creating output directory, if it does not already exist...")
     os.makedirs(out_dir, exist_ok=True)
-    
-    # load the model
-    print("Loading pretrained model...")
-    model = openl3.models.load_audio_embedding_model(input_repr=INPUT_REPRESENTATION,
-                                                     content_type="music",
-                                                     embedding_size=EMBEDDING_SIZE)
-    print("Model loaded successfully.")
-    
-    # create lists of audio arrays and sample rate arrays
-    name_list = []
-    emb_list = []
-    ts_list = []
+
+    # create a store of embedding frames and their timestamps, and/or a store of reduced embeddings
+    # a shard writes to stores of its own, merged into the stores of all files afterwards (see shard.merge),
+    # and projects with the principal components of the merged store, if it has any
+    reductions = reduction_params(pooling, pca_dim, dtype)
+    store = reducer = None
+    stores = []
+    merged_path = os.path.join(out_dir, f"all_embeddings_{EMBEDDING_SIZE}")
+    store_path = shard_path(merged_path, shard, num_shards)
+    if keep_frames or not reductions:
+        store = FeatureStore(store_path, dim=EMBEDDING_SIZE, timestamps=True)
+        stores.append((store, merged_names(merged_path, num_shards)))
+    if reductions:
+        merged_path = os.path.join(out_dir, reduced_store_name(EMBEDDING_SIZE, pooling, pca_dim, dtype))
+        reducer = EmbeddingReducer(shard_path(merged_path, shard, num_shards), EMBEDDING_SIZE, pooling=pooling,
+                                   pca_dim=pca_dim, dtype=dtype, fit_rows=pca_fit_rows,
+                                   pca_path=os.path.join(merged_path, PCA_NAME))
+        stores.append((reducer, merged_names(merged_path, num_shards)))
+
+    # skip files that were already processed
+    manifest = shard_manifest(out_dir, shard, num_shards)
+    params = {"input_repr": INPUT_REPRESENTATION, "embedding_size": EMBEDDING_SIZE, "hop_size": hop_size}
+    if reductions:
+        params.update({**reductions, "keep_frames": keep_frames})
+    file_list = [file for file in file_list
+                 if force or any(embedding_name(file) not in s and embedding_name(file) not in merged
+                                 for s, merged in stores)
+                 or not manifest.is_done(file, os.path.join(in_dir, file), params)]
+    print(f"{len(file_list)} files need to be processed.")
+
+    paths = [os.path.join(in_dir, file) for file in file_list]
+    if server is not None:
+        # embedded by the model server
+        print(f"Sending files to the model server at {server}...")
+        client = ModelClient(server)
+    else:
+        # load the model
+        print("Loading pretrained model...")
+        model = load_embedding_model()
+        print("Model loaded successfully.")
+
+    if batch_size > 1:
+        # group clips of similar length into the same batch
+        print("Sorting files by length...")
+        paths.sort(key=audio_length)
+
+    run_profile = None
+    if profile:
+        run_profile = RunProfile(shard_path(os.path.join(out_dir, PROFILE_NAME), shard, num_shards),
+                                 "extract_embeddings",
+                                 {**params, "batch_size": batch_size, "frame_batch_size": frame_batch_size})
+
     print("Extracting emebddings for each audio file...")
-    for i in tqdm(range(len(file_list))):
-        # only process wav files
-        if file_list[i].endswith(".wav"):   
-            # read the soundfile
-            in_path = os.path.join(in_dir, file_list[i])
-            y, sr = sf.read(in_path)
-            
-            # set the output file name
-            s = file_list[i].split("_")
-            out_name = f"{s[0]}_{s[1]}_Emb_{EMBEDDING_SIZE}.npy"
-
-            # extract embedding
-            emb, ts = openl3.get_audio_embedding(y, sr, model=model)
-            
-            name_list.append(out_name)
-            emb_list.append(emb)
-            ts_list.append(ts)
-
-             # save individual embedding file
-            out_path = os.path.join(out_dir, out_name)
-            np.save(out_path, emb)
-    
-    print("Dumping all embeddings, timestamps, and file names as a single pickle file...")
-    # save all data as one object for easy loading
-    data_obj = (emb_list, ts_list, name_list)
-    out_path = os.path.join(out_dir, f"all_embeddings_{EMBEDDING_SIZE}.pkl")
-
-    # dump pickle file
-    with open(out_path, "wb") as f:
-        pickle.dump(data_obj, f)
-    print("Data dumped successfully!")
+    start = time.perf_counter()
+    if server is not None:
+        embeddings = client.iter_embed([os.path.abspath(path) for path in paths], batch_size=batch_size,
+                                       frame_batch_size=frame_batch_size, hop_size=hop_size)
+    else:
+        embeddings = iter_embeddings(paths, model=model, batch_size=batch_size, frame_batch_size=frame_batch_size,
+                                     hop_size=hop_size)
+
+    failed = []
+    reset()
+    for file, result, error in tqdm(embeddings, total=len(paths)):
+        if error is not None:
+            # a file that fails is reported and processed again by the next run, the rest go on
+            failed.append((file, error))
+            try:
+                manifest.record(file, os.path.join(in_dir, file), params, [], error=error)
+            except OSError:
+                # the file cannot even be hashed, it is processed again by the next run all the same
+                pass
+            if run_profile is not None:
+                run_profile.record(file, collect(), error)
+            reset()
+            continue
+        emb, ts = result
+
+        # set the output file name
+        out_name = embedding_name(file)
+
+        outputs = []
+        with phase("write"):
+            if reducer is not None:
+                reducer.append(out_name, emb, ts)
+                outputs.append(reducer.store.path)
+
+            if store is not None:
+                store.append(out_name, emb, ts)
+
+                # save individual embedding file
+                out_path = os.path.join(out_dir, out_name)
+                np.save(out_path, emb)
+                outputs.append(out_path)
+        manifest.record(file, os.path.join(in_dir, file), params, outputs)
 
+        # the timings of a file cover everything since the previous file was recorded
+        if run_profile is not None:
+            run_profile.record(file, collect())
+        reset()
+    elapsed = time.perf_counter() - start
+    num_embedded = len(file_list) - len(failed)
+    clips_per_sec = num_embedded / max(elapsed, 1e-9)
+    print(f"Embedded {num_embedded} clips in {elapsed:.1f} seconds ({clips_per_sec:.2f} clips/sec).")
+    if run_profile is not None:
+        run_profile.close()
+    if server is not None:
+        client.close()
+
+    if reducer is not None:
+        reducer.close()
+        print(f"Saved reduced embeddings of {len(reducer.store)} files to {reducer.store.path}.")
+    if store is not None:
+        store.close()
+        store.compact(STALE_FRACTION)
+        print(f"Saved embeddings of {len(store)} files to {store_path}.")
+
+    if write_pickle:
+        print("Dumping all embeddings, timestamps, and file names as a single pickle file...")
+        # save all data as one object for easy loading, the reduced embeddings if there are any,
+        # timestamps are None for pooled clips
+        out_store = store if reducer is None else reducer.store
+        name_list = out_store.names
+        emb_list = [np.array(out_store.get(name)) for name in name_list]
+        ts_list = [np.array(out_store.get_timestamps(name)) if out_store.timestamps else None for name in name_list]
+        data_obj = (emb_list, ts_list, name_list)
+        out_path = os.path.join(out_dir, f"{os.path.basename(out_store.path)}.pkl")
+
+        # dump pickle file
+        with open(out_path, "wb") as f:
+            pickle.dump(data_obj, f)
+        print("Data dumped successfully!")
+
+    report_failures(failed)
+    mark_done(out_dir, shard, num_shards)
     print("Processing complete!")
 
 
 if __name__ == '__main__':
     # run function
-    extract_embeddings(INPUT_DIR, OUTPUT_DIR)
-    
\ No newline at end of file
+    args = shard_args("Extract OpenL3 embeddings of the final vocal stems.")
+    extract_embeddings(INPUT_DIR, OUTPUT_DIR, batch_size=BATCH_SIZE, frame_batch_size=FRAME_BATCH_SIZE,
+                       shard=args.shard, num_shards=args.num_shards)
+
@@ -1,19 +1,15 @@
 import os
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
-import librosa
-from librosa.display import specshow
-import soundfile as sf
 import pickle
+import librosa
 from tqdm import tqdm
-from constants import HOP_LENGTH, N_FFT
-
-# use non-interactive backend to write to files
-matplotlib.use('Agg')
-
-# set hyperparameters
-NUM_MFCC = 13
+from audio_io import read_item, prefetch, is_audio_file, PREFETCH_DEPTH
+from constants import HOP_LENGTH, NUM_MFCC, MFCC_N_FFT, MEL_CACHE_DIR, MEL_CACHE_MAX_BYTES, AUDIO_DTYPE
+from shard import select_shard, shard_path, shard_manifest, shard_args, merged_names, mark_done
+from feature_store import FeatureStore, STALE_FRACTION
+from mel_cache import MelCache, mfcc_from_mel
+from plot_mfccs import plot_mfccs
+from profiling import phase, add_audio, reset, collect, RunProfile, PROFILE_NAME
 
 # set input and output directories
 INPUT_DIR = "/scratch/rn2214/data/final_stems_22050"
@@ -21,83 +17,208 @@ OUTPUT_DIR = "/scratch/rn2214/data/mfccs"
 PLOT_DIR = "/scratch/rn2214/plots/mfccs"
 
 
-def extract_mfccs(in_dir, out_dir, plot_dir):
+def mfcc_name(file):
+    """
+    Get the name of the MFCC vector file for a WAV file.
+
+    :param file: (str) name of the WAV file
+    :return: (str) name of the MFCC vector file
+    """
+    s = file.split("_")
+    return f"{s[0]}_{s[1]}_mfcc.npy"
+
+
+def summarize_mfccs(mfccs):
+    """
+    Collapse MFCCs across time into a single vector.
+
+    :param mfccs: (np.array) MFCCs, of shape (num_mfcc, num_frames)
+    :return: (np.array) means and standard deviations over time of the MFCCs,
+                        excluding the 0th coefficient, of length 2 * (num_mfcc - 1)
+    """
+    # collapse the arrays across time
+    # ignore the first coefficient
+    mfcc_mean = np.mean(mfccs[1:, :], axis=1)
+    mfcc_std = np.std(mfccs[1:, :], axis=1)
+    return np.hstack((mfcc_mean, mfcc_std))
+
+
+def iter_mfccs(items, mel_cache=None, n_mfcc=NUM_MFCC, hop_length=HOP_LENGTH, n_fft=MFCC_N_FFT,
+               prefetch_depth=PREFETCH_DEPTH):
+    """
+    Lazily compute the MFCC vector (see summarize_mfccs) of each item of a stream of audio.
+    The audio of the next prefetch_depth items is read on background threads (see audio_io.prefetch),
+    paths whose spectrograms come from the mel cache are read by the cache instead.
+
+    :param items: (iterable) paths of audio files and/or (name, audio array, sample rate) tuples,
+                             audio arrays are channels first and mixed down to mono if stereo
+    :param mel_cache: (MelCache) if given, cache to get the mel spectrograms of paths from
+    :param n_mfcc: (int) number of MFCCs to compute
+    :param hop_length: (int) number of samples between successive frames
+    :param n_fft: (int) length of the FFT window
+    :param prefetch_depth: (int) number of items read ahead
+    :return: (generator) (name, MFCC vector) pairs, in the order of the items,
+                         the name of a path is its file name
+    """
+    def cached(item):
+        return isinstance(item, str) and mel_cache is not None
+
+    def read_uncached(item):
+        return None if cached(item) else read_item(item)
+
+    for item, future in prefetch(items, read_uncached, depth=prefetch_depth):
+        if cached(item):
+            # the cache reads the file itself, if it is not already cached
+            name = os.path.basename(item)
+            M, sr = mel_cache.melspectrogram(item, hop_length=hop_length, n_fft=n_fft)
+        else:
+            # time spent waiting for the background read
+            with phase("read"):
+                name, y, sr = future.result()
+            if y.ndim > 1:
+                with phase("dsp"):
+                    y = librosa.to_mono(y)
+            with phase("features"):
+                M = librosa.feature.melspectrogram(y=y, sr=sr, hop_length=hop_length, n_fft=n_fft)
+
+        # duration of the audio, to within one hop
+        add_audio((M.shape[-1] - 1) * hop_length / sr)
+
+        with phase("features"):
+            mfcc_vec = summarize_mfccs(mfcc_from_mel(M, n_mfcc=n_mfcc))
+        yield name, mfcc_vec
+
+
+def extract_mfccs(in_dir, out_dir, plot_dir=None, force=False, write_pickle=True, cache_dir=None,
+                  plot_workers=1, profile=False, shard=None, num_shards=1):
     """
     Extract Mel-Frequency Cepstral Coefficients (MFCCs) from vocal stem WAV files.
-    Plot the MFCCs over time and save the plots.
+    If a plot directory is given, plot the MFCCs over time and save the plots once all
+    of the MFCCs are extracted (see plot_mfccs, which can also be run on its own).
+
+    The vectors of all files are appended to a FeatureStore in the output directory
+    as they are computed, and can be loaded together with FeatureStore(path).array().
+
+    The MFCCs are computed from power mel spectrograms kept in a MelCache, which is shared
+    with the other features and plots computed from the same files and parameters.
+
+    Files that were already processed with the same contents and parameters, according to
+    the manifest kept in the output directory, are not recomputed unless force is True.
 
     :param in_dir: (str) directory of WAV files to extract MFCCs from
     :param out_dir: (str) directory of where to save the extracted MFCCs
-    :param plot_dir: (str) directory of where to save the MFCC plots
+    :param plot_dir: (str) directory of where to save the MFCC plots, if None, do not plot
+    :param force: (bool) whether to reprocess files that were already processed
+    :param write_pickle: (bool) whether to also dump all vectors and file names as a single pickle file
+    :param cache_dir: (str) directory of the mel spectrogram cache (e.g. constants.MEL_CACHE_DIR), if None, no cache
+    :param plot_workers: (int) number of worker processes to render the plots with
+    :param profile: (bool) whether to append per-file phase timings and a summary of the run
+                           to the profile file in the output (and plot) directory (see profiling.RunProfile)
+    :param shard: (int) shard of the input files to process, from 0 to num_shards - 1 (see shard.py)
+    :param num_shards: (int) number of shards the input files are split into, if 1, process every file
     """
     # get all of the files in the input directory
     print("Loading list of files...")
     file_list = os.listdir(in_dir)
     print(f"There are {len(file_list)} files in the input directory.")
+    if num_shards > 1:
+        file_list = select_shard(file_list, shard, num_shards)
+        print(f"{len(file_list)} of them are in shard {shard} of {num_shards}.")
 
     # create the output directory if it does not already exist
     print("Creating output directory, if it does not already exist...")
     os.makedirs(out_dir, exist_ok=True)
-    os.makedirs(plot_dir, exist_ok=True)
-    
-    # create lists of MFCC arrays
+
+    # load the record of files that were already processed
+    manifest = shard_manifest(out_dir, shard, num_shards)
+    params = {"num_mfcc": NUM_MFCC, "hop_length": HOP_LENGTH, "n_fft": MFCC_N_FFT, "dtype": AUDIO_DTYPE}
+
+    # spectrograms shared with the other features and plots
+    mel_cache = MelCache(cache_dir, max_bytes=MEL_CACHE_MAX_BYTES) if cache_dir is not None else None
+
+    # create a store of MFCC arrays
     # each array consists of the stack means and standard deviations of the
     # MFCCs (excluding the 0th coefficient) averaged over time
     # as an example, for n_mfccs=13, the dimensions of the array would be 24 x 1
-    name_list = []
-    mfcc_list = []
-    print("Extracting MFCCs for each audio file...")
-    for i in tqdm(range(len(file_list))):
+    # a shard writes to a store of its own, merged into the store of all files afterwards (see shard.merge)
+    merged_path = os.path.join(out_dir, f"all_mfccs_{NUM_MFCC}")
+    store_path = shard_path(merged_path, shard, num_shards)
+    store = FeatureStore(store_path, dim=2 * (NUM_MFCC - 1))
+    merged = merged_names(merged_path, num_shards)
+
+    # files that still need to be processed
+    todo = []
+    for file in file_list:
         # only process wav files
-        if file_list[i].endswith(".wav"):   
-            # read the soundfile
-            in_path = os.path.join(in_dir, file_list[i])
-            y, sr = sf.read(in_path)
-            
-            # set the output file name
-            s = file_list[i].split("_")
-            out_name = f"{s[0]}_{s[1]}_mfcc.npy"
-            plot_name = f"{s[0]}_{s[1]}_mfcc.png"
-
-            # extract MFCCs
-            mfccs = librosa.feature.mfcc(y=y, sr=sr, hop_length=HOP_LENGTH, n_mfcc=NUM_MFCC)
-            
-            # collapse the arrays across time
-            # ignore the first coefficient
-            mfcc_mean = np.mean(mfccs[1:, :], axis=1)
-            mfcc_std = np.std(mfccs[1:, :], axis=1)
-            mfcc_vec = np.hstack((mfcc_mean, mfcc_std))
-            
-            name_list.append(out_name)
-            mfcc_list.append(mfcc_vec)
-
-             # save individual vector file
-            out_path = os.path.join(out_dir, out_name)
+        if is_audio_file(file):
+            in_path = os.path.join(in_dir, file)
+
+            # skip files that were already processed
+            stored = mfcc_name(file) in store or mfcc_name(file) in merged
+            if not force and stored and manifest.is_done(file, in_path, params):
+                continue
+            todo.append(file)
+    print(f"{len(todo)} files need to be processed.")
+
+    print("Extracting MFCCs for each audio file...")
+    # extract MFCCs from the (cached) mel spectrograms
+    run_profile = None
+    if profile:
+        run_profile = RunProfile(shard_path(os.path.join(out_dir, PROFILE_NAME), shard, num_shards),
+                                 "extract_mfccs", params)
+
+    paths = [os.path.join(in_dir, file) for file in todo]
+    reset()
+    for file, mfcc_vec in tqdm(iter_mfccs(paths, mel_cache=mel_cache), total=len(paths)):
+        # set the output file name
+        out_name = mfcc_name(file)
+        out_path = os.path.join(out_dir, out_name)
+
+        with phase("write"):
+            store.append(out_name, mfcc_vec)
+
+            # save individual vector file
             np.save(out_path, mfcc_vec)
 
-            # plot the mfccs
-            fig, ax = plt.subplots()
-            img = specshow(mfccs, x_axis='time', hop_length=HOP_LENGTH, ax=ax)
-            fig.colorbar(img, ax=ax)
-            ax.set(title=f'MFCCs\n{s[0]} {s[1]}')
-            plot_out_path = os.path.join(plot_dir, plot_name)
-            plt.savefig(plot_out_path)
-            plt.close()
-    
-    print("Dumping all vectors and file names as a single pickle file...")
-    # save all data as one object for easy loading
-    data_obj = (mfcc_list, name_list)
-    out_path = os.path.join(out_dir, f"all_mfccs.pkl")
-
-    # dump pickle file
-    with open(out_path, "wb") as f:
-        pickle.dump(data_obj, f)
-    print("Data dumped successfully!")
+        manifest.record(file, os.path.join(in_dir, file), params, [out_path])
+
+        # the timings of a file cover everything since the previous file was recorded
+        if run_profile is not None:
+            run_profile.record(file, collect())
+        reset()
+
+    if run_profile is not None:
+        run_profile.close()
+
+    store.close()
+    store.compact(STALE_FRACTION)
+    print(f"Saved vectors of {len(store)} files to {store_path}.")
+
+    if write_pickle:
+        print("Dumping all vectors and file names as a single pickle file...")
+        # save all data as one object for easy loading
+        name_list = store.names
+        mfcc_list = [np.array(store.get(name)[0]) for name in name_list]
+        data_obj = (mfcc_list, name_list)
+        out_path = shard_path(os.path.join(out_dir, f"all_mfccs.pkl"), shard, num_shards)
+
+        # dump pickle file
+        with open(out_path, "wb") as f:
+            pickle.dump(data_obj, f)
+        print("Data dumped successfully!")
+
+    if plot_dir is not None:
+        # render the plots as a separate stage, from the cached spectrograms
+        plot_mfccs(in_dir, plot_dir, workers=plot_workers, force=force, cache_dir=cache_dir, profile=profile,
+                   shard=shard, num_shards=num_shards)
 
+    mark_done(out_dir, shard, num_shards)
     print("Processing complete!")
 
 
 if __name__ == '__main__':
     # run function
-    extract_mfccs(INPUT_DIR, OUTPUT_DIR, PLOT_DIR)
+    args = shard_args("Extract the MFCCs of the final vocal stems.")
+    extract_mfccs(INPUT_DIR, OUTPUT_DIR, PLOT_DIR, plot_workers=len(os.sched_getaffinity(0)),
+                  cache_dir=MEL_CACHE_DIR, shard=args.shard, num_shards=args.num_shards)
     
\ No newline at end of file
@@ -0,0 +1,333 @@
+import os
+import json
+import numpy as np
+
+
+# name of the data file for each dtype the rows can be stored as
+DATA_FILES = {"float32": "data.f32", "float16": "data.f16"}
+
+# compaction (see FeatureStore.compact): extension of the compacted files while they are written,
+# name of the file that commits them, fraction of stale rows above which the stages compact their stores,
+# and number of rows copied at a time
+COMPACT_EXT = ".compact"
+COMPACT_MARKER = "compact.commit"
+STALE_FRACTION = 0.1
+COMPACT_ROWS = 1 << 16
+
+
+def stored_names(path):
+    """
+    Get the names of the items committed to a store without opening it (opening a store truncates anything
+    written after its last committed item), e.g. to check a store that another process may be appending to.
+
+    :param path: (str) directory of the store
+    :return: (set) names of the items in the store, empty if there is no store at path
+    """
+    names_path = os.path.join(path, "names.txt")
+    if not os.path.exists(names_path):
+        return set()
+    with open(names_path, "r") as f:
+        text = f.read()
+    # names are committed by their newline
+    return set(text.split("\n")[:-1])
+
+
+class FeatureStore:
+    """
+    Append-only on-disk store of float32 (or float16) feature arrays that can be read without copying using np.memmap.
+
+    Each item is a name and a (num_rows, dim) array, e.g. a single MFCC vector (one row) or a sequence
+    of OpenL3 embedding frames (one row per frame). The store is a directory with the files:
+        data.f32:       rows of all of the items, as one contiguous float32 array of shape (total_rows, dim)
+                        (data.f16 for a float16 store, half the size)
+        timestamps.f32: (optional) one float32 timestamp per row, for frame sequences
+        offsets.i64:    end row (exclusive) of each item, item i covers rows offsets[i - 1] to offsets[i]
+        names.txt:      name of each item, one per line
+        meta.json:      width and dtype of the rows, whether timestamps are stored, and any attributes
+                        the store was created with (e.g. how the rows were computed)
+
+    Items are committed by writing their name last, so if a run is interrupted,
+    anything written after the last complete name is dropped when the store is reopened.
+    If a name is appended more than once (e.g. by a run with force=True), the last item with that name
+    is the one returned, and the rows of the earlier ones stay in the files until the store is compacted
+    (see compact, which the stages run when they close their stores).
+    """
+
+    def __init__(self, path, dim=None, timestamps=False, dtype=None, attrs=None):
+        """
+        :param path: (str) directory of the store, created if it does not already exist
+        :param dim: (int) width of the rows, required when creating a new store
+        :param timestamps: (bool) when creating a new store, whether to store a timestamp per row
+        :param dtype: (str) dtype of the rows, "float32" or "float16", if None, float32 for a new store
+        :param attrs: (dict) when creating a new store, JSON serializable attributes to keep with it
+        """
+        self.path = path
+        self._files = None
+        self._array = None
+        meta_path = os.path.join(path, "meta.json")
+
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            if dim is not None and dim != meta["dim"]:
+                raise ValueError(f"The store at {path} has rows of width {meta['dim']}, not {dim}!")
+            # stores written before the dtype was configurable are float32
+            if dtype is not None and dtype != meta.get("dtype", "float32"):
+                raise ValueError(f"The store at {path} has {meta.get('dtype', 'float32')} rows, not {dtype}!")
+            self.dim = meta["dim"]
+            self.timestamps = meta["timestamps"]
+            self.dtype = meta.get("dtype", "float32")
+            self.attrs = meta.get("attrs", {})
+        else:
+            if dim is None:
+                raise ValueError("The width of the rows is required to create a new store!")
+            if dtype is None:
+                dtype = "float32"
+            if dtype not in DATA_FILES:
+                raise ValueError(f"Unknown dtype {dtype}!")
+            os.makedirs(path, exist_ok=True)
+            self.dim = dim
+            self.timestamps = timestamps
+            self.dtype = dtype
+            self.attrs = dict(attrs or {})
+            with open(meta_path, "w") as f:
+                json.dump({"dim": dim, "timestamps": timestamps, "dtype": dtype, "attrs": self.attrs}, f)
+
+        self._data = DATA_FILES[self.dtype]
+
+        self._recover()
+
+    def _path(self, name):
+        return os.path.join(self.path, name)
+
+    def _recover(self):
+        """
+        Drop anything written after the last committed item and build the name index.
+        """
+        self._finish_compaction()
+
+        # committed names are the complete lines of the names file
+        names = []
+        if os.path.exists(self._path("names.txt")):
+            with open(self._path("names.txt"), "r") as f:
+                text = f.read()
+            names = text.split("\n")[:-1]
+
+        # offsets are written before names, so there are at least as many offsets as names
+        offsets = np.zeros(0, dtype=np.int64)
+        if os.path.exists(self._path("offsets.i64")):
+            offsets = np.fromfile(self._path("offsets.i64"), dtype=np.int64)
+        num_items = min(len(names), len(offsets))
+        names = names[:num_items]
+        offsets = offsets[:num_items]
+        num_rows = int(offsets[-1]) if num_items else 0
+
+        # truncate each file to the committed items
+        with open(self._path("names.txt"), "w") as f:
+            f.write("".join(name + "\n" for name in names))
+        self._truncate("offsets.i64", num_items * 8)
+        self._truncate(self._data, num_rows * self.dim * np.dtype(self.dtype).itemsize)
+        if self.timestamps:
+            self._truncate("timestamps.f32", num_rows * 4)
+
+        self._names = names
+        self._offsets = list(offsets)
+        self._index = {name: i for i, name in enumerate(names)}
+
+    def _store_files(self):
+        return [self._data] + (["timestamps.f32"] if self.timestamps else []) + ["offsets.i64", "names.txt"]
+
+    def _finish_compaction(self):
+        """
+        Swap in the files of a compaction that was interrupted after it was committed, or drop them if it was not.
+        """
+        committed = os.path.exists(self._path(COMPACT_MARKER))
+        # the names last, as when appending
+        for file in self._store_files():
+            if os.path.exists(self._path(file + COMPACT_EXT)):
+                if committed:
+                    os.replace(self._path(file + COMPACT_EXT), self._path(file))
+                else:
+                    os.remove(self._path(file + COMPACT_EXT))
+        if committed:
+            os.remove(self._path(COMPACT_MARKER))
+
+    def stale_rows(self):
+        """
+        :return: (int) number of rows of items that were appended again under the same name
+        """
+        num_rows = int(self._offsets[-1]) if self._offsets else 0
+        if len(self._names) == len(self._index):
+            return 0
+        _, offsets = self.item_offsets()
+        return num_rows - int((offsets[:, 1] - offsets[:, 0]).sum())
+
+    def compact(self, stale_fraction=0.0):
+        """
+        Rewrite the store without the rows of items that were appended again under the same name,
+        keeping the last item of each name, in the order they were (last) appended.
+
+        The compacted files are written next to the old ones and swapped in once they are complete,
+        so if the compaction is interrupted, it is finished (or dropped) when the store is reopened.
+        Like opening a store, it must not run while another process appends to the store.
+
+        :param stale_fraction: (float) only compact if more than this fraction of the rows are stale
+        :return: (int) number of rows removed
+        """
+        stale = self.stale_rows()
+        num_rows = int(self._offsets[-1]) if self._offsets else 0
+        if stale == 0 or stale <= stale_fraction * num_rows:
+            return 0
+        self.close()
+
+        # rows of the items to keep
+        names, offsets = self.item_offsets()
+        lengths = offsets[:, 1] - offsets[:, 0]
+        rows = np.repeat(offsets[:, 0] - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths) \
+            + np.arange(lengths.sum())
+        arrays = {self._data: self.array()}
+        if self.timestamps:
+            arrays["timestamps.f32"] = self._memmap("timestamps.f32", 1)
+
+        for file, x in arrays.items():
+            with open(self._path(file + COMPACT_EXT), "wb") as f:
+                for start in range(0, len(rows), COMPACT_ROWS):
+                    f.write(np.ascontiguousarray(x[rows[start:start + COMPACT_ROWS]]).tobytes())
+        with open(self._path("offsets.i64" + COMPACT_EXT), "wb") as f:
+            f.write(np.cumsum(lengths).astype(np.int64).tobytes())
+        with open(self._path("names.txt" + COMPACT_EXT), "w") as f:
+            f.write("".join(name + "\n" for name in names))
+
+        # commit the compaction, then swap the files in
+        with open(self._path(COMPACT_MARKER), "w"):
+            pass
+        del arrays
+        self._array = None
+        self._recover()
+        return stale
+
+    def _truncate(self, name, size):
+        with open(self._path(name), "ab") as f:
+            f.truncate(size)
+
+    def append(self, name, x, ts=None):
+        """
+        Append an item to the store.
+
+        :param name: (str) name of the item, cannot contain a newline
+        :param x: (np.array) feature vector of length dim, or array of shape (num_rows, dim)
+        :param ts: (np.array) if the store has timestamps, one timestamp per row
+        """
+        if "\n" in name:
+            raise ValueError("Item names cannot contain a newline!")
+        x = np.ascontiguousarray(x, dtype=self.dtype).reshape(-1, self.dim)
+        if self.timestamps:
+            ts = np.ascontiguousarray(ts, dtype=np.float32).reshape(-1)
+            if len(ts) != len(x):
+                raise ValueError("There must be one timestamp per row!")
+
+        if self._files is None:
+            # keep the files open for appending until the store is closed
+            self._files = {file: open(self._path(file), "ab")
+                           for file in [self._data, "timestamps.f32", "offsets.i64", "names.txt"]
+                           if file != "timestamps.f32" or self.timestamps}
+
+        end = (self._offsets[-1] if self._offsets else 0) + len(x)
+
+        # write the name last, it commits the item
+        self._files[self._data].write(x.tobytes())
+        if self.timestamps:
+            self._files["timestamps.f32"].write(ts.tobytes())
+        self._files["offsets.i64"].write(np.int64(end).tobytes())
+        for f in self._files.values():
+            f.flush()
+        self._files["names.txt"].write((name + "\n").encode())
+        self._files["names.txt"].flush()
+
+        self._index[name] = len(self._names)
+        self._names.append(name)
+        self._offsets.append(end)
+        self._array = None
+
+    def close(self):
+        """
+        Close the files opened for appending.
+        """
+        if self._files is not None:
+            for f in self._files.values():
+                f.close()
+            self._files = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    @property
+    def names(self):
+        """
+        :return: (list) names of the items in the store, in the order they were (last) appended
+        """
+        return sorted(self._index, key=self._index.get)
+
+    def _memmap(self, name, width, dtype="float32"):
+        num_rows = int(self._offsets[-1]) if self._offsets else 0
+        if num_rows == 0:
+            # an empty file cannot be memory-mapped
+            return np.zeros((0, width), dtype=dtype)
+        return np.memmap(self._path(name), dtype=dtype, mode="r", shape=(num_rows, width))
+
+    def array(self):
+        """
+        :return: (np.memmap) all rows of the store, of shape (total_rows, dim), in the dtype of the store
+        """
+        # reuse the memory map until more rows are appended
+        if self._array is None:
+            self._array = self._memmap(self._data, self.dim, self.dtype)
+        return self._array
+
+    def offsets(self):
+        """
+        :return: (np.array) start and end row of every appended item, of shape (num_appended, 2)
+        """
+        ends = np.asarray(self._offsets, dtype=np.int64)
+        starts = np.concatenate(([0], ends)).astype(np.int64)[:-1]
+        return np.stack((starts, ends), axis=1)
+
+    def item_offsets(self):
+        """
+        :return: (list, np.array) names of the items in the store, in the order they were (last) appended,
+                                  and their start and end row, of shape (num_items, 2)
+        """
+        names = self.names
+        return names, self.offsets()[[self._index[name] for name in names]].reshape(-1, 2)
+
+    def _rows(self, name):
+        i = self._index[name]
+        start = int(self._offsets[i - 1]) if i > 0 else 0
+        return start, int(self._offsets[i])
+
+    def get(self, name):
+        """
+        :param name: (str) name of the item
+        :return: (np.memmap) rows of the item, of shape (num_rows, dim)
+        """
+        start, end = self._rows(name)
+        return self.array()[start:end]
+
+    def get_timestamps(self, name):
+        """
+        :param name: (str) name of the item
+        :return: (np.memmap) timestamps of the rows of the item
+        """
+        if not self.timestamps:
+            raise ValueError("This store does not have timestamps!")
+        start, end = self._rows(name)
+        return self._memmap("timestamps.f32", 1)[start:end, 0]
@@ -0,0 +1,120 @@
+import os
+import json
+import hashlib
+
+
+# name of the manifest file kept in each output directory
+MANIFEST_NAME = "manifest.jsonl"
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    Compute the SHA-1 hash of the contents of a file.
+
+    :param path: (str) path of the file to hash
+    :param chunk_size: (int) number of bytes to read at a time
+    :return: (str) hex digest of the file contents
+    """
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """
+    Record of the files a stage has already processed.
+
+    Each line of the manifest file is a JSON object with the name of an input file, the hash of its
+    contents, the parameters it was processed with, and the paths of the outputs it produced.
+    Records are appended as soon as each file is done, so an interrupted run can be picked up where
+    it stopped. If a file appears more than once, the last record wins.
+    """
+
+    def __init__(self, path, base_path=None):
+        """
+        :param path: (str) path of the manifest file, created if it does not already exist
+        :param base_path: (str) if given, path of a manifest whose records are read before the records of path,
+                                but never written to, e.g. the merged manifest of a sharded stage (see shard.py)
+        """
+        self.path = path
+        self.entries = {}
+
+        for read_path in [base_path, path]:
+            if read_path is not None and os.path.exists(read_path):
+                with open(read_path, "r") as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            # the last line may be incomplete if the previous run was interrupted
+                            continue
+                        self.entries[entry["name"]] = entry
+
+    def _input_hash(self, name, in_path):
+        """
+        Get the hash of an input file, reusing the recorded hash if the file size and modification
+        time have not changed since it was recorded.
+
+        :param name: (str) name of the input file
+        :param in_path: (str) path of the input file
+        :return: (str) hex digest of the file contents
+        """
+        stat = os.stat(in_path)
+        entry = self.entries.get(name)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            return entry["hash"]
+        return file_hash(in_path)
+
+    def is_done(self, name, in_path, params):
+        """
+        Check whether an input file has already been processed with the same contents and parameters,
+        and all of its outputs still exist.
+
+        :param name: (str) name of the input file
+        :param in_path: (str) path of the input file
+        :param params: (dict) parameters the file would be processed with
+        :return: (bool) True if the file can be skipped
+        """
+        entry = self.entries.get(name)
+        if entry is None or "error" in entry:
+            return False
+
+        # compare parameters as they would be stored (tuples become lists in JSON)
+        if entry["params"] != json.loads(json.dumps(params)):
+            return False
+
+        if not all(os.path.exists(p) for p in entry["outputs"]):
+            return False
+
+        return entry["hash"] == self._input_hash(name, in_path)
+
+    def record(self, name, in_path, params, outputs, error=None):
+        """
+        Record that an input file has been processed, or that it failed to process.
+
+        :param name: (str) name of the input file
+        :param in_path: (str) path of the input file
+        :param params: (dict) parameters the file was processed with
+        :param outputs: (list) paths of the outputs produced for the file
+        :param error: (str) if given, error message of the file, which is then not done and processed again by the next run
+        """
+        stat = os.stat(in_path)
+        entry = {
+            "name": name,
+            "hash": self._input_hash(name, in_path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "params": params,
+            "outputs": list(outputs),
+        }
+        if error is not None:
+            entry["error"] = error
+        # round trip through JSON so the entry matches what is read back from disk
+        entry = json.loads(json.dumps(entry))
+        self.entries[name] = entry
+
+        # append and flush right away so the record survives a crash
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
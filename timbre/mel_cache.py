@@ -0,0 +1,160 @@
+import os
+import json
+import hashlib
+import numpy as np
+import librosa
+import soundfile as sf
+from constants import AUDIO_DTYPE
+from audio_io import read_audio
+from profiling import phase
+
+
+class MelCache:
+    """
+    On-disk cache of power mel spectrograms, so that the STFT and mel projection of a file are
+    computed once and shared by every feature or plot derived from them (MFCCs, dB spectrograms, ...).
+
+    Entries are keyed by the path, size and modification time of the audio file (so that a lookup
+    does not read the file) and the spectrogram parameters.
+    When the cache grows past max_bytes, the least recently used entries are removed.
+
+    Several processes can share a cache directory (e.g. the shards of a stage, see shard.py).
+    An entry another process removes while it is being read is computed again. Each process only
+    counts the entries it has seen, so with a shared cache max_bytes is approximate.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        """
+        :param cache_dir: (str) directory of the cache, created if it does not already exist
+        :param max_bytes: (int) maximum total size of the cached spectrograms, if None, no limit
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # size and last use of each entry, to evict without rescanning the directory
+        self._entries = {}
+        for file in os.listdir(cache_dir):
+            if file.endswith(".npy"):
+                stat = os.stat(os.path.join(cache_dir, file))
+                self._entries[file] = (stat.st_mtime, stat.st_size)
+
+    def _key(self, in_path, params):
+        stat = os.stat(in_path)
+        h = hashlib.sha1()
+        h.update(json.dumps([os.path.realpath(in_path), stat.st_size, stat.st_mtime_ns]).encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+        return h.hexdigest() + ".npy"
+
+    def melspectrogram(self, in_path, hop_length, n_fft, n_mels=128):
+        """
+        Get the power mel spectrogram of an audio file, computing it only if it is not already cached.
+        Stereo files are mixed down to mono first, as in extract_mfccs.iter_mfccs.
+
+        :param in_path: (str) path of the audio file
+        :param hop_length: (int) number of samples between successive frames
+        :param n_fft: (int) length of the FFT window
+        :param n_mels: (int) number of mel bands
+        :return: (tuple) power mel spectrogram, sample rate of the audio file
+        """
+        sr = sf.info(in_path).samplerate
+        # stereo files are mixed down to mono, which entries written before they were are not
+        params = {"sr": sr, "hop_length": hop_length, "n_fft": n_fft, "n_mels": n_mels, "dtype": AUDIO_DTYPE,
+                  "mono": True}
+        key = self._key(in_path, params)
+        path = os.path.join(self.cache_dir, key)
+
+        try:
+            # mark the entry as recently used
+            os.utime(path)
+            stat = os.stat(path)
+            with phase("read"):
+                M = np.load(path)
+        except OSError:
+            # not cached, or removed by another process sharing the cache
+            self._entries.pop(key, None)
+        else:
+            self._entries[key] = (stat.st_mtime, stat.st_size)
+            return M, sr
+
+        # compute the spectrogram
+        M, sr = compute_melspectrogram(in_path, hop_length, n_fft, n_mels=n_mels)
+
+        # write to a temporary file first so that readers never see a partial entry
+        tmp_path = path + f".{os.getpid()}.tmp"
+        with phase("write"):
+            with open(tmp_path, "wb") as f:
+                np.save(f, M)
+            os.replace(tmp_path, path)
+        stat = os.stat(path)
+        self._entries[key] = (stat.st_mtime, stat.st_size)
+        self._evict()
+
+        return M, sr
+
+    def _evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes.
+        """
+        if self.max_bytes is None:
+            return
+        total = sum(size for _, size in self._entries.values())
+        if total <= self.max_bytes:
+            return
+        for key in sorted(self._entries, key=lambda k: self._entries[k][0]):
+            if total <= self.max_bytes:
+                break
+            total -= self._entries.pop(key)[1]
+            try:
+                os.remove(os.path.join(self.cache_dir, key))
+            except FileNotFoundError:
+                # already removed by another process
+                pass
+
+
+def compute_melspectrogram(in_path, hop_length, n_fft, n_mels=128):
+    """
+    Compute the power mel spectrogram of an audio file, mixed down to mono if stereo.
+
+    :param in_path: (str) path of the audio file
+    :param hop_length: (int) number of samples between successive frames
+    :param n_fft: (int) length of the FFT window
+    :param n_mels: (int) number of mel bands
+    :return: (tuple) power mel spectrogram, sample rate of the audio file
+    """
+    with phase("read"):
+        y, sr = read_audio(in_path)
+    if y.ndim > 1:
+        with phase("dsp"):
+            y = librosa.to_mono(y)
+    with phase("features"):
+        M = librosa.feature.melspectrogram(y=y, sr=sr, hop_length=hop_length, n_fft=n_fft, n_mels=n_mels)
+    return M, sr
+
+
+def melspectrogram(in_path, hop_length, n_fft, n_mels=128, mel_cache=None):
+    """
+    Get the power mel spectrogram of an audio file, from a cache if given one.
+
+    :param in_path: (str) path of the audio file
+    :param hop_length: (int) number of samples between successive frames
+    :param n_fft: (int) length of the FFT window
+    :param n_mels: (int) number of mel bands
+    :param mel_cache: (MelCache) if given, cache to get the spectrogram from, otherwise it is computed
+    :return: (tuple) power mel spectrogram, sample rate of the audio file
+    """
+    if mel_cache is not None:
+        return mel_cache.melspectrogram(in_path, hop_length=hop_length, n_fft=n_fft, n_mels=n_mels)
+    return compute_melspectrogram(in_path, hop_length, n_fft, n_mels=n_mels)
+
+
+def mfcc_from_mel(M, n_mfcc=20):
+    """
+    Compute MFCCs from a power mel spectrogram.
+    Gives the same result as librosa.feature.mfcc on the audio the spectrogram was computed from.
+
+    :param M: (np.array) power mel spectrogram
+    :param n_mfcc: (int) number of MFCCs to return
+    :return: (np.array) MFCCs
+    """
+    return librosa.feature.mfcc(S=librosa.power_to_db(M), n_mfcc=n_mfcc)
@@ -0,0 +1,152 @@
+import os
+import traceback
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+from models import get_separation_model, server_address, authkey_path
+import separate
+from constants import AUDIO_SUBTYPE
+from extract_embeddings import iter_embeddings, load_embedding_model
+
+
+# models to load when the server starts, the others are loaded by the first job that needs them
+PRELOAD = ["separate", "embed"]
+
+
+def handle(job, model_name='htdemucs', device=None):
+    """
+    Run a job with the models loaded by the server.
+
+    :param job: (dict) job sent by a ModelClient, with the name of the job ("op") and its arguments
+    :param model_name: (str) name of the pretrained demucs model to separate with, or path of a saved model
+    :param device: (int or str) device to run the separation model on, if None use the cpu
+    :return: result of the job
+    """
+    op = job["op"]
+    if op == "ping":
+        return "pong"
+
+    if op == "info":
+        return {"model_name": model_name}
+
+    if op == "separate":
+        # reuse the worker of the separate stage, with the model kept loaded by the server
+        separate._worker_model = get_separation_model(model_name)
+        separate._worker_device = device
+        return separate.separate_job(job["in_path"], job["out_path"], stream=job.get("stream", False),
+                                     segment_dur=job.get("segment_dur", separate.SEGMENT_DUR),
+                                     overlap_dur=job.get("overlap_dur", separate.OVERLAP_DUR),
+                                     shifts=job.get("shifts", 1), subtype=job.get("subtype", AUDIO_SUBTYPE))
+
+    if op == "embed":
+        kwargs = {key: job[key] for key in ["batch_size", "frame_batch_size", "hop_size"] if key in job}
+        return list(iter_embeddings(job["items"], model=load_embedding_model(), **kwargs))
+
+    raise ValueError(f"Unknown job {op}!")
+
+
+def remove_own(path):
+    """
+    Remove a file left by a server that did not shut down cleanly, if it belongs to the current user.
+
+    :param path: (str) path of the file
+    """
+    if not os.path.lexists(path):
+        return
+    if os.lstat(path).st_uid != os.getuid():
+        raise PermissionError(f"{path} belongs to another user, refusing to remove it!")
+    os.remove(path)
+
+
+def write_authkey(address, num_bytes=32):
+    """
+    Generate a random key for a server and write it to a file that only the current user can read,
+    where the clients of the user find it (see models.read_authkey).
+
+    :param address: (str or tuple) address of the server
+    :param num_bytes: (int) length of the key
+    :return: (bytes) key
+    """
+    path = authkey_path(address)
+    remove_own(path)
+    authkey = os.urandom(num_bytes)
+    # created exclusively, so that a file someone else planted in between is not written to
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(authkey)
+    return authkey
+
+
+def serve(address=None, model_name='htdemucs', gpu=False, num_threads=None,
+          preload=PRELOAD):
+    """
+    Run a model server: load the models once and keep them warm while running jobs sent by
+    ModelClient connections (see models.py), e.g. from separate(..., server=address) or
+    extract_embeddings(..., server=address).
+
+    Jobs are run one at a time, in the order they arrive. A client keeps its connection for
+    as many jobs as it likes, and other clients wait until it closes. A failing job does not
+    stop the server, its error message is sent back to the client instead.
+    The server stops when a client sends a "shutdown" job.
+
+    Clients have to know a random key that the server generates when it starts and writes to a file
+    that only the current user can read, next to the socket (see models.authkey_path).
+
+    :param address: (str or tuple) address to listen on, path of a unix socket or (host, port),
+                                   if None, a socket in the runtime directory of the current user (see models.runtime_dir)
+    :param model_name: (str) name of the pretrained demucs model to separate with, or path of a saved model
+    :param gpu: (bool) whether to run the separation model on the current gpu device
+    :param num_threads: (int) number of threads torch may use, if None, keep the torch default
+    :param preload: (list) models to load when the server starts ("separate" and/or "embed")
+    """
+    import torch
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    device = torch.cuda.current_device() if gpu else None
+
+    print("Loading pretrained models...")
+    if "separate" in preload:
+        get_separation_model(model_name)
+    if "embed" in preload:
+        load_embedding_model()
+    print("Models loaded successfully.")
+
+    # remove the socket of a server that did not shut down cleanly
+    address = server_address(address)
+    if isinstance(address, str):
+        remove_own(address)
+    authkey = write_authkey(address)
+
+    try:
+        with Listener(address, authkey=authkey) as listener:
+            print(f"Model server listening on {address}.")
+            while True:
+                try:
+                    conn = listener.accept()
+                except AuthenticationError:
+                    print("Refused a connection that did not know the key.")
+                    continue
+
+                with conn:
+                    while True:
+                        try:
+                            job = conn.recv()
+                        except EOFError:
+                            # the client closed the connection
+                            break
+
+                        if job["op"] == "shutdown":
+                            conn.send((None, None))
+                            print("Model server shutting down.")
+                            return
+
+                        try:
+                            conn.send((handle(job, model_name=model_name, device=device), None))
+                        except Exception:
+                            conn.send((None, traceback.format_exc()))
+    finally:
+        remove_own(authkey_path(address))
+
+
+if __name__ == '__main__':
+    # run function
+    serve(gpu=False, num_threads=len(os.sched_getaffinity(0)))
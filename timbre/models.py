@@ -0,0 +1,196 @@
+import os
+import stat
+import tempfile
+import functools
+from multiprocessing.connection import Client
+
+
+# the model server (see model_server.py) listens on a unix socket by default, so it is only reachable
+# from the same node, in a runtime directory that only the current user can access
+SERVER_SOCKET_NAME = "model_server.sock"
+# the server generates a random key when it starts and writes it next to its socket, readable only by
+# the current user, the clients read it from there to authenticate (and to authenticate the server)
+SERVER_KEY_EXT = ".key"
+
+
+def check_private(path):
+    """
+    Check that a file or directory belongs to the current user and that no one else can access it.
+
+    :param path: (str) path of the file or directory
+    """
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(f"{path} has to belong to the current user and be accessible only by them!")
+
+
+def runtime_dir():
+    """
+    Get the runtime directory of the current user, $XDG_RUNTIME_DIR/timbre or /tmp/timbre-<uid>,
+    created (accessible only by the user) if it does not already exist.
+
+    :return: (str) path of the directory
+    """
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    path = os.path.join(base, "timbre") if base else os.path.join(tempfile.gettempdir(), f"timbre-{os.getuid()}")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    check_private(path)
+    return path
+
+
+def server_address(address=None):
+    """
+    :param address: (str or tuple) address of a model server, path of a unix socket or (host, port)
+    :return: (str or tuple) the address, or if None, the socket in the runtime directory of the current user
+    """
+    if address is None:
+        return os.path.join(runtime_dir(), SERVER_SOCKET_NAME)
+    return address
+
+
+def authkey_path(address):
+    """
+    :param address: (str or tuple) address of a model server, path of a unix socket or (host, port)
+    :return: (str) path of the file the server writes its key to
+    """
+    if isinstance(address, str):
+        return address + SERVER_KEY_EXT
+    host, port = address
+    return os.path.join(runtime_dir(), f"model_server_{host}_{port}{SERVER_KEY_EXT}")
+
+
+def read_authkey(address):
+    """
+    Read the key of a model server, after checking that no one else could have written (or read) it.
+
+    :param address: (str or tuple) address of the model server
+    :return: (bytes) key of the server
+    """
+    path = authkey_path(address)
+    check_private(path)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# torch, demucs and openl3 (tensorflow) take seconds to import, so they are only imported
+# by the functions that need them, and every model is loaded at most once per process
+
+@functools.lru_cache(maxsize=None)
+def get_separation_model(model_name='htdemucs'):
+    """
+    Load a separation model, or get it from the models already loaded by the current process.
+
+    :param model_name: (str) name of a pretrained demucs model,
+                             or path of a model saved with torch.save (e.g. the stand-in model of the benchmarks)
+    :return: (torch.nn.Module) demucs model
+    """
+    if os.path.isfile(model_name):
+        import torch
+        return torch.load(model_name, weights_only=False)
+
+    from demucs import pretrained
+    return pretrained.get_model(model_name)
+
+
+@functools.lru_cache(maxsize=None)
+def get_embedding_model(input_repr, content_type, embedding_size):
+    """
+    Load a pretrained OpenL3 model, or get it from the models already loaded by the current process.
+
+    :param input_repr: (str) input representation of the model ("linear", "mel128" or "mel256")
+    :param content_type: (str) content the model was trained on ("music" or "env")
+    :param embedding_size: (int) size of the embeddings (512 or 6144)
+    :return: (keras.Model) OpenL3 audio embedding model
+    """
+    import openl3
+    return openl3.models.load_audio_embedding_model(input_repr=input_repr, content_type=content_type,
+                                                    embedding_size=embedding_size)
+
+
+class ModelClient:
+    """
+    Connection to a model server (see model_server.py), which keeps the models loaded and runs jobs
+    sent to it, so that a job does not pay for importing torch/tensorflow and loading the models.
+    """
+
+    def __init__(self, address=None, authkey=None):
+        """
+        :param address: (str or tuple) address of the server, path of a unix socket or (host, port),
+                                       if None, the socket in the runtime directory of the current user
+        :param authkey: (bytes) key of the server, if None, read from the file the server wrote it to
+        """
+        address = server_address(address)
+        if authkey is None:
+            authkey = read_authkey(address)
+        self.conn = Client(address, authkey=authkey)
+
+    def request(self, op, **kwargs):
+        """
+        Send a job to the server and wait for its result.
+
+        :param op: (str) name of the job ("ping", "info", "separate", "embed" or "shutdown")
+        :param kwargs: arguments of the job
+        :return: result of the job
+        """
+        self.conn.send({"op": op, **kwargs})
+        result, error = self.conn.recv()
+        if error is not None:
+            raise RuntimeError(f"The model server failed to run the {op} job:\n{error}")
+        return result
+
+    def info(self):
+        """
+        :return: (dict) settings of the server, e.g. the name of the model it separates with ("model_name")
+        """
+        return self.request("info")
+
+    def separate(self, in_path, out_path, stream=False, **kwargs):
+        """
+        Separate the vocal stem of a WAV file on the server (see separate.separate_job).
+
+        :param in_path: (str) path of the WAV file, readable by the server
+        :param out_path: (str) path of where the server saves the separated vocal stem
+        :param stream: (bool) whether to separate the file segment by segment
+        :param kwargs: segment_dur, overlap_dur, shifts and subtype, as in separate.separate_job
+        """
+        return self.request("separate", in_path=in_path, out_path=out_path, stream=stream, **kwargs)
+
+    def embed(self, items, **kwargs):
+        """
+        Compute the OpenL3 embedding frames of a batch of audio on the server (see extract_embeddings.iter_embeddings).
+
+        :param items: (list) paths of audio files readable by the server and/or (name, audio array, sample rate) tuples
+        :param kwargs: frame_batch_size and hop_size, as in extract_embeddings.iter_embeddings
+        :return: (list) (name, (embedding frames, timestamps), error) for each item, in the order of the items
+        """
+        return self.request("embed", items=list(items), **kwargs)
+
+    def iter_embed(self, items, batch_size=1, **kwargs):
+        """
+        Lazily compute the OpenL3 embedding frames of a stream of audio on the server, batch_size items at a time.
+
+        :param items: (iterable) paths of audio files readable by the server and/or (name, audio array, sample rate) tuples
+        :param batch_size: (int) number of items sent to the server at once
+        :param kwargs: frame_batch_size and hop_size, as in extract_embeddings.iter_embeddings
+        :return: (generator) (name, (embedding frames, timestamps), error) for each item, in the order of the items
+        """
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield from self.embed(batch, batch_size=batch_size, **kwargs)
+                batch = []
+        if batch:
+            yield from self.embed(batch, batch_size=batch_size, **kwargs)
+
+    def close(self):
+        """
+        Close the connection, the server keeps running.
+        """
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,158 @@
+import traceback
+import collections
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed, wait
+from tqdm import tqdm
+from audio_io import prefetch, AudioWriter, PREFETCH_DEPTH, AUDIO_SUBTYPE
+from profiling import phase, reset, collect
+
+
+def _call(func, args, kwargs=None):
+    """
+    Call a function on a tuple of arguments and catch any exception it raises.
+
+    :param func: (function) function to call
+    :param args: (tuple) positional arguments for the function
+    :param kwargs: (dict) keyword arguments for the function, a Future is replaced by its result
+                          (e.g. audio read ahead by prefetch) and its errors are errors of the call
+    :return: (tuple) result of the call (None on failure), error message (None on success),
+                     timings of the call (see profiling.collect)
+    """
+    reset()
+    try:
+        kwargs = dict(kwargs) if kwargs else {}
+        for key, value in kwargs.items():
+            if isinstance(value, Future):
+                # time spent waiting for the background read
+                with phase("read"):
+                    kwargs[key] = value.result()
+        result, error = func(*args, **kwargs), None
+    except Exception:
+        result, error = None, traceback.format_exc()
+    return result, error, collect()
+
+
+def _run_overlapped(func, jobs, load=None, write_behind=0, prefetch_depth=PREFETCH_DEPTH, profile=None):
+    """
+    Run jobs one at a time in the current process, overlapping their file I/O with compute
+    (see run_jobs).
+
+    :return: (generator) yields (name, result, error) for each job, in order, once its outputs are written
+    """
+    writer = AudioWriter(write_behind) if write_behind > 0 else None
+    inputs = prefetch([args[0] for _, args in jobs], load, prefetch_depth) if load is not None else None
+
+    # jobs that ran but whose outputs may still be waiting to be written
+    pending = collections.deque()
+
+    def finish(name, result, error, timings, writes):
+        wait(writes)
+        for future in writes:
+            if error is None and future.exception() is not None:
+                exc = future.exception()
+                result, error = None, "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+        if profile is not None:
+            profile.record(name, timings, error)
+        return name, result, error
+
+    try:
+        for name, args in tqdm(jobs):
+            kwargs = {}
+            if inputs is not None:
+                kwargs["audio"] = next(inputs)[1]
+            writes = []
+            if writer is not None:
+                def write(path, y, sr, subtype=AUDIO_SUBTYPE, writes=writes):
+                    writes.append(writer.write(path, y, sr, subtype))
+                kwargs["write"] = write
+            result, error, timings = _call(func, args, kwargs)
+            pending.append((name, result, error, timings, writes))
+
+            # report jobs in order, as soon as everything they wrote is on disk
+            while pending and (len(pending) > write_behind or all(f.done() for f in pending[0][4])):
+                yield finish(*pending.popleft())
+        while pending:
+            yield finish(*pending.popleft())
+    finally:
+        if inputs is not None:
+            inputs.close()
+        if writer is not None:
+            writer.close()
+
+
+def run_jobs(func, jobs, workers=1, initializer=None, initargs=(), mp_context=None, profile=None,
+             load=None, write_behind=0, prefetch_depth=PREFETCH_DEPTH):
+    """
+    Run a function over a list of per-file jobs, either serially or in a process pool.
+    A failing job does not stop the run, its error message is reported instead.
+
+    When the jobs run in the current process (workers=1, e.g. separation on the gpu), their file I/O
+    can be overlapped with compute:
+        load:         the input of the next prefetch_depth jobs is read on background threads with
+                      load(args[0]), and passed to func as audio=(the loaded input)
+        write_behind: func is passed write=(a function like audio_io.write_audio) that queues
+                      the output on a background writer, up to write_behind outputs are queued at a time
+    A job is only reported once its outputs are written, so a finished job always has its outputs on disk.
+    In a process pool, the workers overlap each other's I/O and func reads and writes its own files.
+
+    :param func: (function) module-level function to run on each job
+                            (it has to be picklable to be sent to the worker processes)
+    :param jobs: (list) list of (name, args) tuples, where args is the tuple of
+                        positional arguments passed to func for that job
+    :param workers: (int) number of worker processes to use
+                          if 1, run all jobs serially in the current process
+    :param initializer: (function) if given, called once in each worker before any job
+    :param initargs: (tuple) arguments for the initializer
+    :param mp_context: (multiprocessing context) context used to start the worker processes,
+                       if None, use the platform default
+    :param profile: (profiling.RunProfile) if given, profile to record the timings of each job to
+    :param load: (function) if given, function that reads the input of a job from its first argument,
+                            to read ahead of the current job (only used when workers=1)
+    :param write_behind: (int) number of outputs that may be waiting to be written, if 0, func writes
+                               its own outputs (only used when workers=1)
+    :param prefetch_depth: (int) number of inputs read ahead of the current job
+    :return: (generator) yields (name, result, error) for each job as it finishes,
+                         error is None if the job succeeded
+    """
+    if workers <= 1 and (load is not None or write_behind > 0):
+        # run in the current process, with reads and writes on background threads
+        if initializer is not None:
+            initializer(*initargs)
+        yield from _run_overlapped(func, jobs, load=load, write_behind=write_behind,
+                                   prefetch_depth=prefetch_depth, profile=profile)
+        return
+
+    if workers <= 1:
+        # run in the current process
+        if initializer is not None:
+            initializer(*initargs)
+        for name, args in tqdm(jobs):
+            result, error, timings = _call(func, args)
+            if profile is not None:
+                profile.record(name, timings, error)
+            yield name, result, error
+        return
+
+    # fan the jobs out over a pool of worker processes
+    # jobs are submitted in order, so free workers pick them up in that order
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context,
+                             initializer=initializer, initargs=initargs) as pool:
+        futures = {pool.submit(_call, func, args): name for name, args in jobs}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            result, error, timings = future.result()
+            if profile is not None:
+                profile.record(futures[future], timings, error)
+            yield futures[future], result, error
+
+
+def report_failures(failed):
+    """
+    Print a summary of the jobs that failed.
+
+    :param failed: (list) list of (name, error) tuples
+    """
+    if not failed:
+        return
+    print(f"{len(failed)} files failed to process:")
+    for name, error in failed:
+        print(f"--- {name}")
+        print(error)
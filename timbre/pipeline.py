@@ -0,0 +1,330 @@
+import os
+import multiprocessing
+import librosa
+from constants import HOP_LENGTH, NUM_MFCC, MFCC_N_FFT, RES_TYPE, AUDIO_FORMAT, AUDIO_SUBTYPE
+from preprocess import preprocess_audio, read_input
+from separate import separate_audio
+from postprocess import postprocess_audio
+from mel_cache import mfcc_from_mel
+from extract_mfccs import mfcc_name, summarize_mfccs
+from extract_embeddings import embedding_name, load_embedding_model, INPUT_REPRESENTATION, EMBEDDING_SIZE, HOP_SIZE, FRAME_BATCH_SIZE
+from feature_store import FeatureStore, STALE_FRACTION
+from models import get_separation_model
+from shard import select_shard, shard_path, shard_manifest, shard_args, merged_names, mark_done
+from parallel import run_jobs, report_failures
+from audio_io import (write_audio, audio_ext, is_audio_file, audio_length, storage_params, PREFETCH_DEPTH,
+                      WRITE_BEHIND)
+from profiling import phase, add_audio, RunProfile, PROFILE_NAME
+
+
+# set input and output directories
+INPUT_DIR = "/scratch/rn2214/data/choruses"
+OUTPUT_DIR = "/scratch/rn2214/data/pipeline"
+
+# settings of each stage, the same as when the stage scripts are run on their own
+# preprocess: sample rate of the standardized (and separated) audio
+PREPROCESS_SR = 44100
+# postprocess: sample rates of the final stems and the max length (in seconds) they are trimmed to
+FINAL_SRS = [22050, 44100]
+TRIM_DUR = 20.0
+# features: sample rate of the final stems each feature is computed from
+MFCC_SR = 22050
+EMBEDDING_SR = 44100
+
+# models of the current worker process, set by init_pipeline_worker
+_sep_model = None
+_sep_device = None
+_emb_model = None
+
+
+def init_pipeline_worker(model_name='htdemucs', num_threads=None, gpu=False, embeddings=True):
+    """
+    Load the models of the pipeline into the current process, so that they can be reused for every file
+    the process runs through the pipeline.
+
+    :param model_name: (str) name of the pretrained demucs model to use, or path of a saved model
+    :param num_threads: (int) number of threads torch may use in this process,
+                              if None, keep the torch default
+    :param gpu: (bool) whether to run the separation model on the current gpu device
+    :param embeddings: (bool) whether to load the OpenL3 model
+    """
+    global _sep_model, _sep_device, _emb_model
+
+    import torch
+    if num_threads is not None:
+        # fixed thread budget, so that several workers can share the cpu without oversubscribing it
+        torch.set_num_threads(num_threads)
+
+    print("Loading pretrained models...")
+    _sep_model = get_separation_model(model_name)
+    _sep_device = torch.cuda.current_device() if gpu else None
+    if embeddings:
+        _emb_model = load_embedding_model()
+    print("Models loaded successfully.")
+
+
+def pipeline_file(in_path, inter_paths=None, shifts=1, res_type=RES_TYPE, subtype=AUDIO_SUBTYPE, audio=None,
+                  write=None):
+    """
+    Run a single WAV file through preprocess, separate, postprocess and feature extraction,
+    with the models loaded by init_pipeline_worker.
+
+    The audio is handed from one stage to the next in memory. The intermediate audio is only
+    written to disk if inter_paths is given.
+
+    :param in_path: (str) path of the WAV file to process
+    :param inter_paths: (dict) if given, paths of where to save the intermediate audio, with the keys
+                               "standardized", "separated" and "final" (a list, one per final sample rate)
+    :param shifts: (int) number of random shifts to average the separation model output over
+    :param res_type: (str) resampling filter, any res_type of librosa.resample (see constants.RES_TYPE)
+    :param subtype: (str) sample format of the intermediate audio (see constants.AUDIO_SUBTYPE)
+    :param audio: (tuple) if given, (audio array, sample rate) already read from in_path (see preprocess.read_input)
+    :param write: (function) if given, function like audio_io.write_audio to save the intermediate audio with,
+                             e.g. to queue it on a background writer (see parallel.run_jobs)
+    :return: (dict) MFCC vector ("mfcc") and, if the OpenL3 model is loaded,
+                    embedding frames ("emb") and their timestamps ("ts")
+    """
+    if write is None:
+        write = write_audio
+
+    # load native sampling rate, keep in stereo
+    if audio is None:
+        with phase("read"):
+            audio = read_input(in_path, to_mono=False)
+    y, sr = audio
+    add_audio(y.shape[-1] / sr)
+
+    # preprocess: resample and fade
+    y_std = preprocess_audio(y, sr, target_sr=PREPROCESS_SR, normalize=False, fade=True, res_type=res_type)
+    del y
+    if inter_paths is not None:
+        with phase("write"):
+            write(inter_paths["standardized"], y_std, PREPROCESS_SR, subtype=subtype)
+
+    # separate the vocal stem
+    vox = separate_audio(_sep_model, y_std, device=_sep_device, shifts=shifts)
+    del y_std
+    if inter_paths is not None:
+        with phase("write"):
+            write(inter_paths["separated"], vox, PREPROCESS_SR, subtype=subtype)
+
+    # postprocess: mix down to mono, then resample, normalize, trim and fade at every final sample rate
+    with phase("dsp"):
+        vox = librosa.to_mono(vox)
+    stems = postprocess_audio(vox, PREPROCESS_SR, target_srs=FINAL_SRS, trim_dur=TRIM_DUR,
+                              normalize=True, fade=True, res_type=res_type)
+    del vox
+    if inter_paths is not None:
+        with phase("write"):
+            for out_path, target_sr, stem in zip(inter_paths["final"], FINAL_SRS, stems):
+                write(out_path, stem, target_sr, subtype=subtype)
+    stems = dict(zip(FINAL_SRS, stems))
+
+    # MFCC vector
+    with phase("features"):
+        M = librosa.feature.melspectrogram(y=stems[MFCC_SR], sr=MFCC_SR, hop_length=HOP_LENGTH, n_fft=MFCC_N_FFT)
+        result = {"mfcc": summarize_mfccs(mfcc_from_mel(M, n_mfcc=NUM_MFCC))}
+
+    # OpenL3 embedding frames
+    if _emb_model is not None:
+        import openl3
+        with phase("inference"):
+            emb, ts = openl3.get_audio_embedding(stems[EMBEDDING_SR].T, EMBEDDING_SR, model=_emb_model,
+                                                 hop_size=HOP_SIZE, batch_size=FRAME_BATCH_SIZE, verbose=False)
+        result["emb"] = emb
+        result["ts"] = ts
+
+    return result
+
+
+def pipeline(in_dir, out_dir, model_name='htdemucs', gpu=True, embeddings=True, keep_intermediates=False,
+             shifts=1, workers=1, threads=None, force=False, profile=False, res_type=RES_TYPE,
+             prefetch=PREFETCH_DEPTH, write_behind=WRITE_BEHIND, audio_format=AUDIO_FORMAT, subtype=AUDIO_SUBTYPE,
+             shard=None, num_shards=1):
+    """
+    Run WAV files through preprocess, separate, postprocess and feature extraction in a single pass.
+
+    Each file is decoded once and its audio is handed from one stage to the next in memory,
+    instead of being written to and decoded from the standardized, separated and final stem
+    directories in between. The stages use the same settings as the stage scripts.
+    The intermediate audio is only written when keep_intermediates is True, to the
+    standardized, separated and final_stems_<sr> subdirectories of the output directory.
+
+    Since the audio is not quantized to 16 bits between stages, the features can differ
+    very slightly from those computed by running the stage scripts one after another.
+
+    The MFCC vectors and embedding frames of all files are appended to FeatureStores in the output
+    directory (all_mfccs_<num_mfcc> and all_embeddings_<embedding_size>), under the same names as
+    extract_mfccs and extract_embeddings use.
+
+    Files that were already processed with the same contents and parameters, according to
+    the manifest kept in the output directory, are skipped unless force is True.
+
+    With a single process (e.g. on the gpu), the next files are read and the intermediate audio
+    is written on background threads while the models run (see parallel.run_jobs).
+
+    :param in_dir: (str) directory of WAV files to process
+    :param out_dir: (str) directory of where to save the features (and intermediate audio)
+    :param model_name: (str) name of the pretrained demucs model to use
+    :param gpu: (bool) if a gpu is available for use, set to True
+    :param embeddings: (bool) whether to extract OpenL3 embeddings as well as MFCCs
+    :param keep_intermediates: (bool) whether to also save the intermediate audio of every stage
+    :param shifts: (int) number of random shifts to average the separation model output over
+    :param workers: (int) number of worker processes, only used on the cpu
+    :param threads: (int) number of torch threads per worker,
+                          if None, the available cores are split evenly between the workers
+    :param force: (bool) whether to reprocess files that were already processed
+    :param profile: (bool) whether to append per-file phase timings and a summary of the run
+                           to the profile file in the output directory (see profiling.RunProfile)
+    :param res_type: (str) resampling filter, any res_type of librosa.resample (see constants.RES_TYPE)
+    :param prefetch: (int) with a single process, number of files read ahead, if 0, read each file when it is processed
+    :param write_behind: (int) with a single process and keep_intermediates, number of intermediate files that
+                               may be waiting to be written, if 0, write them before processing the next file
+    :param audio_format: (str) storage format of the intermediate audio, "WAV" or "FLAC" (see constants.AUDIO_FORMAT)
+    :param subtype: (str) sample format of the intermediate audio (see constants.AUDIO_SUBTYPE)
+    :param shard: (int) shard of the input files to process, from 0 to num_shards - 1 (see shard.py)
+    :param num_shards: (int) number of shards the input files are split into, if 1, process every file
+    :return: (tuple) list of files that were processed, list of (file, error) for files that failed
+    """
+    # get all of the files in the input directory
+    print("Loading list of files...")
+    file_list = os.listdir(in_dir)
+    print(f"There are {len(file_list)} files in the input directory.")
+    if num_shards > 1:
+        file_list = select_shard(file_list, shard, num_shards)
+        print(f"{len(file_list)} of them are in shard {shard} of {num_shards}.")
+
+    # create the output directories if they do not already exist
+    print("Creating output directory, if it does not already exist...")
+    inter_dirs = {"standardized": os.path.join(out_dir, "standardized"),
+                  "separated": os.path.join(out_dir, "separated"),
+                  "final": [os.path.join(out_dir, f"final_stems_{sr}") for sr in FINAL_SRS]}
+    os.makedirs(out_dir, exist_ok=True)
+    if keep_intermediates:
+        for d in [inter_dirs["standardized"], inter_dirs["separated"]] + inter_dirs["final"]:
+            os.makedirs(d, exist_ok=True)
+
+    # create the stores of MFCC vectors and embedding frames
+    # a shard writes to stores of its own, merged into the stores of all files afterwards (see shard.merge)
+    mfcc_path = os.path.join(out_dir, f"all_mfccs_{NUM_MFCC}")
+    mfcc_store = FeatureStore(shard_path(mfcc_path, shard, num_shards), dim=2 * (NUM_MFCC - 1))
+    merged_mfccs = merged_names(mfcc_path, num_shards)
+    emb_store = None
+    merged_embs = set()
+    if embeddings:
+        emb_path = os.path.join(out_dir, f"all_embeddings_{EMBEDDING_SIZE}")
+        emb_store = FeatureStore(shard_path(emb_path, shard, num_shards), dim=EMBEDDING_SIZE, timestamps=True)
+        merged_embs = merged_names(emb_path, num_shards)
+
+    # load the record of files that were already processed
+    manifest = shard_manifest(out_dir, shard, num_shards)
+    params = {"model_name": model_name, "shifts": shifts, "embeddings": embeddings,
+              "keep_intermediates": keep_intermediates, "preprocess_sr": PREPROCESS_SR,
+              "final_srs": FINAL_SRS, "trim_dur": TRIM_DUR, "num_mfcc": NUM_MFCC,
+              "hop_length": HOP_LENGTH, "n_fft": MFCC_N_FFT, "res_type": res_type}
+    if keep_intermediates:
+        params.update(storage_params(audio_format, subtype))
+    if embeddings:
+        params.update({"input_repr": INPUT_REPRESENTATION, "embedding_size": EMBEDDING_SIZE,
+                       "hop_size": HOP_SIZE})
+
+    # create one job per file that still needs to be processed
+    jobs = []
+    paths = {}
+    for file in file_list:
+        # only process audio files
+        if is_audio_file(file):
+            in_path = os.path.join(in_dir, file)
+            name, _ = os.path.splitext(file)
+
+            # set the names of the features, the same as the stage scripts,
+            # which name them after the final stem, e.g. Artist_Song_Standardized_Vox_Final.wav
+            final_file = name + "_Standardized_Vox_Final.wav"
+            mfcc_out_name = mfcc_name(final_file)
+            emb_name = embedding_name(final_file)
+
+            # skip files that were already processed
+            mfcc_stored = mfcc_out_name in mfcc_store or mfcc_out_name in merged_mfccs
+            emb_stored = emb_store is None or emb_name in emb_store or emb_name in merged_embs
+            if not force and mfcc_stored and emb_stored and manifest.is_done(file, in_path, params):
+                continue
+
+            # set the names of the intermediate files, the same as the stage scripts
+            inter_paths = None
+            if keep_intermediates:
+                ext = audio_ext(audio_format)
+                std_name = name + "_Standardized"
+                vox_name = std_name + "_Vox"
+                inter_paths = {"standardized": os.path.join(inter_dirs["standardized"], f"{std_name}{ext}"),
+                               "separated": os.path.join(inter_dirs["separated"], f"{vox_name}{ext}"),
+                               "final": [os.path.join(d, f"{vox_name}_Final{ext}") for d in inter_dirs["final"]]}
+
+            paths[file] = (in_path, mfcc_out_name, emb_name, inter_paths)
+            jobs.append((file, (in_path, inter_paths, shifts, res_type, subtype)))
+    print(f"{len(jobs)} files need to be processed.")
+
+    # a gpu is shared by a single process
+    if gpu:
+        workers = 1
+
+    if workers > 1:
+        if threads is None:
+            threads = max(1, len(os.sched_getaffinity(0)) // workers)
+
+        # longest files first
+        jobs.sort(key=lambda job: audio_length(job[1][0]), reverse=True)
+
+    # each worker loads its own copy of the models in init_pipeline_worker
+    # workers are started as fresh processes rather than forks of a process that already initialized torch
+    print(f"Storage: {audio_format} {subtype}")
+    print(f"Number of workers: {workers}, threads per worker: {threads}")
+
+    # iterate through each file
+    print("Beginning to process files...")
+    run_profile = None
+    if profile:
+        run_profile = RunProfile(shard_path(os.path.join(out_dir, PROFILE_NAME), shard, num_shards),
+                                 "pipeline", {**params, "gpu": gpu, "workers": workers, "threads": threads})
+
+    processed = []
+    failed = []
+    for file, result, error in run_jobs(pipeline_file, jobs, workers=workers,
+                                        initializer=init_pipeline_worker,
+                                        initargs=(model_name, threads, gpu, embeddings),
+                                        mp_context=multiprocessing.get_context("spawn"), profile=run_profile,
+                                        load=read_input if prefetch > 0 else None,
+                                        write_behind=write_behind if keep_intermediates else 0,
+                                        prefetch_depth=prefetch):
+        if error is None:
+            processed.append(file)
+            in_path, mfcc_out_name, emb_name, inter_paths = paths[file]
+            mfcc_store.append(mfcc_out_name, result["mfcc"])
+            if emb_store is not None:
+                emb_store.append(emb_name, result["emb"], result["ts"])
+
+            outputs = []
+            if inter_paths is not None:
+                outputs = [inter_paths["standardized"], inter_paths["separated"]] + inter_paths["final"]
+            manifest.record(file, in_path, params, outputs)
+        else:
+            failed.append((file, error))
+
+    mfcc_store.close()
+    mfcc_store.compact(STALE_FRACTION)
+    if emb_store is not None:
+        emb_store.close()
+        emb_store.compact(STALE_FRACTION)
+    if run_profile is not None:
+        run_profile.close()
+
+    report_failures(failed)
+    mark_done(out_dir, shard, num_shards)
+    print("Processing complete!")
+
+    return processed, failed
+
+
+if __name__ == '__main__':
+    # run function
+    args = shard_args("Run every stage on each chorus, from the chorus to its features.")
+    pipeline(INPUT_DIR, OUTPUT_DIR, shard=args.shard, num_shards=args.num_shards)
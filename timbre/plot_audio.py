@@ -2,12 +2,12 @@ import os
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
-import librosa
-from librosa.display import specshow
 import soundfile as sf
-import pickle
-from tqdm import tqdm
-from constants import HOP_LENGTH, N_FFT
+from audio_io import is_audio_file
+from constants import AUDIO_DTYPE
+from shard import select_shard, shard_path, shard_manifest, shard_args, mark_done
+from parallel import run_jobs, report_failures
+from profiling import phase, add_audio, RunProfile, PROFILE_NAME
 
 # use non-interactive backend to write to files
 matplotlib.use('Agg')
@@ -17,49 +17,165 @@ matplotlib.use('Agg')
 INPUT_DIR = "/scratch/rn2214/data/final_stems_22050"
 PLOT_DIR = "/scratch/rn2214/plots/waveforms"
 
-def plot_audio(in_dir, plot_dir):
+# figure and axes of the current worker process, set by init_plot_worker
+_fig = None
+_ax = None
+
+
+def init_plot_worker():
+    """
+    Create the figure that the current process reuses for every plot it renders.
+    """
+    global _fig, _ax
+    _fig, _ax = plt.subplots()
+
+
+def minmax_envelope(t, y, num_bins):
+    """
+    Reduce a waveform to the minimum and maximum of each of num_bins equal time bins.
+    Drawn as a line, the envelope alternates between the minimum and maximum of each bin,
+    which looks the same as the full waveform when there is about one bin per pixel.
+
+    :param t: (np.array) time axis of the waveform
+    :param y: (np.array) waveform, of shape (num_samples,) or (num_samples, num_channels)
+    :param num_bins: (int) number of time bins
+    :return: (tuple) time axis of the envelope, envelope (2 points per bin)
+    """
+    num_samples = len(y)
+    if num_samples <= 2 * num_bins:
+        # nothing to gain
+        return t, y
+
+    # first sample of each bin
+    starts = np.linspace(0, num_samples, num_bins + 1).astype(int)[:-1]
+    y_min = np.minimum.reduceat(y, starts, axis=0)
+    y_max = np.maximum.reduceat(y, starts, axis=0)
+
+    # interleave the minimum and maximum of each bin, both at the center of the bin
+    ends = np.append(starts[1:], num_samples) - 1
+    t_center = (t[starts] + t[ends]) / 2
+    t_env = np.repeat(t_center, 2)
+    y_env = np.stack((y_min, y_max), axis=1).reshape((2 * num_bins,) + y.shape[1:])
+
+    return t_env, y_env
+
+
+def plot_audio_file(in_path, plot_out_path, title, decimate=True):
+    """
+    Plot and save the waveform of a single WAV file, on the figure created by init_plot_worker.
+
+    :param in_path: (str) path of the WAV file to plot the waveform of
+    :param plot_out_path: (str) path of where to save the waveform plot
+    :param title: (str) title of the plot
+    :param decimate: (bool) whether to only draw the min/max envelope at about the pixel width of the figure
+    """
+    # read the soundfile
+    with phase("read"):
+        y, sr = sf.read(in_path, dtype=AUDIO_DTYPE)
+
+    # plot the waveform
+    duration = len(y) / sr
+    add_audio(duration)
+    with phase("plot"):
+        t = np.linspace(0, duration, num=len(y))
+        if decimate:
+            # one bin per pixel column of the saved figure
+            width, _ = _fig.get_size_inches()
+            dpi = plt.rcParams["savefig.dpi"]
+            if dpi == "figure":
+                dpi = _fig.dpi
+            t, y = minmax_envelope(t, y, int(width * dpi))
+
+        # clear the previous plot and draw on the same axes
+        _ax.clear()
+        _ax.plot(t, y)
+        _ax.set_xlabel("Time (seconds)")
+        _ax.set_ylabel("Amplitude")
+        _ax.set_title(title)
+    with phase("write"):
+        _fig.savefig(plot_out_path)
+
+
+def plot_audio(in_dir, plot_dir, force=False, decimate=True, workers=1, profile=False, shard=None, num_shards=1):
     """
     Plot and save waveforms of vocal stem WAV files.
 
     :param in_dir: (str) directory of WAV files to plot waveforms of
     :param plot_dir: (str) directory of where to save the waveform plots
+    :param force: (bool) whether to plot files that were already plotted
+    :param decimate: (bool) whether to only draw the min/max envelope of each waveform
+                            at about the pixel width of the figure, instead of every sample
+    :param workers: (int) number of worker processes to render the plots with
+    :param profile: (bool) whether to append per-file phase timings and a summary of the run
+                           to the profile file in the plot directory (see profiling.RunProfile)
+    :param shard: (int) shard of the input files to process, from 0 to num_shards - 1 (see shard.py)
+    :param num_shards: (int) number of shards the input files are split into, if 1, process every file
+    :return: (tuple) list of files that were plotted, list of (file, error) for files that failed
     """
     # get all of the files in the input directory
     print("Loading list of files...")
     file_list = os.listdir(in_dir)
     print(f"There are {len(file_list)} files in the input directory.")
+    if num_shards > 1:
+        file_list = select_shard(file_list, shard, num_shards)
+        print(f"{len(file_list)} of them are in shard {shard} of {num_shards}.")
 
     # create the output directory if it does not already exist
     print("Creating plot directory, if it does not already exist...")
     os.makedirs(plot_dir, exist_ok=True)
-    
-    print("Plotting waveforms for each audio file...")
-    for i in tqdm(range(len(file_list))):
-        # only process wav files
-        if file_list[i].endswith(".wav"):   
-            # read the soundfile
-            in_path = os.path.join(in_dir, file_list[i])
-            y, sr = sf.read(in_path)
-            
+
+    # load the record of files that were already plotted
+    manifest = shard_manifest(plot_dir, shard, num_shards)
+    params = {"decimate": decimate}
+
+    # create one job per file that still needs to be plotted
+    jobs = []
+    paths = {}
+    for file in file_list:
+        # only process audio files
+        if is_audio_file(file):
+            in_path = os.path.join(in_dir, file)
+
+            # skip files that were already plotted
+            if not force and manifest.is_done(file, in_path, params):
+                continue
+
             # set the output file name
-            s = file_list[i].split("_")
+            s = file.split("_")
             plot_name = f"{s[0]}_{s[1]}_waveform.png"
             plot_out_path = os.path.join(plot_dir, plot_name)
 
-            # plot the mfccs
-            duration = len(y) / sr
-            t = np.linspace(0, duration, num=len(y))
-            plt.plot(t, y)
-            plt.xlabel("Time (seconds)")
-            plt.ylabel("Amplitude")
-            plt.title(f"{s[0]} {s[1]} Audio")
-            plt.savefig(plot_out_path)
-            plt.close()
+            paths[file] = (in_path, plot_out_path)
+            jobs.append((file, (in_path, plot_out_path, f"{s[0]} {s[1]} Audio", decimate)))
+
+    print("Plotting waveforms for each audio file...")
+    run_profile = None
+    if profile:
+        run_profile = RunProfile(shard_path(os.path.join(plot_dir, PROFILE_NAME), shard, num_shards),
+                                 "plot_audio", {**params, "workers": workers})
 
+    processed = []
+    failed = []
+    for file, _, error in run_jobs(plot_audio_file, jobs, workers=workers,
+                                   initializer=init_plot_worker, profile=run_profile):
+        if error is None:
+            processed.append(file)
+            in_path, plot_out_path = paths[file]
+            manifest.record(file, in_path, params, [plot_out_path])
+        else:
+            failed.append((file, error))
+
+    if run_profile is not None:
+        run_profile.close()
+
+    report_failures(failed)
+    mark_done(plot_dir, shard, num_shards)
     print("Processing complete!")
 
+    return processed, failed
+
 
 if __name__ == '__main__':
     # run function
-    plot_audio(INPUT_DIR, PLOT_DIR)
-    
\ No newline at end of file
+    args = shard_args("Plot the waveforms of the final vocal stems.")
+    plot_audio(INPUT_DIR, PLOT_DIR, workers=len(os.sched_getaffinity(0)), shard=args.shard, num_shards=args.num_shards)
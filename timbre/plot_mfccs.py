@@ -0,0 +1,147 @@
+import os
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.colorbar import make_axes
+from librosa.display import specshow
+from constants import HOP_LENGTH, NUM_MFCC, MFCC_N_FFT, MEL_CACHE_DIR, MEL_CACHE_MAX_BYTES
+from audio_io import is_audio_file
+from shard import select_shard, shard_path, shard_manifest, shard_args, mark_done
+from mel_cache import MelCache, melspectrogram, mfcc_from_mel
+from parallel import run_jobs, report_failures
+from profiling import phase, add_audio, RunProfile, PROFILE_NAME
+
+# use non-interactive backend to write to files
+matplotlib.use('Agg')
+
+# set input and output directories
+INPUT_DIR = "/scratch/rn2214/data/final_stems_22050"
+PLOT_DIR = "/scratch/rn2214/plots/mfccs"
+
+# figure, axes and spectrogram cache of the current worker process, set by init_plot_worker
+_fig = None
+_ax = None
+_cax = None
+_mel_cache = None
+
+
+def init_plot_worker(cache_dir=None):
+    """
+    Create the figure that the current process reuses for every plot it renders.
+
+    :param cache_dir: (str) directory of the mel spectrogram cache (e.g. constants.MEL_CACHE_DIR), if None, no cache
+    """
+    global _fig, _ax, _cax, _mel_cache
+
+    # same layout as fig.colorbar(img, ax=ax) on a new figure, but the colorbar axes are kept
+    _fig, _ax = plt.subplots()
+    _cax, _ = make_axes(_ax)
+    _mel_cache = MelCache(cache_dir, max_bytes=MEL_CACHE_MAX_BYTES) if cache_dir is not None else None
+
+
+def plot_mfcc_file(in_path, plot_out_path, title):
+    """
+    Plot the MFCCs of a single WAV file over time and save the plot.
+
+    :param in_path: (str) path of the WAV file
+    :param plot_out_path: (str) path of where to save the MFCC plot
+    :param title: (str) title of the plot
+    """
+    # compute the MFCCs from the cached mel spectrogram
+    M, sr = melspectrogram(in_path, hop_length=HOP_LENGTH, n_fft=MFCC_N_FFT, mel_cache=_mel_cache)
+    add_audio((M.shape[-1] - 1) * HOP_LENGTH / sr)
+    with phase("features"):
+        mfccs = mfcc_from_mel(M, n_mfcc=NUM_MFCC)
+
+    # clear the previous plot and draw on the same axes
+    with phase("plot"):
+        _ax.clear()
+        _cax.clear()
+        img = specshow(mfccs, x_axis='time', hop_length=HOP_LENGTH, ax=_ax)
+        _fig.colorbar(img, cax=_cax)
+        _ax.set(title=title)
+    with phase("write"):
+        _fig.savefig(plot_out_path)
+
+
+def plot_mfccs(in_dir, plot_dir, workers=1, force=False, cache_dir=None, profile=False,
+               shard=None, num_shards=1):
+    """
+    Plot the MFCCs of vocal stem WAV files over time and save the plots.
+
+    :param in_dir: (str) directory of WAV files to plot MFCCs of
+    :param plot_dir: (str) directory of where to save the MFCC plots
+    :param workers: (int) number of worker processes to render the plots with
+    :param force: (bool) whether to plot files that were already plotted
+    :param cache_dir: (str) directory of the mel spectrogram cache (e.g. constants.MEL_CACHE_DIR), if None, no cache
+    :param profile: (bool) whether to append per-file phase timings and a summary of the run
+                           to the profile file in the plot directory (see profiling.RunProfile)
+    :param shard: (int) shard of the input files to process, from 0 to num_shards - 1 (see shard.py)
+    :param num_shards: (int) number of shards the input files are split into, if 1, process every file
+    :return: (tuple) list of files that were plotted, list of (file, error) for files that failed
+    """
+    # get all of the files in the input directory
+    print("Loading list of files...")
+    file_list = os.listdir(in_dir)
+    print(f"There are {len(file_list)} files in the input directory.")
+    if num_shards > 1:
+        file_list = select_shard(file_list, shard, num_shards)
+        print(f"{len(file_list)} of them are in shard {shard} of {num_shards}.")
+
+    # create the output directory if it does not already exist
+    print("Creating plot directory, if it does not already exist...")
+    os.makedirs(plot_dir, exist_ok=True)
+
+    # load the record of files that were already plotted
+    manifest = shard_manifest(plot_dir, shard, num_shards)
+    params = {"num_mfcc": NUM_MFCC, "hop_length": HOP_LENGTH, "n_fft": MFCC_N_FFT}
+
+    # create one job per file that still needs to be plotted
+    jobs = []
+    paths = {}
+    for file in file_list:
+        # only process audio files
+        if is_audio_file(file):
+            in_path = os.path.join(in_dir, file)
+            if not force and manifest.is_done(file, in_path, params):
+                continue
+
+            # set the output file name
+            s = file.split("_")
+            plot_name = f"{s[0]}_{s[1]}_mfcc.png"
+            plot_out_path = os.path.join(plot_dir, plot_name)
+
+            paths[file] = (in_path, plot_out_path)
+            jobs.append((file, (in_path, plot_out_path, f'MFCCs\n{s[0]} {s[1]}')))
+
+    print("Plotting MFCCs for each audio file...")
+    run_profile = None
+    if profile:
+        run_profile = RunProfile(shard_path(os.path.join(plot_dir, PROFILE_NAME), shard, num_shards),
+                                 "plot_mfccs", {**params, "workers": workers})
+
+    processed = []
+    failed = []
+    for file, _, error in run_jobs(plot_mfcc_file, jobs, workers=workers,
+                                   initializer=init_plot_worker, initargs=(cache_dir,), profile=run_profile):
+        if error is None:
+            processed.append(file)
+            in_path, plot_out_path = paths[file]
+            manifest.record(file, in_path, params, [plot_out_path])
+        else:
+            failed.append((file, error))
+
+    if run_profile is not None:
+        run_profile.close()
+
+    report_failures(failed)
+    mark_done(plot_dir, shard, num_shards)
+    print("Processing complete!")
+
+    return processed, failed
+
+
+if __name__ == '__main__':
+    # run function
+    args = shard_args("Plot the MFCCs of the final vocal stems.")
+    plot_mfccs(INPUT_DIR, PLOT_DIR, workers=len(os.sched_getaffinity(0)), cache_dir=MEL_CACHE_DIR,
+               shard=args.shard, num_shards=args.num_shards)
@@ -7,7 +7,11 @@ from librosa.display import specshow
 import soundfile as sf
 import pickle
 from tqdm import tqdm
-from constants import HOP_LENGTH, N_FFT
+from constants import HOP_LENGTH, N_FFT, MEL_CACHE_DIR, MEL_CACHE_MAX_BYTES
+from audio_io import is_audio_file
+from shard import select_shard, shard_path, shard_manifest, shard_args, mark_done
+from mel_cache import MelCache, melspectrogram
+from profiling import phase, add_audio, reset, collect, RunProfile, PROFILE_NAME
 
 # use non-interactive backend to write to files
 matplotlib.use('Agg')
@@ -17,49 +21,87 @@ matplotlib.use('Agg')
 INPUT_DIR = "/scratch/rn2214/data/final_stems_22050"
 PLOT_DIR = "/scratch/rn2214/plots/spectrograms"
 
-def plot_spectrograms(in_dir, plot_dir):
+def plot_spectrograms(in_dir, plot_dir, force=False, cache_dir=None, profile=False,
+                      shard=None, num_shards=1):
     """
     Plot and save Mel-Frequency spectrograms vocal stem WAV files.
 
     :param in_dir: (str) directory of WAV files to plot spectrograms of
     :param plot_dir: (str) directory of where to save the spectrogram plots
+    :param force: (bool) whether to plot files that were already plotted
+    :param cache_dir: (str) directory of the mel spectrogram cache (e.g. constants.MEL_CACHE_DIR), if None, no cache
+    :param profile: (bool) whether to append per-file phase timings and a summary of the run
+                           to the profile file in the plot directory (see profiling.RunProfile)
+    :param shard: (int) shard of the input files to process, from 0 to num_shards - 1 (see shard.py)
+    :param num_shards: (int) number of shards the input files are split into, if 1, process every file
     """
     # get all of the files in the input directory
     print("Loading list of files...")
     file_list = os.listdir(in_dir)
     print(f"There are {len(file_list)} files in the input directory.")
+    if num_shards > 1:
+        file_list = select_shard(file_list, shard, num_shards)
+        print(f"{len(file_list)} of them are in shard {shard} of {num_shards}.")
 
     # create the output directory if it does not already exist
     print("Creating plot directory, if it does not already exist...")
     os.makedirs(plot_dir, exist_ok=True)
-    
+
+    # load the record of files that were already plotted
+    manifest = shard_manifest(plot_dir, shard, num_shards)
+    params = {"hop_length": HOP_LENGTH, "n_fft": N_FFT}
+
+    # spectrograms shared with the features computed from the same files
+    mel_cache = MelCache(cache_dir, max_bytes=MEL_CACHE_MAX_BYTES) if cache_dir is not None else None
+
+    run_profile = None
+    if profile:
+        run_profile = RunProfile(shard_path(os.path.join(plot_dir, PROFILE_NAME), shard, num_shards),
+                                 "plot_spectrograms", params)
+
     print("Plotting spectrograms for each audio file...")
     for i in tqdm(range(len(file_list))):
-        # only process wav files
-        if file_list[i].endswith(".wav"):   
-            # read the soundfile
+        # only process audio files
+        if is_audio_file(file_list[i]):
             in_path = os.path.join(in_dir, file_list[i])
-            y, sr = sf.read(in_path)
-            
+
+            # skip files that were already plotted
+            if not force and manifest.is_done(file_list[i], in_path, params):
+                continue
+
             # set the output file name
             s = file_list[i].split("_")
             plot_name = f"{s[0]}_{s[1]}_melspectrogram.png"
             plot_out_path = os.path.join(plot_dir, plot_name)
 
             # plot the mfccs
+            reset()
             fig, ax = plt.subplots()
-            M = librosa.feature.melspectrogram(y=y, sr=sr, hop_length=HOP_LENGTH, n_fft=N_FFT)
-            M_db = librosa.power_to_db(M, ref=np.max)
-            img = librosa.display.specshow(M_db, sr=sr, hop_length=HOP_LENGTH, y_axis='mel', x_axis='time', ax=ax)
-            ax.set(title=f'Mel Spectrogram\n{s[0]} {s[1]}', xlabel='Time (seconds)')
-            fig.colorbar(img, ax=ax, format="%+2.f dB")
-            plt.savefig(plot_out_path)
+            M, sr = melspectrogram(in_path, hop_length=HOP_LENGTH, n_fft=N_FFT, mel_cache=mel_cache)
+            add_audio((M.shape[-1] - 1) * HOP_LENGTH / sr)
+            with phase("features"):
+                M_db = librosa.power_to_db(M, ref=np.max)
+            with phase("plot"):
+                img = librosa.display.specshow(M_db, sr=sr, hop_length=HOP_LENGTH, y_axis='mel', x_axis='time', ax=ax)
+                ax.set(title=f'Mel Spectrogram\n{s[0]} {s[1]}', xlabel='Time (seconds)')
+                fig.colorbar(img, ax=ax, format="%+2.f dB")
+            with phase("write"):
+                plt.savefig(plot_out_path)
             plt.close()
 
+            manifest.record(file_list[i], in_path, params, [plot_out_path])
+            if run_profile is not None:
+                run_profile.record(file_list[i], collect())
+
+    if run_profile is not None:
+        run_profile.close()
+
+    mark_done(plot_dir, shard, num_shards)
     print("Processing complete!")
 
 
 if __name__ == '__main__':
     # run function
-    plot_spectrograms(INPUT_DIR, PLOT_DIR)
+    args = shard_args("Plot the mel spectrograms of the final vocal stems.")
+    plot_spectrograms(INPUT_DIR, PLOT_DIR, cache_dir=MEL_CACHE_DIR, shard=args.shard, num_shards=args.num_shards)
     
\ No newline at end of file
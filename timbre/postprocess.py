@@ -1,63 +1,60 @@
 import os
+import functools
 import numpy as np
 import librosa
-import soundfile as sf
-from tqdm import tqdm
+from constants import RES_TYPE, LIBROSA_RES_TYPE, AUDIO_FORMAT, AUDIO_SUBTYPE
 from utils import normalize_data, trim_audio, fade_in_out
+from parallel import run_jobs, report_failures
+from audio_io import (load_audio, write_audio, audio_ext, is_audio_file, storage_params, PREFETCH_DEPTH,
+                      WRITE_BEHIND)
+from shard import select_shard, shard_path, shard_manifest, shard_args, mark_done
+from profiling import phase, add_audio, RunProfile, PROFILE_NAME
 
 
 # set input and output directories
 INPUT_DIR = "/scratch/rn2214/data/separated"
 OUTPUT_DIR = "/scratch/rn2214/data/final_stems"
 
+# extra audio (in seconds) decoded past the trim point when only the beginning of a file is read
+# so that the resampling filter sees the same samples around the trim point as on the full track
+RESAMPLE_GUARD = 0.25
 
-def postprocess(in_dir, out_dir, target_sr=22050, to_mono=False, trim_dur=20.0, normalize=False, fade=True):
+
+def postprocess_audio(y, sr, target_srs=(22050,), trim_dur=20.0, normalize=False, fade=True, trim_first=False,
+                      res_type=RES_TYPE):
     """
-    Postprocess WAV files after applying the source separation model.
+    Postprocess an audio array after applying the source separation model.
+    One output is returned for each target sample rate.
 
-    :param in_dir: (str) directory of WAV files to process
-    :param out_dir: (str) directory of where to save the final stems WAV files
-    :param target_sr: (int) sample rate to resample all WAV files to
-                            downsample to 22050 Hz because this is what
-                            librosa uses by default to manage the computional load
-    :param to_mono: (bool) whether to mix down stereo files to mono
+    :param y: (np.array) audio array (channels first if stereo), left untouched
+    :param sr: (int) sample rate of the audio array
+    :param target_srs: (list) sample rates to resample the audio to
     :param trim_dur: (float) if positive, the max length (in seconds) to trim the clip down to
                              if 0.0, do not trim the audio at all
     :param normalize: (bool) whether to normalize data (center, amplitude)
-    :param fade: (bool) whether to add a fade at the beginning and end of each clip
+    :param fade: (bool) whether to add a fade at the beginning and end of the clip
+    :param trim_first: (bool) whether to trim the audio before normalizing it
+    :param res_type: (str) resampling filter, any res_type of librosa.resample (see constants.RES_TYPE)
+    :return: (list) processed audio arrays, one per target sample rate
     """
+    outputs = []
+    for target_sr in target_srs:
+        # resample to target sampling rate
+        with phase("resample"):
+            y_hat = librosa.resample(y, orig_sr=sr, target_sr=target_sr, res_type=res_type)
+        if y_hat is y:
+            # already at the target sampling rate, copy so the in-place steps below leave y untouched
+            y_hat = y.copy()
 
-    print("Loading list of files...")
-    # get all of the files in the input directory
-    file_list = os.listdir(in_dir)
-    print(f"There are {len(file_list)} files in the input directory.")
-
-    # create the output directory if it does not already exist
-    print("Creating output directory, if it does not already exist...")
-    os.makedirs(out_dir, exist_ok=True)
-
-    # iterate through each file
-    print("Beginning to process files...")
-    print(f"Target Sampling Rate: {target_sr} Hz")
-
-    for i in tqdm(range(len(file_list))):
-        # only process .wav files
-        if file_list[i].endswith(".wav"):
-            # read the soundfile
-            in_path = os.path.join(in_dir, file_list[i])
-
-            # load native sampling rate
-            # mix down to mono, if enabled
-            # otherwise, keep in stereo
-            y, sr = librosa.load(in_path, sr=None, mono=to_mono)
-
-            # resample to target sampling rate
-            y_hat = librosa.resample(y, orig_sr=sr, target_sr=target_sr)
+        with phase("dsp"):
+            if trim_first and trim_dur > 0:
+                # trim before normalizing, the statistics only cover the trimmed clip
+                y_hat = trim_audio(y_hat, target_sr, trim_dur)
 
             if normalize:
                 # normalize data to have a mean of 0, standard deviation of 1
                 # scale between -1 and 1
-                y_norm = normalize_data(y_hat)
+                y_norm = normalize_data(y_hat, out=y_hat)
             else:
                 y_norm = y_hat
 
@@ -69,30 +66,216 @@ def postprocess(in_dir, out_dir, target_sr=22050, to_mono=False, trim_dur=20.0,
 
             if fade:
                 # add a 0.5 second fade in and out to the audio
-                y_out = fade_in_out(y_trim, target_sr, duration=0.5)
+                y_out = fade_in_out(y_trim, target_sr, duration=0.5, out=y_trim)
             else:
                 y_out = y_trim
 
-            # save file
-            name, ext = file_list[i].split('.')
-            out_file = name + "_Final." + ext
-            out_path = os.path.join(out_dir, out_file)
-            sf.write(out_path, y_out.T, target_sr)
+        outputs.append(y_out)
+
+    return outputs
+
+
+def read_duration(trim_dur=20.0, normalize=False, trim_first=False):
+    """
+    Get the length of audio to read from the beginning of a file to postprocess.
+
+    :param trim_dur: (float) if positive, the max length (in seconds) the clip is trimmed down to
+    :param normalize: (bool) whether the data is normalized
+    :param trim_first: (bool) whether the audio is trimmed before it is normalized
+    :return: (float) length (in seconds) to read, if None, read the whole file
+             (always the case with normalize=True and trim_first=False, e.g. the production run)
+    """
+    # when trimming, only the beginning of the file is needed unless the
+    # normalization statistics have to be computed over the whole track
+    if trim_dur > 0 and (trim_first or not normalize):
+        return trim_dur + RESAMPLE_GUARD
+    return None
+
+
+def postprocess_file(in_path, out_paths, target_srs=(22050,), to_mono=False, trim_dur=20.0, normalize=False,
+                     fade=True, trim_first=False, res_type=RES_TYPE, subtype=AUDIO_SUBTYPE, audio=None, write=None):
+    """
+    Postprocess a single WAV file after applying the source separation model.
+    The file is decoded once and one output is written for each target sample rate.
+
+    :param in_path: (str) path of the WAV file to process
+    :param out_paths: (list) paths of where to save the final stem WAV files, one per target sample rate
+    :param target_srs: (list) sample rates to resample the WAV file to
+    :param to_mono: (bool) whether to mix down stereo files to mono
+    :param trim_dur: (float) if positive, the max length (in seconds) to trim the clip down to
+                             if 0.0, do not trim the audio at all
+    :param normalize: (bool) whether to normalize data (center, amplitude)
+    :param fade: (bool) whether to add a fade at the beginning and end of the clip
+    :param trim_first: (bool) whether to trim the audio before normalizing it
+    :param res_type: (str) resampling filter, any res_type of librosa.resample (see constants.RES_TYPE)
+    :param subtype: (str) sample format of the final stems (see constants.AUDIO_SUBTYPE)
+    :param audio: (tuple) if given, (audio array, sample rate) already read from in_path,
+                          with load_audio(in_path, mono=to_mono, duration=read_duration(...))
+    :param write: (function) if given, function like audio_io.write_audio to save the files with,
+                             e.g. to queue them on a background writer (see parallel.run_jobs)
+    """
+    # load native sampling rate
+    # mix down to mono, if enabled
+    # otherwise, keep in stereo
+    if audio is None:
+        with phase("read"):
+            audio = load_audio(in_path, mono=to_mono, duration=read_duration(trim_dur, normalize, trim_first))
+    y, sr = audio
+    add_audio(y.shape[-1] / sr)
+
+    outputs = postprocess_audio(y, sr, target_srs=target_srs, trim_dur=trim_dur, normalize=normalize,
+                                fade=fade, trim_first=trim_first, res_type=res_type)
+
+    for out_path, target_sr, y_out in zip(out_paths, target_srs, outputs):
+        # save file
+        with phase("write"):
+            (write or write_audio)(out_path, y_out, target_sr, subtype=subtype)
 
+
+def postprocess(in_dir, out_dir, target_sr=22050, to_mono=False, trim_dur=20.0, normalize=False, fade=True,
+                trim_first=False, workers=1, force=False, profile=False, res_type=RES_TYPE, prefetch=PREFETCH_DEPTH,
+                write_behind=WRITE_BEHIND, audio_format=AUDIO_FORMAT, subtype=AUDIO_SUBTYPE,
+                shard=None, num_shards=1):
+    """
+    Postprocess WAV files after applying the source separation model.
+
+    Several target sample rates can be given at once, in which case each file is only
+    decoded once and all of the sample rate variants are written from that one decode.
+
+    When trimming, only the first trim_dur seconds of each file (plus a small guard band
+    for the resampling filter) are decoded and resampled, unless normalize=True and trim_first=False:
+    the normalization statistics then cover the whole track, so the whole file is decoded and resampled,
+    as in the production run (see __main__). trim_first=True enables the partial decode with normalize=True,
+    but normalizes with the statistics of the trimmed clip only, which changes the outputs.
+
+    Files that were already processed with the same contents and parameters, according to
+    the manifest kept in the (first) output directory, are skipped unless force is True.
+
+    With a single worker, the next files are read and the final stems are written on
+    background threads while the current file is processed (see parallel.run_jobs).
+
+    :param in_dir: (str) directory of WAV files to process
+    :param out_dir: (str or list) directory of where to save the final stems WAV files
+                                  if target_sr is a list, a list of directories, one per sample rate
+    :param target_sr: (int or list) sample rate(s) to resample all WAV files to
+                                    downsample to 22050 Hz because this is what
+                                    librosa uses by default to manage the computional load
+    :param to_mono: (bool) whether to mix down stereo files to mono
+    :param trim_dur: (float) if positive, the max length (in seconds) to trim the clip down to
+                             if 0.0, do not trim the audio at all
+    :param normalize: (bool) whether to normalize data (center, amplitude)
+    :param fade: (bool) whether to add a fade at the beginning and end of each clip
+    :param trim_first: (bool) whether to trim the audio before normalizing it
+                              if True, normalization statistics are computed over the trimmed clip only
+    :param workers: (int) number of worker processes to spread the files over
+    :param force: (bool) whether to reprocess files that were already processed
+    :param profile: (bool) whether to append per-file phase timings and a summary of the run
+                           to the profile file in the (first) output directory (see profiling.RunProfile)
+    :param res_type: (str) resampling filter, any res_type of librosa.resample (see constants.RES_TYPE)
+    :param prefetch: (int) with a single worker, number of files read ahead, if 0, read each file when it is processed
+    :param write_behind: (int) with a single worker, number of final stems that may be waiting to be written,
+                               if 0, write the stems of each file before processing the next one
+    :param audio_format: (str) storage format of the final stems, "WAV" or "FLAC" (see constants.AUDIO_FORMAT)
+    :param subtype: (str) sample format of the final stems (see constants.AUDIO_SUBTYPE)
+    :param shard: (int) shard of the input files to process, from 0 to num_shards - 1 (see shard.py)
+    :param num_shards: (int) number of shards the input files are split into, if 1, process every file
+    :return: (tuple) list of files that were processed, list of (file, error) for files that failed
+    """
+
+    # accept a single sample rate or a list of sample rates
+    if isinstance(target_sr, int):
+        target_srs = [target_sr]
+        out_dirs = [out_dir]
+    else:
+        target_srs = list(target_sr)
+        out_dirs = list(out_dir)
+    if len(target_srs) != len(out_dirs):
+        raise ValueError("There must be one output directory for each target sample rate!")
+
+    print("Loading list of files...")
+    # get all of the files in the input directory
+    file_list = os.listdir(in_dir)
+    print(f"There are {len(file_list)} files in the input directory.")
+    if num_shards > 1:
+        file_list = select_shard(file_list, shard, num_shards)
+        print(f"{len(file_list)} of them are in shard {shard} of {num_shards}.")
+
+    # create the output directories if they do not already exist
+    print("Creating output directory, if it does not already exist...")
+    for d in out_dirs:
+        os.makedirs(d, exist_ok=True)
+
+    # load the record of files that were already processed
+    manifest = shard_manifest(out_dirs[0], shard, num_shards)
+    params = {"target_srs": target_srs, "to_mono": to_mono, "trim_dur": trim_dur,
+              "normalize": normalize, "fade": fade, "trim_first": trim_first}
+    if res_type != LIBROSA_RES_TYPE:
+        # files processed before the resampler was configurable used the librosa default
+        params["res_type"] = res_type
+    params.update(storage_params(audio_format, subtype))
+
+    # create one job per file that still needs to be processed
+    jobs = []
+    paths = {}
+    for file in file_list:
+        # only process audio files
+        if is_audio_file(file):
+            in_path = os.path.join(in_dir, file)
+            name, _ = os.path.splitext(file)
+            out_file = name + "_Final" + audio_ext(audio_format)
+            out_paths = [os.path.join(d, out_file) for d in out_dirs]
+            if not force and manifest.is_done(file, in_path, params):
+                continue
+            paths[file] = (in_path, out_paths)
+            jobs.append((file, (in_path, out_paths, target_srs, to_mono, trim_dur, normalize, fade,
+                                trim_first, res_type, subtype)))
+    print(f"{len(jobs)} files need to be processed.")
+
+    # iterate through each file
+    print("Beginning to process files...")
+    print(f"Target Sampling Rate: {', '.join(str(sr) for sr in target_srs)} Hz")
+    print(f"Resampler: {res_type}")
+    print(f"Storage: {audio_format} {subtype}")
+    print(f"Number of workers: {workers}")
+
+    run_profile = None
+    if profile:
+        run_profile = RunProfile(shard_path(os.path.join(out_dirs[0], PROFILE_NAME), shard, num_shards),
+                                 "postprocess", {**params, "workers": workers})
+
+    processed = []
+    failed = []
+    load = None
+    if prefetch > 0:
+        load = functools.partial(load_audio, mono=to_mono, duration=read_duration(trim_dur, normalize, trim_first))
+    for file, _, error in run_jobs(postprocess_file, jobs, workers=workers, profile=run_profile,
+                                   load=load, write_behind=write_behind, prefetch_depth=prefetch):
+        if error is None:
+            processed.append(file)
+            in_path, out_paths = paths[file]
+            manifest.record(file, in_path, params, out_paths)
+        else:
+            failed.append((file, error))
+
+    if run_profile is not None:
+        run_profile.close()
+
+    report_failures(failed)
+    mark_done(out_dirs[0], shard, num_shards)
     print("Processing complete!")
 
+    return processed, failed
+
 
 if __name__ == '__main__':
     # run function
+    NUM_WORKERS = len(os.sched_getaffinity(0))
+    args = shard_args("Trim and resample the separated vocal stems.")
 
-    # 22.050 kHz
-    TARGET_SAMPLE_RATE = 22050
-    postprocess(INPUT_DIR, f"{OUTPUT_DIR}_{TARGET_SAMPLE_RATE}",
-                target_sr=TARGET_SAMPLE_RATE, to_mono=True, trim_dur=20.0,
-                normalize=True, fade=True)
-
-    # 44.1 kHZ
-    TARGET_SAMPLE_RATE = 44100
-    postprocess(INPUT_DIR, f"{OUTPUT_DIR}_{TARGET_SAMPLE_RATE}",
-                target_sr=TARGET_SAMPLE_RATE, to_mono=True, trim_dur=20.0,
-                normalize=True, fade=True)
+    # 22.050 kHz and 44.1 kHz from a single decode of each file
+    # the stems are normalized with the statistics of the whole track (trim_first=False), so every file is
+    # decoded and resampled in full, the partial decode of read_duration does not apply to this run
+    TARGET_SAMPLE_RATES = [22050, 44100]
+    postprocess(INPUT_DIR, [f"{OUTPUT_DIR}_{sr}" for sr in TARGET_SAMPLE_RATES],
+                target_sr=TARGET_SAMPLE_RATES, to_mono=True, trim_dur=20.0, normalize=True, fade=True,
+                trim_first=False, workers=NUM_WORKERS, shard=args.shard, num_shards=args.num_shards)
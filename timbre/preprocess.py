@@ -1,9 +1,13 @@
 import os
+import functools
 import numpy as np
 import librosa
-import soundfile as sf
-from tqdm import tqdm
+from constants import RES_TYPE, LIBROSA_RES_TYPE, AUDIO_FORMAT, AUDIO_SUBTYPE
 from utils import normalize_data, fade_in_out
+from parallel import run_jobs, report_failures
+from audio_io import write_audio, audio_ext, is_audio_file, storage_params, PREFETCH_DEPTH, WRITE_BEHIND
+from shard import select_shard, shard_path, shard_manifest, shard_args, mark_done
+from profiling import phase, add_audio, RunProfile, PROFILE_NAME
 
 
 # set input and output directories
@@ -11,68 +15,195 @@ INPUT_DIR = "/scratch/rn2214/data/choruses"
 OUTPUT_DIR = "/scratch/rn2214/data/standardized"
 
 
-def preprocess(in_dir, out_dir, target_sr=44100, to_mono=False, normalize=False, fade=True):
+def preprocess_audio(y, sr, target_sr=44100, normalize=False, fade=True, res_type=RES_TYPE):
+    """
+    Preprocess an audio array.
+
+    :param y: (np.array) audio array (channels first if stereo)
+    :param sr: (int) sample rate of the audio array
+    :param target_sr: (int) sample rate to resample the audio to
+    :param normalize: (bool) whether to normalize data (center, amplitude)
+    :param fade: (bool) whether to add a fade at the beginning and end of the clip
+    :param res_type: (str) resampling filter, any res_type of librosa.resample (see constants.RES_TYPE)
+    :return: (np.array) processed audio array, at the target sample rate
+    """
+    # resample to target sampling rate
+    with phase("resample"):
+        y_hat = librosa.resample(y, orig_sr=sr, target_sr=target_sr, res_type=res_type)
+    if y_hat is y:
+        # already at the target sampling rate, copy so the in-place steps below leave y untouched
+        y_hat = y.copy()
+
+    with phase("dsp"):
+        if normalize:
+            # normalize data to have a mean of 0, standard deviation of 1
+            # scale between -1 and 1
+            y_norm = normalize_data(y_hat, out=y_hat)
+        else:
+            y_norm = y_hat
+
+        if fade:
+            # add a 0.5 second fade in and out to the audio
+            y_out = fade_in_out(y_norm, target_sr, duration=0.5, out=y_norm)
+        else:
+            y_out = y_norm
+
+    return y_out
+
+
+def read_input(in_path, to_mono=False):
+    """
+    Read a WAV file to preprocess at its native sample rate.
+
+    :param in_path: (str) path of the WAV file
+    :param to_mono: (bool) whether to downmix stereo files to mono
+    :return: (tuple) audio array (channels first if stereo), native sample rate
+    """
+    return librosa.load(in_path, sr=None, mono=to_mono)
+
+
+def preprocess_file(in_path, out_path, target_sr=44100, to_mono=False, normalize=False, fade=True,
+                    res_type=RES_TYPE, subtype=AUDIO_SUBTYPE, audio=None, write=None):
+    """
+    Preprocess a single WAV file.
+
+    :param in_path: (str) path of the WAV file to process
+    :param out_path: (str) path of where to save the processed WAV file
+    :param target_sr: (int) sample rate to resample the WAV file to
+    :param to_mono: (bool) whether to downmix stereo files to mono
+    :param normalize: (bool) whether to normalize data (center, amplitude)
+    :param fade: (bool) whether to add a fade at the beginning and end of the clip
+    :param res_type: (str) resampling filter, any res_type of librosa.resample (see constants.RES_TYPE)
+    :param subtype: (str) sample format of the processed file (see constants.AUDIO_SUBTYPE)
+    :param audio: (tuple) if given, (audio array, sample rate) already read from in_path (see read_input)
+    :param write: (function) if given, function like audio_io.write_audio to save the file with,
+                             e.g. to queue it on a background writer (see parallel.run_jobs)
+    """
+    # load native sampling rate
+    # mix down to mono, if enabled
+    # otherwise, keep in stereo
+    if audio is None:
+        with phase("read"):
+            audio = read_input(in_path, to_mono=to_mono)
+    y, sr = audio
+    add_audio(y.shape[-1] / sr)
+
+    y_out = preprocess_audio(y, sr, target_sr=target_sr, normalize=normalize, fade=fade, res_type=res_type)
+
+    # save file
+    with phase("write"):
+        (write or write_audio)(out_path, y_out, target_sr, subtype=subtype)
+
+
+def preprocess(in_dir, out_dir, target_sr=44100, to_mono=False, normalize=False, fade=True, workers=1, force=False,
+               profile=False, res_type=RES_TYPE, prefetch=PREFETCH_DEPTH, write_behind=WRITE_BEHIND,
+               audio_format=AUDIO_FORMAT, subtype=AUDIO_SUBTYPE, shard=None, num_shards=1):
     """
     Preprocess WAV files.
 
+    Files that were already processed with the same contents and parameters, according to
+    the manifest kept in the output directory, are skipped unless force is True.
+
+    With a single worker, the next files are read and the processed files are written on
+    background threads while the current file is processed (see parallel.run_jobs).
+
     :param in_dir: (str) directory of WAV files to process
     :param out_dir: (str) directory of where to save the processed WAV files
     :param target_sr: (int) sample rate to resample all WAV files to
     :param to_mono: (bool) whether to downmix stereo files to mono
     :param normalize: (bool) whether to normalize data (center, amplitude)
+    :param fade: (bool) whether to add a fade at the beginning and end of each clip
+    :param workers: (int) number of worker processes to spread the files over
+    :param force: (bool) whether to reprocess files that were already processed
+    :param profile: (bool) whether to append per-file phase timings and a summary of the run
+                           to the profile file in the output directory (see profiling.RunProfile)
+    :param res_type: (str) resampling filter, any res_type of librosa.resample (see constants.RES_TYPE)
+    :param prefetch: (int) with a single worker, number of files read ahead, if 0, read each file when it is processed
+    :param write_behind: (int) with a single worker, number of processed files that may be waiting to be written,
+                               if 0, write each file before processing the next one
+    :param audio_format: (str) storage format of the processed files, "WAV" or "FLAC" (see constants.AUDIO_FORMAT)
+    :param subtype: (str) sample format of the processed files (see constants.AUDIO_SUBTYPE)
+    :param shard: (int) shard of the input files to process, from 0 to num_shards - 1 (see shard.py)
+    :param num_shards: (int) number of shards the input files are split into, if 1, process every file
+    :return: (tuple) list of files that were processed, list of (file, error) for files that failed
     """
 
     print("Loading list of files...")
     # get all of the files in the input directory
     file_list = os.listdir(in_dir)
     print(f"There are {len(file_list)} files in the input directory.")
+    if num_shards > 1:
+        file_list = select_shard(file_list, shard, num_shards)
+        print(f"{len(file_list)} of them are in shard {shard} of {num_shards}.")
 
     # create the output directory if it does not already exist
     print("Creating output directory, if it does not already exist...")
     os.makedirs(out_dir, exist_ok=True)
 
+    # load the record of files that were already processed
+    manifest = shard_manifest(out_dir, shard, num_shards)
+    params = {"target_sr": target_sr, "to_mono": to_mono, "normalize": normalize, "fade": fade}
+    if res_type != LIBROSA_RES_TYPE:
+        # files processed before the resampler was configurable used the librosa default
+        params["res_type"] = res_type
+    params.update(storage_params(audio_format, subtype))
+
+    # create one job per file that still needs to be processed
+    jobs = []
+    paths = {}
+    for file in file_list:
+        # only process audio files
+        if is_audio_file(file):
+            in_path = os.path.join(in_dir, file)
+            name, _ = os.path.splitext(file)
+            out_file = name + "_Standardized" + audio_ext(audio_format)
+            out_path = os.path.join(out_dir, out_file)
+            if not force and manifest.is_done(file, in_path, params):
+                continue
+            paths[file] = (in_path, out_path)
+            jobs.append((file, (in_path, out_path, target_sr, to_mono, normalize, fade, res_type, subtype)))
+    print(f"{len(jobs)} files need to be processed.")
+
     # iterate through each file
     print("Beginning to process files...")
     print(f"Target Sampling Rate: {target_sr} Hz")
-
-    for i in tqdm(range(len(file_list))):
-        # only process .wav files
-        if file_list[i].endswith(".wav"):
-            # read the soundfile
-            in_path = os.path.join(in_dir, file_list[i])
-
-            # load native sampling rate
-            # mix down to mono, if enabled
-            # otherwise, keep in stereo
-            y, sr = librosa.load(in_path, sr=None, mono=to_mono)
-
-            # resample to target sampling rate
-            y_hat = librosa.resample(y, orig_sr=sr, target_sr=target_sr)
-
-            if normalize:
-                # normalize data to have a mean of 0, standard deviation of 1
-                # scale between -1 and 1
-                y_norm = normalize_data(y_hat)
-            else:
-                y_norm = y_hat
-
-            if fade:
-                # add a 0.5 second fade in and out to the audio
-                y_out = fade_in_out(y_norm, target_sr, duration=0.5)
-            else:
-                y_out = y_norm
-
-            # save file
-            name, ext = file_list[i].split('.')
-            out_file = name + "_Standardized." + ext
-            out_path = os.path.join(out_dir, out_file)
-            sf.write(out_path, y_out.T, target_sr)
-
+    print(f"Resampler: {res_type}")
+    print(f"Storage: {audio_format} {subtype}")
+    print(f"Number of workers: {workers}")
+
+    run_profile = None
+    if profile:
+        run_profile = RunProfile(shard_path(os.path.join(out_dir, PROFILE_NAME), shard, num_shards),
+                                 "preprocess", {**params, "workers": workers})
+
+    processed = []
+    failed = []
+    load = functools.partial(read_input, to_mono=to_mono) if prefetch > 0 else None
+    for file, _, error in run_jobs(preprocess_file, jobs, workers=workers, profile=run_profile,
+                                   load=load, write_behind=write_behind, prefetch_depth=prefetch):
+        if error is None:
+            processed.append(file)
+            in_path, out_path = paths[file]
+            manifest.record(file, in_path, params, [out_path])
+        else:
+            failed.append((file, error))
+
+    if run_profile is not None:
+        run_profile.close()
+
+    report_failures(failed)
+    mark_done(out_dir, shard, num_shards)
     print("Processing complete!")
 
+    return processed, failed
+
 
 if __name__ == '__main__':
-	# run function
-	preprocess(INPUT_DIR, OUTPUT_DIR,
+    # run function
+    NUM_WORKERS = len(os.sched_getaffinity(0))
+    args = shard_args("Standardize the choruses.")
+
+    preprocess(INPUT_DIR, OUTPUT_DIR,
                target_sr=44100, to_mono=False,
-               normalize=False, fade=True)
+               normalize=False, fade=True,
+               workers=NUM_WORKERS, shard=args.shard, num_shards=args.num_shards)
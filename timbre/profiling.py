@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import uuid
+import resource
+from contextlib import contextmanager
+
+
+# name of the profile file kept in each output directory
+PROFILE_NAME = "profile.jsonl"
+
+# phase timings and audio duration of the file the current process is working on, see reset and collect
+# the stages time their work under these phase names:
+#     read:      decoding audio files and reading cached spectrograms
+#     resample:  sample rate conversion
+#     dsp:       normalizing, trimming, fading and mixing down
+#     inference: separation and embedding models
+#     features:  spectrograms, MFCCs and their statistics
+#     plot:      drawing figures
+#     write:     writing audio files, features, plots and cache entries
+_phases = {}
+_audio_sec = 0.0
+_start = time.perf_counter()
+
+
+def reset():
+    """
+    Start timing a new file in the current process.
+    """
+    global _phases, _audio_sec, _start
+    _phases = {}
+    _audio_sec = 0.0
+    _start = time.perf_counter()
+
+
+@contextmanager
+def phase(name):
+    """
+    Add the time spent in a with block to a phase of the current file.
+
+    :param name: (str) name of the phase
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases[name] = _phases.get(name, 0.0) + time.perf_counter() - start
+
+
+def add_audio(seconds):
+    """
+    Add to the duration of the audio processed for the current file.
+
+    :param seconds: (float) duration of audio in seconds
+    """
+    global _audio_sec
+    _audio_sec += seconds
+
+
+def peak_rss_mb():
+    """
+    :return: (float) peak resident memory of the current process so far, in MiB
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def collect():
+    """
+    Get the timings of the current file, since the last call to reset.
+
+    :return: (dict) total time, time per phase (in seconds), duration of the audio processed,
+                    peak memory and process id
+    """
+    return {
+        "total_sec": time.perf_counter() - _start,
+        "phases": dict(_phases),
+        "audio_sec": _audio_sec,
+        "peak_rss_mb": peak_rss_mb(),
+        "pid": os.getpid(),
+    }
+
+
+class RunProfile:
+    """
+    Machine-readable profile of a run of a stage, written as JSON lines.
+
+    One "file" line is appended for each file, with the timings from collect, and one "run" line
+    is appended by close, with the wall time, files/sec and audio-seconds/sec of the whole run,
+    the total time of each phase, and the peak memory of any of the processes of the run.
+    The lines of a run share a run id, so that several runs can be appended to the same file.
+    """
+
+    def __init__(self, path, stage, params=None):
+        """
+        :param path: (str) path of the profile file, created if it does not already exist
+        :param stage: (str) name of the stage
+        :param params: (dict) parameters of the run, stored with the run summary
+        """
+        self.path = path
+        self.stage = stage
+        self.params = params if params is not None else {}
+        self.run_id = uuid.uuid4().hex[:12]
+        self._start = time.perf_counter()
+        self._started_at = time.time()
+
+        # totals over the files of the run
+        self.num_files = 0
+        self.num_failed = 0
+        self.audio_sec = 0.0
+        self.phases = {}
+        self.peak_rss_mb = 0.0
+
+    def _write(self, entry):
+        # append and flush right away so the lines survive a crash
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def record(self, name, profile, error=None):
+        """
+        Record the timings of a file.
+
+        :param name: (str) name of the file
+        :param profile: (dict) timings of the file, from collect
+        :param error: (str) error message if the file failed, None if it succeeded
+        """
+        self.num_files += 1
+        if error is not None:
+            self.num_failed += 1
+        self.audio_sec += profile["audio_sec"]
+        for key, sec in profile["phases"].items():
+            self.phases[key] = self.phases.get(key, 0.0) + sec
+        self.peak_rss_mb = max(self.peak_rss_mb, profile["peak_rss_mb"])
+
+        self._write({"type": "file", "run": self.run_id, "stage": self.stage, "name": name,
+                     "ok": error is None, **profile})
+
+    def close(self):
+        """
+        Write the summary of the run.
+
+        :return: (dict) summary of the run
+        """
+        wall_sec = time.perf_counter() - self._start
+        summary = {
+            "type": "run",
+            "run": self.run_id,
+            "stage": self.stage,
+            "started_at": self._started_at,
+            "params": self.params,
+            "num_files": self.num_files,
+            "num_failed": self.num_failed,
+            "wall_sec": wall_sec,
+            "files_per_sec": self.num_files / max(wall_sec, 1e-9),
+            "audio_sec": self.audio_sec,
+            "audio_sec_per_sec": self.audio_sec / max(wall_sec, 1e-9),
+            "phases": self.phases,
+            "peak_rss_mb": max(self.peak_rss_mb, peak_rss_mb()),
+        }
+        self._write(summary)
+
+        phases = ", ".join(f"{key} {sec:.1f}s" for key, sec in sorted(self.phases.items(), key=lambda p: -p[1]))
+        print(f"Profile: {summary['files_per_sec']:.2f} files/sec, "
+              f"{summary['audio_sec_per_sec']:.1f} audio sec/sec ({phases}), written to {self.path}")
+
+        return summary
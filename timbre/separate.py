@@ -1,85 +1,399 @@
 import os
-import torch
+import threading
+import multiprocessing
 import numpy as np
 import soundfile as sf
-from demucs import pretrained
-from demucs.apply import apply_model
+from shard import select_shard, shard_path, shard_manifest, shard_args, mark_done
+from models import get_separation_model, ModelClient
+from parallel import run_jobs, report_failures
+from audio_io import (read_audio, write_audio, audio_ext, is_audio_file, audio_length, storage_params,
+                      PREFETCH_DEPTH, WRITE_BEHIND)
+from constants import AUDIO_FORMAT, AUDIO_SUBTYPE
+from profiling import phase, add_audio, RunProfile, PROFILE_NAME
 
 # set input and output directories
 INPUT_DIR = "/scratch/rn2214/data/standardized"
 OUTPUT_DIR = "/scratch/rn2214/data/separated"
 
+# settings for streaming separation (see separate_file_streaming)
+# length (in seconds) of the audio separated at a time
+SEGMENT_DUR = 30.0
+# overlap (in seconds) between consecutive segments, crossfaded when stitching
+OVERLAP_DUR = 2.0
 
-def separate(in_dir, out_dir, model_name='htdemucs', gpu=True):
+# model and device of the current worker process, or connection to a model server, set by init_worker
+_worker_model = None
+_worker_device = None
+_worker_client = None
+
+
+def init_worker(model_name='htdemucs', num_threads=None, gpu=False, server=None):
+    """
+    Load a separation model into the current process, so that it can be reused for every file
+    the process separates.
+
+    :param model_name: (str) name of the pretrained demucs model to use, or path of a saved model
+    :param num_threads: (int) number of threads torch may use in this process,
+                              if None, keep the torch default
+    :param gpu: (bool) whether to run the model on the current gpu device
+    :param server: (str or tuple) if given, address of a model server to send the files to
+                                  instead of loading the model (see model_server.py)
+    """
+    global _worker_model, _worker_device, _worker_client
+
+    if server is not None:
+        _worker_client = ModelClient(server)
+        return
+
+    import torch
+    if num_threads is not None:
+        # fixed thread budget, so that several workers can share the cpu without oversubscribing it
+        torch.set_num_threads(num_threads)
+
+    print("Loading pretrained model...")
+    _worker_model = get_separation_model(model_name)
+    print("Model loaded successfully.")
+    _worker_device = torch.cuda.current_device() if gpu else None
+
+
+def separate_audio(model, y, device=None, shifts=1):
+    """
+    Separate the vocal stem of an audio array.
+
+    :param model: (torch.nn.Module) pretrained demucs model
+    :param y: (np.array) audio array, of shape (num_channels, num_samples) or (num_samples,) if mono
+    :param device: (int or str) device to run the model on, if None use the cpu
+    :param shifts: (int) number of random shifts to average the model output over
+    :return: (np.array) vocal stem as float32, of shape (2, num_samples)
+    """
+    # torch and demucs are only imported when a model is run (see models.py)
+    import torch
+    from demucs.apply import apply_model
+
+    # check if audio is in mono
+    if len(y.shape) == 1:
+        # if the audio is in mono,
+        # duplicate channels to create a stereo track
+        # demucs network expects two channels of audio
+        y = np.stack([y, y])
+
+    # convert to 3 dimensional tensor (1, num_channels, num_samples)
+    x = torch.from_numpy(np.ascontiguousarray(y, dtype=np.float32)).unsqueeze(0)
+
+    # output is [1, S, C, T] where S is the number of sources
+    with phase("inference"):
+        out = apply_model(model, x, shifts=shifts, device=device)
+
+    # vocals are the 4th source
+    # drums.wav, bass.wav, other.wav, vocals.wav
+    vox = out[0][3]
+
+    # convert tensor back to numpy array
+    return np.array(vox.cpu())
+
+
+def separate_file(model, in_path, out_path, device=None, shifts=1, subtype=AUDIO_SUBTYPE, audio=None, write=None):
+    """
+    Separate the vocal stem of a single WAV file.
+
+    :param model: (torch.nn.Module) pretrained demucs model
+    :param in_path: (str) path of the WAV file to run source separation model on
+    :param out_path: (str) path of where to save the separated vocal stem
+    :param device: (int or str) device to run the model on, if None use the cpu
+    :param shifts: (int) number of random shifts to average the model output over
+    :param subtype: (str) sample format of the vocal stem (see constants.AUDIO_SUBTYPE)
+    :param audio: (tuple) if given, (audio array, sample rate) already read from in_path with read_audio
+    :param write: (function) if given, function like audio_io.write_audio to save the stem with,
+                             e.g. to queue it on a background writer (see parallel.run_jobs)
+    """
+    # read the soundfile, channels first
+    if audio is None:
+        with phase("read"):
+            audio = read_audio(in_path)
+    y, sr = audio
+    add_audio(y.shape[-1] / sr)
+
+    vox = separate_audio(model, y, device=device, shifts=shifts)
+
+    # save file
+    with phase("write"):
+        (write or write_audio)(out_path, vox, sr, subtype=subtype)
+
+
+def separate_file_streaming(model, in_path, out_path, device=None, segment_dur=SEGMENT_DUR,
+                            overlap_dur=OVERLAP_DUR, shifts=1, subtype=AUDIO_SUBTYPE):
+    """
+    Separate the vocal stem of a single WAV file one segment at a time,
+    writing the vocals to disk as they are produced.
+
+    Only one segment of audio and its separated sources are held in memory at a time,
+    so peak memory is set by segment_dur rather than by the length of the track.
+    Consecutive segments overlap and are stitched together with a linear crossfade.
+
+    Memory/throughput tradeoffs:
+        - segment_dur: longer segments use more memory but have fewer seams and less per-call overhead
+        - overlap_dur: longer overlaps give smoother seams but separate overlap_dur / segment_dur more audio
+        - shifts: number of random shifts demucs averages over, better quality for shifts times the compute
+
+    :param model: (torch.nn.Module) pretrained demucs model
+    :param in_path: (str) path of the WAV file to run source separation model on
+    :param out_path: (str) path of where to save the separated vocal stem
+    :param device: (int or str) device to run the model on, if None use the cpu
+    :param segment_dur: (float) length (in seconds) of the audio separated at a time
+    :param overlap_dur: (float) overlap (in seconds) between consecutive segments
+    :param shifts: (int) number of random shifts to average the model output over
+    """
+    import torch
+    from demucs.apply import apply_model
+
+    # index of the vocals in the model output
+    vocals = model.sources.index("vocals")
+
+    with sf.SoundFile(in_path) as f_in:
+        sr = f_in.samplerate
+        num_frames = f_in.frames
+        add_audio(num_frames / sr)
+
+        # segment length and overlap in samples
+        seg_len = int(segment_dur * sr)
+        ov_len = int(overlap_dur * sr)
+        if ov_len >= seg_len:
+            raise ValueError("The overlap must be shorter than the segment!")
+        hop = seg_len - ov_len
+
+        # stream into a temporary file next to out_path and rename it into place once the whole stem is written,
+        # so that an interrupted or failed separation never leaves a partial stem at out_path (see write_audio)
+        root, ext = os.path.splitext(out_path)
+        tmp_path = f"{root}.{os.getpid()}.{threading.get_ident()}.tmp{ext}"
+        try:
+            with sf.SoundFile(tmp_path, "w", samplerate=sr, channels=2, subtype=subtype) as f_out:
+                tail = None
+                start = 0
+                while start < num_frames:
+                    # read the next segment as (num_samples, num_channels)
+                    with phase("read"):
+                        f_in.seek(start)
+                        y = f_in.read(seg_len, dtype="float32", always_2d=True)
+
+                    # demucs network expects two channels of audio
+                    # if the audio is in mono, duplicate the channel
+                    if y.shape[1] == 1:
+                        y = np.repeat(y, 2, axis=1)
+
+                    # convert to 3 dimensional tensor (1, num_channels, num_samples)
+                    x = torch.from_numpy(np.ascontiguousarray(y.T)).unsqueeze(0)
+
+                    # output is [1, S, C, T] where S is the number of sources
+                    # only keep the vocals so the other sources can be freed right away
+                    with phase("inference"), torch.no_grad():
+                        out = apply_model(model, x, shifts=shifts, device=device)
+                    vox = out[0, vocals].cpu().numpy().T
+                    del out
+
+                    # crossfade with the end of the previous segment
+                    if tail is not None:
+                        n = min(len(tail), len(vox))
+                        fade = np.linspace(0.0, 1.0, n, dtype=np.float32)[:, None]
+                        vox[:n] = tail[:n] * (1.0 - fade) + vox[:n] * fade
+
+                    if start + seg_len >= num_frames:
+                        # last segment, write everything
+                        with phase("write"):
+                            f_out.write(vox)
+                        break
+
+                    # hold back the overlap until the next segment is separated
+                    keep = len(vox) - ov_len
+                    with phase("write"):
+                        f_out.write(vox[:keep])
+                    tail = vox[keep:]
+                    start += hop
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    os.replace(tmp_path, out_path)
+
+
+def separate_job(in_path, out_path, stream=False, segment_dur=SEGMENT_DUR, overlap_dur=OVERLAP_DUR, shifts=1,
+                 subtype=AUDIO_SUBTYPE, audio=None, write=None):
+    """
+    Separate the vocal stem of a single WAV file with the model loaded by init_worker.
+
+    :param in_path: (str) path of the WAV file to run source separation model on
+    :param out_path: (str) path of where to save the separated vocal stem
+    :param stream: (bool) whether to separate the file segment by segment
+    :param segment_dur: (float) if streaming, length (in seconds) of the audio separated at a time
+    :param overlap_dur: (float) if streaming, overlap (in seconds) between consecutive segments
+    :param shifts: (int) number of random shifts to average the model output over
+    :param audio: (tuple) if given, (audio array, sample rate) already read from in_path with read_audio,
+                          not used when streaming or separating on a model server
+    :param write: (function) if given, function like audio_io.write_audio to save the stem with,
+                             not used when streaming or separating on a model server
+    """
+    if _worker_client is not None:
+        # separated by the model server
+        add_audio(sf.info(in_path).duration)
+        with phase("inference"):
+            _worker_client.separate(os.path.abspath(in_path), os.path.abspath(out_path), stream=stream,
+                                    segment_dur=segment_dur, overlap_dur=overlap_dur, shifts=shifts, subtype=subtype)
+        return
+
+    if stream:
+        separate_file_streaming(_worker_model, in_path, out_path, device=_worker_device,
+                                segment_dur=segment_dur, overlap_dur=overlap_dur, shifts=shifts, subtype=subtype)
+    else:
+        separate_file(_worker_model, in_path, out_path, device=_worker_device, shifts=shifts, subtype=subtype,
+                      audio=audio, write=write)
+
+
+def separate(in_dir, out_dir, model_name='htdemucs', gpu=True, force=False, stream=False,
+             segment_dur=SEGMENT_DUR, overlap_dur=OVERLAP_DUR, shifts=1, workers=1, threads=None,
+             profile=False, server=None, prefetch=PREFETCH_DEPTH, write_behind=WRITE_BEHIND,
+             audio_format=AUDIO_FORMAT, subtype=AUDIO_SUBTYPE, shard=None, num_shards=1):
     """
     Run Demucs source separation model on WAV files to isolate vocal stems.
 
+    Files that were already separated with the same contents and model, according to
+    the manifest kept in the output directory, are skipped unless force is True.
+
+    With stream=True, each file is separated segment by segment and only the vocals are
+    kept and written to disk as they are produced, which bounds peak memory on long tracks
+    (see separate_file_streaming for the segment_dur/overlap_dur/shifts tradeoffs).
+
+    On the cpu, several files can be separated at once by worker processes that each hold
+    their own copy of the model and use a fixed number of torch threads. Files are handed
+    out longest first, so that one long song does not hold up the end of the run.
+
+    With a single process (e.g. on the gpu), the next files are read and the separated stems
+    are written on background threads while the model runs (see parallel.run_jobs), unless streaming.
+
     :param in_dir: (str) directory of WAV files to run source separation model on
     :param out_dir: (str) directory of where to save the separated vocal stems
     :param model_name: (str) name of the pretrained demucs model to use,
                         default model is the hybrid transformer demucs
     :param gpu: (bool) if a gpu is available for use, set to True
+    :param force: (bool) whether to reprocess files that were already processed
+    :param stream: (bool) whether to separate each file segment by segment
+    :param segment_dur: (float) if streaming, length (in seconds) of the audio separated at a time
+    :param overlap_dur: (float) if streaming, overlap (in seconds) between consecutive segments
+    :param shifts: (int) number of random shifts to average the model output over
+    :param workers: (int) number of separation worker processes, only used on the cpu
+    :param threads: (int) number of torch threads per worker,
+                          if None, the available cores are split evenly between the workers
+    :param profile: (bool) whether to append per-file phase timings and a summary of the run
+                           to the profile file in the output directory (see profiling.RunProfile)
+    :param server: (str or tuple) if given, address of a model server that keeps the model loaded
+                                  (see model_server.py), files are sent to it one at a time instead of
+                                  loading the model in this run, gpu and threads are ignored and model_name is
+                                  replaced by the name of the model of the server
+    :param prefetch: (int) with a single process, number of files read ahead, if 0, read each file when it is separated
+    :param write_behind: (int) with a single process, number of stems that may be waiting to be written,
+                               if 0, write each stem before separating the next file
+    :param audio_format: (str) storage format of the vocal stems, "WAV" or "FLAC" (see constants.AUDIO_FORMAT)
+    :param subtype: (str) sample format of the vocal stems (see constants.AUDIO_SUBTYPE)
+    :param shard: (int) shard of the input files to process, from 0 to num_shards - 1 (see shard.py)
+    :param num_shards: (int) number of shards the input files are split into, if 1, process every file
+    :return: (tuple) list of files that were processed, list of (file, error) for files that failed
     """
     # get all of the files in the input directory
     print("Loading list of files...")
     file_list = os.listdir(in_dir)
     print(f"There are {len(file_list)} files in the input directory.")
+    if num_shards > 1:
+        file_list = select_shard(file_list, shard, num_shards)
+        print(f"{len(file_list)} of them are in shard {shard} of {num_shards}.")
 
     # create the output directory if it does not already exist
     print("Creating output directory, if it does not already exist...")
     os.makedirs(out_dir, exist_ok=True)
 
-    # load the model
-    print("Loading pretrained model...")
-    model = pretrained.get_model(model_name)
-    print("Model loaded successfully.")
+    if server is not None:
+        # the files are separated with the model of the server, which is the one to record
+        with ModelClient(server) as client:
+            model_name = client.info()["model_name"]
+        print(f"Separating files on the model server at {server}, with {model_name}.")
 
-    # iterate through each file
-    print("Beginning to process files...")
+    # load the record of files that were already processed
+    manifest = shard_manifest(out_dir, shard, num_shards)
+    params = {"model_name": model_name, "shifts": shifts}
+    if stream:
+        params.update({"segment_dur": segment_dur, "overlap_dur": overlap_dur})
+    params.update(storage_params(audio_format, subtype))
+
+    # create one job per file that still needs to be processed
+    jobs = []
+    paths = {}
     for file in file_list:
-        # only process wav files
-        if file.endswith(".wav"):
-            # read the soundfile
+        # only process audio files
+        if is_audio_file(file):
             in_path = os.path.join(in_dir, file)
-            y, sr = sf.read(in_path)
-
-            # check if audio is in mono
-            if len(y.shape) == 1:
-                # if the audio is in mono,
-                # duplicate channels to create a stereo track
-                # demucs network expects two channels of audio
-                y = np.vstack([y, y])
-
-            # get dimensions
-            num_samples, num_channels = y.shape
-
-            # convert to 3 dimensional tensor (1, num_channels, num_samples)
-            x = torch.from_numpy(y.T.reshape(1, num_channels, num_samples).astype(np.float32))
-
-            # output is [1, S, C, T] where S is the number of sources
-            if gpu:
-                # use current gpu device
-                out = apply_model(model, x, progress=True, device=torch.cuda.current_device())
-            else:
-                # use cpu
-                out = apply_model(model, x, progress=True)
-
-            # vocals are the 4th source
-            # drums.wav, bass.wav, other.wav, vocals.wav
-            vox = out[0][3]
-
-            # convert tensor back to numpy array
-            vox_np = np.array(vox).T
-
-            # save file
-            name, ext = file.split('.')
-            out_file = name + "_Vox." + ext
+            name, _ = os.path.splitext(file)
+            out_file = name + "_Vox" + audio_ext(audio_format)
             out_path = os.path.join(out_dir, out_file)
-            sf.write(out_path, vox_np, sr)
 
+            # skip files that were already separated
+            if not force and manifest.is_done(file, in_path, params):
+                continue
+
+            paths[file] = (in_path, out_path)
+            jobs.append((file, (in_path, out_path, stream, segment_dur, overlap_dur, shifts, subtype)))
+    print(f"{len(jobs)} files need to be processed.")
+
+    # a gpu is shared by a single process, and a model server runs one file at a time
+    if gpu or server is not None:
+        workers = 1
+
+    if workers > 1:
+        if threads is None:
+            threads = max(1, len(os.sched_getaffinity(0)) // workers)
+
+        # longest files first
+        jobs.sort(key=lambda job: audio_length(job[1][0]), reverse=True)
+
+    # each worker loads its own copy of the model in init_worker
+    # workers are started as fresh processes rather than forks of a process that already initialized torch
+    print(f"Storage: {audio_format} {subtype}")
+    print(f"Number of workers: {workers}, threads per worker: {threads}")
+
+    # iterate through each file
+    print("Beginning to process files...")
+    run_profile = None
+    if profile:
+        run_profile = RunProfile(shard_path(os.path.join(out_dir, PROFILE_NAME), shard, num_shards),
+                                 "separate",
+                                 {**params, "stream": stream, "gpu": gpu, "workers": workers, "threads": threads})
+
+    processed = []
+    failed = []
+    # streamed files and files separated by a model server are read and written segment by segment
+    # or by the server, not as whole arrays in this process
+    overlap_io = not stream and server is None
+    load = read_audio if overlap_io and prefetch > 0 else None
+    for file, _, error in run_jobs(separate_job, jobs, workers=workers,
+                                   initializer=init_worker, initargs=(model_name, threads, gpu, server),
+                                   mp_context=multiprocessing.get_context("spawn"), profile=run_profile,
+                                   load=load, write_behind=write_behind if overlap_io else 0,
+                                   prefetch_depth=prefetch):
+        if error is None:
+            processed.append(file)
+            in_path, out_path = paths[file]
+            manifest.record(file, in_path, params, [out_path])
+        else:
+            failed.append((file, error))
+
+    if run_profile is not None:
+        run_profile.close()
+
+    report_failures(failed)
+    mark_done(out_dir, shard, num_shards)
     print("Processing complete!")
 
+    return processed, failed
+
 
 if __name__ == '__main__':
     # run function
-    separate(INPUT_DIR, OUTPUT_DIR)
+    args = shard_args("Separate the vocals of the standardized choruses.")
+    separate(INPUT_DIR, OUTPUT_DIR, shard=args.shard, num_shards=args.num_shards)
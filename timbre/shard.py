@@ -0,0 +1,352 @@
+import os
+import re
+import json
+import shutil
+import pickle
+import hashlib
+import filecmp
+import argparse
+import multiprocessing
+from manifest import Manifest, MANIFEST_NAME
+from feature_store import FeatureStore, stored_names, DATA_FILES, STALE_FRACTION
+
+
+# sharded runs write their manifests, profiles, feature stores and pickles next to the merged ones,
+# with the shard in the name, e.g. manifest.shard-3-of-8.jsonl or all_mfccs_13.shard-3-of-8
+SHARD_PATTERN = re.compile(r"^(?P<root>.+)\.shard-(?P<shard>\d+)-of-(?P<num_shards>\d+)(?P<ext>\.[^.]*)?$")
+
+# name of the file a shard writes to its output directory when it has finished, e.g. shard_done.shard-3-of-8,
+# only the files of finished shards are merged
+DONE_NAME = "shard_done"
+
+# files every FeatureStore has, any other file of a store (e.g. the principal components of
+# a reduced embedding store) has to be the same in every shard
+STORE_FILES = {"meta.json", "names.txt", "offsets.i64", "timestamps.f32", *DATA_FILES.values()}
+
+
+def shard_of(name, num_shards):
+    """
+    Get the shard a file belongs to, from the hash of its name, so that every node of a job array
+    agrees on it without coordinating, whatever order it lists the input directory in.
+    Adding files to the input directory does not move the other files to another shard.
+
+    :param name: (str) name of the file
+    :param num_shards: (int) number of shards
+    :return: (int) shard of the file, from 0 to num_shards - 1
+    """
+    return int(hashlib.sha1(name.encode()).hexdigest()[:8], 16) % num_shards
+
+
+def select_shard(file_list, shard=None, num_shards=1):
+    """
+    Keep the files of a shard.
+
+    :param file_list: (list) names of the files
+    :param shard: (int) shard to keep, from 0 to num_shards - 1
+    :param num_shards: (int) number of shards, if 1, keep every file
+    :return: (list) names of the files of the shard, in the order of file_list
+    """
+    if num_shards <= 1:
+        return file_list
+    if shard is None or not 0 <= shard < num_shards:
+        raise ValueError(f"The shard must be from 0 to {num_shards - 1}, not {shard}!")
+    return [file for file in file_list if shard_of(file, num_shards) == shard]
+
+
+def shard_path(path, shard=None, num_shards=1):
+    """
+    Get the path a shard writes to instead of path, e.g. out/manifest.shard-3-of-8.jsonl for out/manifest.jsonl.
+
+    :param path: (str) path of a manifest, profile, feature store or pickle
+    :param shard: (int) shard, from 0 to num_shards - 1
+    :param num_shards: (int) number of shards, if 1, path itself
+    :return: (str) path of the shard
+    """
+    if num_shards <= 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard-{shard}-of-{num_shards}{ext}"
+
+
+def unshard_path(path):
+    """
+    :param path: (str) path of a shard, see shard_path
+    :return: (str) path the shard is merged into, path itself if it is not a shard
+    """
+    match = SHARD_PATTERN.match(os.path.basename(path))
+    if match is None:
+        return path
+    return os.path.join(os.path.dirname(path), match["root"] + (match["ext"] or ""))
+
+
+def shard_manifest(out_dir, shard=None, num_shards=1):
+    """
+    Open the manifest of a stage. A shard records to its own manifest, but also reads the merged one,
+    so that files merged by an earlier run are not processed again.
+
+    :param out_dir: (str) output directory of the stage
+    :param shard: (int) shard, from 0 to num_shards - 1
+    :param num_shards: (int) number of shards, if 1, the stage is not sharded
+    :return: (Manifest) manifest
+    """
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    if num_shards <= 1:
+        return Manifest(path)
+
+    # the shard is running (again), its files must not be merged until it has finished
+    done_path = shard_path(os.path.join(out_dir, DONE_NAME), shard, num_shards)
+    if os.path.exists(done_path):
+        os.remove(done_path)
+    return Manifest(shard_path(path, shard, num_shards), base_path=path)
+
+
+def mark_done(out_dir, shard=None, num_shards=1):
+    """
+    Record that a shard of a stage has finished writing to its output directory, so that its files can be merged.
+
+    :param out_dir: (str) output directory of the stage
+    :param shard: (int) shard, from 0 to num_shards - 1
+    :param num_shards: (int) number of shards, if 1, the stage is not sharded and nothing is recorded
+    """
+    if num_shards <= 1:
+        return
+    with open(shard_path(os.path.join(out_dir, DONE_NAME), shard, num_shards), "w"):
+        pass
+
+
+def merged_names(store_path, num_shards=1):
+    """
+    Get the names of the items already merged into a feature store, which a shard does not need to compute again.
+
+    :param store_path: (str) directory of the merged store
+    :param num_shards: (int) number of shards, if 1, the stage is not sharded and writes to the store itself
+    :return: (set) names of the items of the merged store, empty if the stage is not sharded
+    """
+    if num_shards <= 1:
+        return set()
+    return stored_names(store_path)
+
+
+def merge_store(path, shard_paths):
+    """
+    Append the items of shard feature stores to a store.
+
+    :param path: (str) directory of the merged store, created if it does not already exist
+    :param shard_paths: (list) directories of the shard stores, in shard order
+    """
+    dst = None
+    for src_path in shard_paths:
+        src = FeatureStore(src_path)
+        dst = FeatureStore(path, dim=src.dim, timestamps=src.timestamps, dtype=src.dtype, attrs=src.attrs)
+        if dst.attrs != src.attrs or dst.timestamps != src.timestamps:
+            raise ValueError(f"The store at {src_path} cannot be merged into {path}, they were written differently!")
+
+        # files that describe how the rows were computed have to agree
+        for file in sorted(set(os.listdir(src_path)) - STORE_FILES):
+            dst_file = os.path.join(path, file)
+            if not os.path.exists(dst_file):
+                shutil.copyfile(os.path.join(src_path, file), dst_file)
+            elif not filecmp.cmp(os.path.join(src_path, file), dst_file, shallow=False):
+                raise ValueError(f"{file} of {src_path} differs from {file} of {path}, the rows of the two stores "
+                                 f"are not comparable! Run one shard and merge it first, so that the others reuse it.")
+
+        names, offsets = src.item_offsets()
+        data = src.array()
+        for name, (start, end) in zip(names, offsets):
+            ts = src.get_timestamps(name) if src.timestamps else None
+            dst.append(name, data[start:end], ts)
+        dst.close()
+
+    # items merged again (e.g. by a repeated merge) leave stale rows behind
+    if dst is not None:
+        dst.compact(STALE_FRACTION)
+
+
+def merge_jsonl(path, shard_paths):
+    """
+    Append the lines of shard manifests (or profiles) to a manifest, pointing their outputs to the merged paths.
+
+    :param path: (str) path of the merged file
+    :param shard_paths: (list) paths of the shard files, in shard order
+    """
+    with open(path, "a") as out:
+        for src_path in shard_paths:
+            with open(src_path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line may be incomplete if the shard was interrupted
+                        continue
+                    if "outputs" in entry:
+                        entry["outputs"] = [unshard_path(p) for p in entry["outputs"]]
+                    out.write(json.dumps(entry) + "\n")
+
+
+def merge_pickles(path, shard_paths):
+    """
+    Merge shard pickles of a stage into its pickle.
+
+    The pickles are tuples of lists with one entry per file, and the names of the files last,
+    e.g. (vectors, names) or (embeddings, timestamps, names). The entries of a name that is
+    in more than one pickle are taken from the last shard.
+
+    :param path: (str) path of the merged pickle, whose entries are kept if it already exists
+    :param shard_paths: (list) paths of the shard pickles, in shard order
+    """
+    entries = {}
+    num_columns = 0
+    for src_path in ([path] if os.path.exists(path) else []) + list(shard_paths):
+        with open(src_path, "rb") as f:
+            data_obj = pickle.load(f)
+        num_columns = len(data_obj)
+        for values in zip(*data_obj):
+            entries[values[-1]] = values
+    columns = zip(*entries.values()) if entries else [[]] * num_columns
+    data_obj = tuple(list(column) for column in columns)
+
+    tmp_path = path + f".{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(data_obj, f)
+    os.replace(tmp_path, path)
+
+
+def merge(out_dir, keep_shards=False):
+    """
+    Merge the manifests, profiles, feature stores and pickles written by the shards of a stage
+    into the ones of an unsharded run, e.g. after every task of a job array has finished.
+
+    Only the shards that have finished (see mark_done) are merged, the files of shards that are still
+    running (or were interrupted) are left in place, merge again once they have finished. Merging is
+    safe to repeat: if it is interrupted, run it again, the items it already appended are appended
+    again and the last one wins.
+
+    :param out_dir: (str) output directory of the stage
+    :param keep_shards: (bool) whether to keep the shard files, by default they are removed once merged
+    """
+    # group the files of the finished shards by the path they are merged into
+    groups = {}
+    done = set()
+    unfinished = set()
+    for entry in sorted(os.listdir(out_dir)):
+        match = SHARD_PATTERN.match(entry)
+        if match is not None and match["root"] == DONE_NAME and match["ext"] is None:
+            done.add((int(match["shard"]), int(match["num_shards"])))
+    for entry in sorted(os.listdir(out_dir)):
+        match = SHARD_PATTERN.match(entry)
+        if match is None or match["root"] == DONE_NAME:
+            continue
+        key = (int(match["shard"]), int(match["num_shards"]))
+        if key not in done:
+            unfinished.add(key)
+            continue
+        groups.setdefault(unshard_path(os.path.join(out_dir, entry)), []).append(
+            (*key, os.path.join(out_dir, entry)))
+    if unfinished:
+        print(f"Shards {sorted(shard for shard, _ in unfinished)} have not finished, their files are left in place.")
+    if not groups:
+        print(f"There are no finished shards to merge in {out_dir}.")
+        return
+
+    # stores first, then pickles, then manifests, so that a merged manifest never points to missing items
+    def kind(path):
+        if os.path.isdir(groups[path][0][2]):
+            return 0
+        return 1 if path.endswith(".pkl") else 2
+
+    for path in sorted(groups, key=lambda p: (kind(p), p)):
+        shards = sorted(groups[path])
+        num_shards = {n for _, n, _ in shards}
+        if len(num_shards) > 1:
+            raise ValueError(f"The shards of {path} were run with different numbers of shards: {sorted(num_shards)}!")
+        missing = sorted(set(range(num_shards.pop())) - {i for i, _, _ in shards} - {i for i, _ in unfinished})
+        print(f"Merging {len(shards)} shards into {path}...")
+        if missing:
+            print(f"There is nothing of shards {missing} to merge into {path}.")
+
+        shard_paths = [p for _, _, p in shards]
+        if kind(path) == 0:
+            merge_store(path, shard_paths)
+        elif kind(path) == 1:
+            merge_pickles(path, shard_paths)
+        elif path.endswith(".jsonl"):
+            merge_jsonl(path, shard_paths)
+        else:
+            raise ValueError(f"Do not know how to merge {shard_paths[0]}!")
+
+        if not keep_shards:
+            for p in shard_paths:
+                if os.path.isdir(p):
+                    shutil.rmtree(p)
+                else:
+                    os.remove(p)
+
+    if not keep_shards:
+        for shard, num_shards in done:
+            os.remove(shard_path(os.path.join(out_dir, DONE_NAME), shard, num_shards))
+    print("Merging complete!")
+
+
+def _run_shard(func, args, kwargs):
+    func(*args, **kwargs)
+
+
+def run_shards(func, num_shards, out_dirs, *args, **kwargs):
+    """
+    Run the shards of a stage as parallel processes on this machine, like the tasks of a job array,
+    and merge their outputs.
+
+    :param func: (function) stage function, e.g. preprocess.preprocess, taking shard and num_shards
+    :param num_shards: (int) number of shards (processes)
+    :param out_dirs: (str or list) output directory (or directories) of the stage to merge
+    :param args: positional arguments of the stage function
+    :param kwargs: keyword arguments of the stage function
+    """
+    # fresh processes, as on separate nodes
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=_run_shard, args=(func, args, {**kwargs, "shard": shard,
+                                                                        "num_shards": num_shards}))
+                 for shard in range(num_shards)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    failed = [shard for shard, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Shards {failed} failed, run them again before merging!")
+
+    for out_dir in [out_dirs] if isinstance(out_dirs, str) else out_dirs:
+        merge(out_dir)
+
+
+def shard_args(description=None):
+    """
+    Parse the --shard and --num-shards arguments of a stage script. In a Slurm job array,
+    they default to the index of the task in the array and the number of tasks, e.g.
+        sbatch --array=0-7 --wrap "python preprocess.py"
+    (or --array=0-21:3, whose tasks 0, 3, ..., 21 are shards 0 to 7)
+        sbatch --dependency=afterok:<job id> --wrap "python shard.py merge <output directory>"
+
+    :param description: (str) description of the script
+    :return: (argparse.Namespace) arguments, with shard and num_shards
+    """
+    task = ((int(os.environ.get("SLURM_ARRAY_TASK_ID", 0)) - int(os.environ.get("SLURM_ARRAY_TASK_MIN", 0)))
+            // int(os.environ.get("SLURM_ARRAY_TASK_STEP", 1)))
+    num_tasks = int(os.environ.get("SLURM_ARRAY_TASK_COUNT", 1))
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--shard", type=int, default=task, help="shard to process, from 0 to num-shards - 1")
+    parser.add_argument("--num-shards", type=int, default=num_tasks, help="number of shards the files are split into")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Merge the outputs of the shards of a stage.")
+    parser.add_argument("command", choices=["merge"], help="what to do")
+    parser.add_argument("out_dirs", nargs="+", help="output directories of the stage")
+    parser.add_argument("--keep-shards", action="store_true", help="keep the shard files once merged")
+    args = parser.parse_args()
+
+    # run function
+    for out_dir in args.out_dirs:
+        merge(out_dir, keep_shards=args.keep_shards)
@@ -0,0 +1,483 @@
+import os
+import json
+import traceback
+import functools
+import numpy as np
+import librosa
+import scipy.fft
+from tqdm import tqdm
+from constants import HOP_LENGTH, NUM_MFCC, MFCC_N_FFT, MEL_CACHE_DIR, MEL_CACHE_MAX_BYTES, AUDIO_DTYPE
+from audio_io import is_audio_file
+from shard import select_shard, shard_path, shard_manifest, shard_args, merged_names, mark_done
+from feature_store import FeatureStore, STALE_FRACTION
+from parallel import report_failures
+from mel_cache import MelCache, melspectrogram
+from profiling import phase, add_audio, reset, collect, RunProfile, PROFILE_NAME
+
+# set input and output directories
+INPUT_DIR = "/scratch/rn2214/data/final_stems_22050"
+OUTPUT_DIR = "/scratch/rn2214/data/timbre_stats"
+
+# frame-level features, all computed from the (cached) power mel spectrogram:
+#     "mfcc":     MFCCs, excluding the 0th coefficient (as in extract_mfccs)
+#     "delta":    first order deltas of the MFCCs
+#     "delta2":   second order deltas of the MFCCs
+#     "centroid": spectral centroid (Hz), from the center frequencies of the mel bands
+#     "flatness": spectral flatness of the mel bands
+#     "contrast": spectral contrast (dB) of CONTRAST_BANDS groups of mel bands
+FEATURES = ["mfcc", "delta", "delta2", "centroid", "flatness", "contrast"]
+
+# statistics over time of every feature: "mean", "std" and "percentiles" (PERCENTILES)
+STATISTICS = ["mean", "std", "percentiles"]
+PERCENTILES = [10, 50, 90]
+
+# features whose covariance across dimensions (upper triangle, without the variances) is added
+COV_FEATURES = ["mfcc"]
+
+# number of frames on each side used to compute the deltas
+DELTA_WIDTH = 4
+
+# number of groups of mel bands for the spectral contrast, and fraction of the bands
+# of a group averaged for its peak and valley
+CONTRAST_BANDS = 8
+CONTRAST_QUANTILE = 0.2
+
+# number of mel bands of the spectrograms
+NUM_MELS = 128
+
+# maximum number of values (clips x mel bands x frames) in a batch, bounds the memory of a batch
+MAX_BATCH_VALUES = 1 << 22
+
+# number of clips read before their statistics are computed and written
+CHUNK_SIZE = 1024
+
+
+def feature_dims(features=FEATURES, n_mfcc=NUM_MFCC, n_mels=NUM_MELS):
+    """
+    Get the number of dimensions of each frame-level feature.
+
+    :param features: (list) names of the features (see FEATURES)
+    :param n_mfcc: (int) number of MFCCs, including the 0th coefficient
+    :param n_mels: (int) number of mel bands
+    :return: (dict) number of dimensions of each feature
+    """
+    dims = {"mfcc": n_mfcc - 1, "delta": n_mfcc - 1, "delta2": n_mfcc - 1, "centroid": 1, "flatness": 1,
+            "contrast": min(CONTRAST_BANDS, n_mels)}
+    unknown = [feature for feature in features if feature not in dims]
+    if unknown:
+        raise ValueError(f"Unknown features {unknown}!")
+    return {feature: dims[feature] for feature in features}
+
+
+def stat_names(features=FEATURES, statistics=STATISTICS, percentiles=PERCENTILES, cov_features=COV_FEATURES,
+               n_mfcc=NUM_MFCC, n_mels=NUM_MELS):
+    """
+    Get the name of each column of the statistics matrix.
+
+    :param features: (list) names of the frame-level features (see FEATURES)
+    :param statistics: (list) statistics over time of every feature (see STATISTICS)
+    :param percentiles: (list) percentiles computed with the "percentiles" statistic
+    :param cov_features: (list) features whose covariance is added
+    :param n_mfcc: (int) number of MFCCs, including the 0th coefficient
+    :param n_mels: (int) number of mel bands
+    :return: (list) names of the columns, e.g. "mfcc3_mean", "contrast0_p90", "mfcc_cov1_2"
+    """
+    names = []
+    for feature, dim in feature_dims(features, n_mfcc, n_mels).items():
+        for stat in statistics:
+            if stat == "percentiles":
+                names += [f"{feature}{i}_p{p}" for p in percentiles for i in range(dim)]
+            else:
+                names += [f"{feature}{i}_{stat}" for i in range(dim)]
+        if feature in cov_features:
+            rows, cols = np.triu_indices(dim, 1)
+            names += [f"{feature}_cov{i}_{j}" for i, j in zip(rows, cols)]
+    return names
+
+
+def pad_batch(mels, pad=0):
+    """
+    Stack spectrograms of different lengths into one array, repeating the edge frames of each
+    spectrogram so that padding does not change its deltas.
+
+    :param mels: (list) power mel spectrograms, of shape (n_mels, num_frames)
+    :param pad: (int) number of edge frames to add before and after each spectrogram
+    :return: (np.array, np.array) float32 array of shape (num_clips, n_mels, max_frames + 2 * pad),
+                                  and the number of frames of each spectrogram
+    """
+    lengths = np.array([M.shape[-1] for M in mels], dtype=np.int64)
+    out = np.empty((len(mels), mels[0].shape[0], int(lengths.max()) + 2 * pad), dtype=np.float32)
+    for i, M in enumerate(mels):
+        n = M.shape[-1]
+        out[i, :, pad:pad + n] = M
+        out[i, :, :pad] = M[:, :1]
+        out[i, :, pad + n:] = M[:, -1:]
+    return out, lengths
+
+
+def deltas(x, width=DELTA_WIDTH):
+    """
+    Compute first order deltas along time, as the least squares slope over 2 * width + 1 frames.
+
+    :param x: (np.array) features, of shape (num_clips, dim, num_frames), edge padded by width frames
+    :param width: (int) number of frames on each side
+    :return: (np.array) deltas, of shape (num_clips, dim, num_frames - 2 * width)
+    """
+    num_frames = x.shape[-1] - 2 * width
+    out = np.zeros(x.shape[:-1] + (num_frames,), dtype=x.dtype)
+    for n in range(1, width + 1):
+        out += n * (x[..., width + n:width + n + num_frames] - x[..., width - n:width - n + num_frames])
+    out /= 2 * sum(n ** 2 for n in range(1, width + 1))
+    return out
+
+
+@functools.lru_cache(maxsize=None)
+def dct_basis(n_mels, n_mfcc):
+    """
+    Get the rows of the orthonormal DCT-II matrix that give the MFCCs, excluding the 0th coefficient.
+
+    :param n_mels: (int) number of mel bands
+    :param n_mfcc: (int) number of MFCCs, including the 0th coefficient
+    :return: (np.array) float32 matrix of shape (n_mfcc - 1, n_mels)
+    """
+    return scipy.fft.dct(np.eye(n_mels), axis=0, type=2, norm="ortho")[1:n_mfcc].astype(np.float32)
+
+
+def frame_features(M, sr, lengths, features=FEATURES, n_mfcc=NUM_MFCC):
+    """
+    Compute frame-level features of a batch of power mel spectrograms.
+
+    :param M: (np.array) power mel spectrograms, of shape (num_clips, n_mels, num_frames),
+                         edge padded by DELTA_WIDTH frames if deltas are computed (see pad_batch)
+    :param sr: (int) sample rate of the audio the spectrograms were computed from
+    :param lengths: (np.array) number of frames of each spectrogram
+    :param features: (list) names of the features (see FEATURES)
+    :param n_mfcc: (int) number of MFCCs, including the 0th coefficient
+    :return: (dict) features, of shape (num_clips, dim, num_frames without the padding)
+    """
+    pad = DELTA_WIDTH if {"delta", "delta2"} & set(features) else 0
+    num_frames = M.shape[-1] - 2 * pad
+    out = {}
+
+    # natural log of the power, shared by the MFCCs and the flatness
+    log_M = np.log(np.maximum(M, 1e-10))
+
+    if {"mfcc", "delta", "delta2"} & set(features):
+        # same as librosa.feature.mfcc(S=librosa.power_to_db(M)), with the top_db floor of each clip
+        S_db = log_M * np.float32(10.0 / np.log(10.0))
+        np.maximum(S_db, S_db.max(axis=(1, 2), keepdims=True) - 80.0, out=S_db)
+        # only the needed rows of the orthonormal DCT-II, as one matrix product
+        mfcc = np.matmul(dct_basis(M.shape[1], n_mfcc), S_db)
+        del S_db
+        if "mfcc" in features:
+            out["mfcc"] = mfcc[..., pad:pad + num_frames]
+        if {"delta", "delta2"} & set(features):
+            delta = deltas(mfcc, DELTA_WIDTH)
+            if "delta" in features:
+                out["delta"] = delta
+            if "delta2" in features:
+                # pad the deltas at the last frame of each clip, as librosa.feature.delta(mode="nearest")
+                idx = np.clip(np.arange(-pad, num_frames + pad)[None, :], 0, lengths[:, None] - 1)
+                out["delta2"] = deltas(np.take_along_axis(delta, idx[:, None, :], axis=2), DELTA_WIDTH)
+
+    M = M[..., pad:pad + num_frames]
+    log_M = log_M[..., pad:pad + num_frames]
+    if "centroid" in features:
+        freqs = librosa.mel_frequencies(n_mels=M.shape[1], fmin=0.0, fmax=sr / 2).astype(np.float32)
+        out["centroid"] = (np.matmul(freqs, M) / np.maximum(M.sum(axis=1), 1e-10))[:, None, :]
+    if "flatness" in features:
+        out["flatness"] = (np.exp(log_M.mean(axis=1)) / np.maximum(M, 1e-10).mean(axis=1))[:, None, :]
+    if "contrast" in features:
+        # peak and valley of groups of adjacent mel bands
+        num_bands = min(CONTRAST_BANDS, M.shape[1])
+        group = M.shape[1] // num_bands
+        q = max(1, int(round(CONTRAST_QUANTILE * group)))
+        bands = np.sort(M[:, :group * num_bands].reshape(len(M), num_bands, group, -1), axis=2)
+        valley = bands[:, :, :q].mean(axis=2)
+        peak = bands[:, :, -q:].mean(axis=2)
+        out["contrast"] = 10.0 * (np.log10(np.maximum(peak, 1e-10)) - np.log10(np.maximum(valley, 1e-10)))
+
+    return {feature: out[feature].astype(np.float32, copy=False) for feature in features}
+
+
+def summarize_features(frames, lengths, statistics=STATISTICS, percentiles=PERCENTILES, cov_features=COV_FEATURES):
+    """
+    Compute statistics over time of a batch of frame-level features, ignoring the padding of each clip.
+    The features are stacked into one (num_clips, dims, num_frames) array, so that every statistic,
+    and the covariances of all cov_features, are one vectorized pass over the batch.
+
+    :param frames: (dict) features, of shape (num_clips, dim, num_frames) (see frame_features)
+    :param lengths: (np.array) number of frames of each clip
+    :param statistics: (list) statistics over time of every feature (see STATISTICS)
+    :param percentiles: (list) percentiles computed with the "percentiles" statistic
+    :param cov_features: (list) features whose covariance is added
+    :return: (np.array) float32 statistics, of shape (num_clips, width), in the order of stat_names
+    """
+    dims = [x.shape[1] for x in frames.values()]
+    offsets = np.cumsum([0] + dims)
+    x = np.concatenate(list(frames.values()), axis=1)
+    mask = (np.arange(x.shape[-1])[None, :] < lengths[:, None])[:, None, :]
+    n = lengths[:, None].astype(np.float32)
+    mean = np.where(mask, x, 0).sum(axis=-1) / n
+    centered = np.where(mask, x - mean[..., None], 0)
+
+    # each block is one statistic of every dimension of every feature, of shape (num_clips, sum(dims))
+    blocks = []
+    for stat in statistics:
+        if stat == "mean":
+            blocks.append(mean)
+        elif stat == "std":
+            blocks.append(np.sqrt((centered ** 2).sum(axis=-1) / n))
+        elif stat == "percentiles":
+            # linear interpolation between the sorted frames of each clip, as np.percentile
+            x_sorted = np.sort(np.where(mask, x, np.inf), axis=-1)
+            pos = np.asarray(percentiles)[None, :] / 100 * (lengths[:, None] - 1)
+            lo = np.floor(pos).astype(np.int64)
+            hi = np.minimum(lo + 1, lengths[:, None] - 1)
+            frac = (pos - lo).astype(np.float32)[:, None, :]
+            shape = x.shape[:-1] + (len(percentiles),)
+            x_lo = np.take_along_axis(x_sorted, np.broadcast_to(lo[:, None, :], shape), -1)
+            x_hi = np.take_along_axis(x_sorted, np.broadcast_to(hi[:, None, :], shape), -1)
+            blocks += list(np.moveaxis(x_lo + frac * (x_hi - x_lo), -1, 0))
+        else:
+            raise ValueError(f"Unknown statistic {stat}!")
+
+    # covariance of the dimensions of all cov_features at once, then the upper triangle of each feature's block
+    cov_rows, cov_cols, pos = [], [], []
+    for feature, dim, offset in zip(frames, dims, offsets):
+        if feature in cov_features:
+            rows, cols = np.triu_indices(dim, 1)
+            cov_rows += list(rows + len(pos))
+            cov_cols += list(cols + len(pos))
+            pos += range(offset, offset + dim)
+    cov = np.einsum("bft,bgt->bfg", centered[:, pos], centered[:, pos]) / np.maximum(n - 1, 1)[..., None]
+    cov = cov[:, cov_rows, cov_cols]
+
+    # columns in the order of stat_names: the blocks of each feature, then its covariances
+    width = x.shape[1]
+    order = []
+    cov_start = len(blocks) * width
+    for feature, dim, offset in zip(frames, dims, offsets):
+        for k in range(len(blocks)):
+            order += range(k * width + offset, k * width + offset + dim)
+        if feature in cov_features:
+            order += range(cov_start, cov_start + dim * (dim - 1) // 2)
+            cov_start += dim * (dim - 1) // 2
+
+    return np.concatenate(blocks + [cov], axis=1)[:, order].astype(np.float32)
+
+
+def length_batches(lengths, num_rows, max_values=MAX_BATCH_VALUES):
+    """
+    Group clips of similar length into batches, so that little of a batch is padding.
+
+    :param lengths: (list) number of frames of each clip
+    :param num_rows: (int) number of rows (e.g. mel bands) of each frame
+    :param max_values: (int) maximum number of values (clips x rows x frames) in a batch
+    :return: (list) indices of the clips of each batch
+    """
+    order = np.argsort(lengths, kind="stable")
+    batches = []
+    start = 0
+    while start < len(order):
+        # clips are sorted by length, so the last clip of a batch is the longest
+        end = start + 1
+        while end < len(order) and (end - start + 1) * num_rows * lengths[order[end]] <= max_values:
+            end += 1
+        batches.append(order[start:end])
+        start = end
+    return batches
+
+
+def timbre_stats(mels, sr, features=FEATURES, statistics=STATISTICS, percentiles=PERCENTILES,
+                 cov_features=COV_FEATURES, n_mfcc=NUM_MFCC, max_values=MAX_BATCH_VALUES):
+    """
+    Compute the timbre statistics of clips from their power mel spectrograms,
+    one vectorized pass per batch of clips of similar length.
+
+    :param mels: (list) power mel spectrograms, of shape (n_mels, num_frames)
+    :param sr: (int) sample rate of the audio the spectrograms were computed from
+    :param features: (list) names of the frame-level features (see FEATURES)
+    :param statistics: (list) statistics over time of every feature (see STATISTICS)
+    :param percentiles: (list) percentiles computed with the "percentiles" statistic
+    :param cov_features: (list) features whose covariance is added
+    :param n_mfcc: (int) number of MFCCs, including the 0th coefficient
+    :param max_values: (int) maximum number of values (clips x mel bands x frames) in a batch
+    :return: (np.array) float32 matrix of shape (num_clips, width), with columns named by stat_names
+    """
+    n_mels = mels[0].shape[0] if len(mels) else NUM_MELS
+    width = len(stat_names(features, statistics, percentiles, cov_features, n_mfcc, n_mels))
+    out = np.zeros((len(mels), width), dtype=np.float32)
+    pad = DELTA_WIDTH if {"delta", "delta2"} & set(features) else 0
+
+    lengths = [M.shape[-1] for M in mels]
+    for batch in length_batches(lengths, n_mels, max_values):
+        M, batch_lengths = pad_batch([mels[i] for i in batch], pad)
+        frames = frame_features(M, sr, batch_lengths, features, n_mfcc)
+        out[batch] = summarize_features(frames, batch_lengths, statistics, percentiles, cov_features)
+    return out
+
+
+def stats_name(file):
+    """
+    Get the name of the timbre statistics of a WAV file.
+
+    :param file: (str) name of the WAV file
+    :return: (str) name of the timbre statistics
+    """
+    s = file.split("_")
+    return f"{s[0]}_{s[1]}_timbre"
+
+
+def extract_timbre_stats(in_dir, out_dir, force=False, chunk_size=CHUNK_SIZE, cache_dir=None,
+                         profile=False, shard=None, num_shards=1):
+    """
+    Extract timbre statistics (see timbre_stats) from vocal stem WAV files.
+
+    The mel spectrograms are taken from the MelCache shared with extract_mfccs and the plots,
+    chunk_size files at a time, and the statistics of each chunk are computed together.
+    The statistics of all files are appended to a FeatureStore in the output directory,
+    and can be loaded together with FeatureStore(path).array(); the name of each column
+    is saved next to it, in columns.json.
+
+    Files that were already processed with the same contents and parameters, according to
+    the manifest kept in the output directory, are not recomputed unless force is True.
+
+    :param in_dir: (str) directory of WAV files to extract statistics from
+    :param out_dir: (str) directory of where to save the statistics
+    :param force: (bool) whether to reprocess files that were already processed
+    :param chunk_size: (int) number of files read before their statistics are computed
+    :param cache_dir: (str) directory of the mel spectrogram cache (e.g. constants.MEL_CACHE_DIR), if None, no cache
+    :param profile: (bool) whether to append per-file phase timings and a summary of the run
+                           to the profile file in the output directory (see profiling.RunProfile),
+                           the time to compute and write the statistics of a chunk is counted on its first file
+    :param shard: (int) shard of the input files to process, from 0 to num_shards - 1 (see shard.py)
+    :param num_shards: (int) number of shards the input files are split into, if 1, process every file
+    """
+    # get all of the files in the input directory
+    print("Loading list of files...")
+    file_list = os.listdir(in_dir)
+    print(f"There are {len(file_list)} files in the input directory.")
+    if num_shards > 1:
+        file_list = select_shard(file_list, shard, num_shards)
+        print(f"{len(file_list)} of them are in shard {shard} of {num_shards}.")
+
+    # only process wav files
+    file_list = sorted(file for file in file_list if is_audio_file(file))
+
+    # create the output directory if it does not already exist
+    print("Creating output directory, if it does not already exist...")
+    os.makedirs(out_dir, exist_ok=True)
+
+    # create a store of statistics, one row per file
+    # a shard writes to a store of its own, merged into the store of all files afterwards (see shard.merge)
+    columns = stat_names()
+    merged_path = os.path.join(out_dir, f"all_timbre_stats_{len(columns)}")
+    store_path = shard_path(merged_path, shard, num_shards)
+    store = FeatureStore(store_path, dim=len(columns))
+    merged = merged_names(merged_path, num_shards)
+    with open(os.path.join(out_dir, "columns.json"), "w") as f:
+        json.dump(columns, f)
+
+    # skip files that were already processed
+    manifest = shard_manifest(out_dir, shard, num_shards)
+    params = {"features": FEATURES, "statistics": STATISTICS, "percentiles": PERCENTILES,
+              "cov_features": COV_FEATURES, "num_mfcc": NUM_MFCC, "hop_length": HOP_LENGTH, "n_fft": MFCC_N_FFT,
+              "n_mels": NUM_MELS, "delta_width": DELTA_WIDTH, "contrast_bands": CONTRAST_BANDS,
+              "contrast_quantile": CONTRAST_QUANTILE, "dtype": AUDIO_DTYPE}
+    file_list = [file for file in file_list
+                 if force or (stats_name(file) not in store and stats_name(file) not in merged)
+                 or not manifest.is_done(file, os.path.join(in_dir, file), params)]
+    print(f"{len(file_list)} files need to be processed.")
+
+    # spectrograms shared with the other features and plots
+    mel_cache = MelCache(cache_dir, max_bytes=MEL_CACHE_MAX_BYTES) if cache_dir is not None else None
+
+    run_profile = None
+    if profile:
+        run_profile = RunProfile(shard_path(os.path.join(out_dir, PROFILE_NAME), shard, num_shards),
+                                 "extract_timbre_stats", params)
+
+    print("Extracting timbre statistics for each audio file...")
+    failed = []
+    progress = tqdm(total=len(file_list))
+    for start in range(0, len(file_list), chunk_size):
+        # read the (cached) spectrograms of the chunk
+        # a file that cannot be read fails on its own, the rest of the chunk is processed
+        files = file_list[start:start + chunk_size]
+        chunk, mels, srs, timings = [], [], [], []
+        errors = {}
+        for file in files:
+            reset()
+            try:
+                M, sr = melspectrogram(os.path.join(in_dir, file), hop_length=HOP_LENGTH, n_fft=MFCC_N_FFT,
+                                       n_mels=NUM_MELS, mel_cache=mel_cache)
+            except Exception:
+                errors[file] = traceback.format_exc()
+                continue
+            add_audio((M.shape[-1] - 1) * HOP_LENGTH / sr)
+            chunk.append(file)
+            mels.append(M)
+            srs.append(sr)
+            timings.append(collect())
+
+        # statistics of the files of each sample rate, usually all of the chunk
+        reset()
+        stats = np.zeros((len(chunk), len(columns)), dtype=np.float32)
+        with phase("features"):
+            for sr in sorted(set(srs)):
+                idx = [i for i, s in enumerate(srs) if s == sr]
+                try:
+                    stats[idx] = timbre_stats([mels[i] for i in idx], sr)
+                except Exception:
+                    # find the files that fail on their own
+                    for i in idx:
+                        try:
+                            stats[i] = timbre_stats([mels[i]], sr)[0]
+                        except Exception:
+                            errors[chunk[i]] = traceback.format_exc()
+        del mels
+
+        with phase("write"):
+            for file, vec in zip(chunk, stats):
+                if file not in errors:
+                    store.append(stats_name(file), vec)
+        for file in chunk:
+            if file not in errors:
+                manifest.record(file, os.path.join(in_dir, file), params, [store_path])
+        for file, error in errors.items():
+            failed.append((file, error))
+            try:
+                manifest.record(file, os.path.join(in_dir, file), params, [], error=error)
+            except OSError:
+                # the file cannot even be hashed, it is processed again by the next run all the same
+                pass
+
+        if run_profile is not None and chunk:
+            # computing and writing the statistics of the chunk is counted on its first file
+            timing = collect()
+            timings[0]["total_sec"] += timing["total_sec"]
+            for key, sec in timing["phases"].items():
+                timings[0]["phases"][key] = timings[0]["phases"].get(key, 0.0) + sec
+            for file, timing in zip(chunk, timings):
+                if file not in errors:
+                    run_profile.record(file, timing)
+        progress.update(len(files))
+    progress.close()
+
+    if run_profile is not None:
+        run_profile.close()
+
+    store.close()
+    store.compact(STALE_FRACTION)
+    print(f"Saved statistics ({len(columns)} columns) of {len(store)} files to {store_path}.")
+    report_failures(failed)
+    mark_done(out_dir, shard, num_shards)
+    print("Processing complete!")
+
+
+if __name__ == '__main__':
+    # run function
+    args = shard_args("Extract timbre statistics of the final vocal stems.")
+    extract_timbre_stats(INPUT_DIR, OUTPUT_DIR, cache_dir=MEL_CACHE_DIR, shard=args.shard,
+                         num_shards=args.num_shards)
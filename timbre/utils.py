@@ -1,19 +1,30 @@
 import numpy as np
 
 
-def normalize_data(x):
+def normalize_data(x, out=None):
     """
     Normalize an array between -1 and 1.
 
+    Centering the data and scaling it to a standard deviation of 1 does not change the result
+    of the min/max scaling that follows, so only the min/max scaling is computed, in place on
+    the output array. Floating point inputs keep their dtype (float32 stays float32).
+
     :param x: (np.array) data to normalize
+    :param out: (np.array) if given, array to write the normalized data to
+                           (can be x itself, to normalize in place)
     :return: (np.array) normalized array
     """
-    # center data with a mean of 0 and a standard deviation of 1
-    z = (x - np.mean(x)) / np.std(x)
-    
+    if not np.issubdtype(x.dtype, np.floating):
+        x = x.astype(np.float64)
+
     # scale between -1 and 1
-    q = 2 * ((z - np.min(z)) / (np.max(z) - np.min(z))) - 1
-    
+    # q = 2 * (x - min) / (max - min) - 1
+    x_min = np.min(x)
+    x_max = np.max(x)
+    q = np.subtract(x, x_min, out=out)
+    q *= 2 / (x_max - x_min)
+    q -= 1
+
     return q
 
 
@@ -57,13 +68,17 @@ def trim_audio(y, sr, duration):
     return y_trim
 
 
-def fade_in_out(audio, sr, duration=0.5):
+def fade_in_out(audio, sr, duration=0.5, out=None):
     """
     Apply a linear fade in and out to audio data.
+    Only the samples at the beginning and end of the audio are touched,
+    and floating point inputs keep their dtype (float32 stays float32).
 
     :param audio: (np.array) audio array
     :param sr: (int) sample rate of audio
     :param duration: (float) length of fade in seconds
+    :param out: (np.array) if given, array to write the faded audio to
+                           (can be audio itself, to fade in place)
     :return: (np.array) audio array with fade applied
     """
     if len(audio.shape) == 2:
@@ -75,15 +90,144 @@ def fade_in_out(audio, sr, duration=0.5):
         raise ValueError("Audio array can only be 1-dimensional or 2-dimensional!")
 
     fade_length = int(duration * sr)  # length of fade in samples
+    if 2 * fade_length > num_samples:
+        raise ValueError("Audio array is shorter than the fade in and fade out!")
+
+    # copy the audio to the output array
+    if out is None:
+        dtype = audio.dtype if np.issubdtype(audio.dtype, np.floating) else np.float64
+        out = np.array(audio, dtype=dtype)
+    elif out is not audio:
+        out[...] = audio
+
+    # create fade curves
+    fade_in = np.linspace(0.0, 1.0, fade_length, dtype=out.dtype)
+    fade_out = np.linspace(1.0, 0.0, fade_length, dtype=out.dtype)
+
+    # apply fade curves to the beginning and end of the audio
+    out[..., :fade_length] *= fade_in
+    out[..., num_samples - fade_length:] *= fade_out
+
+    return out
+
+
+def normalize_batch(X, out=None):
+    """
+    Normalize each clip of a batch between -1 and 1.
+    Gives exactly the same result as normalize_data on each clip.
+
+    :param X: (np.array) batch of equal-length clips, of shape (num_clips, num_samples)
+                         or (num_clips, num_channels, num_samples)
+    :param out: (np.array) if given, array to write the normalized batch to
+                           (can be X itself, to normalize in place)
+    :return: (np.array) normalized batch
+    """
+    if X.ndim not in (2, 3):
+        raise ValueError("Batch array can only be 2-dimensional or 3-dimensional!")
+    if not np.issubdtype(X.dtype, np.floating):
+        X = X.astype(np.float64)
+
+    # min and max of each clip, over all of its channels and samples
+    axes = tuple(range(1, X.ndim))
+    x_min = np.min(X, axis=axes, keepdims=True)
+    x_max = np.max(X, axis=axes, keepdims=True)
+
+    # scale between -1 and 1
+    # q = 2 * (x - min) / (max - min) - 1
+    Q = np.subtract(X, x_min, out=out)
+    Q *= 2 / (x_max - x_min)
+    Q -= 1
+
+    return Q
+
+
+def trim_batch(X, sr, duration):
+    """
+    Trim each clip of a batch from the beginning to the maximum duration.
+    Gives exactly the same result as trim_audio on each clip.
+
+    :param X: (np.array) batch of equal-length clips, of shape (num_clips, num_samples)
+                         or (num_clips, num_channels, num_samples)
+    :param sr: (int) sample rate of the clips
+    :param duration: (float) maximum duration in seconds
+    :return: (np.array) trimmed batch (a view of X)
+    """
+    if X.ndim not in (2, 3):
+        raise ValueError("Batch array can only be 2-dimensional or 3-dimensional!")
+
+    # get the duration in samples
+    dur_in_samples = int(duration * sr)
+
+    return X[..., :dur_in_samples]
+
+
+def fade_batch(X, sr, duration=0.5, out=None):
+    """
+    Apply a linear fade in and out to each clip of a batch.
+    Gives exactly the same result as fade_in_out on each clip.
+
+    :param X: (np.array) batch of equal-length clips, of shape (num_clips, num_samples)
+                         or (num_clips, num_channels, num_samples)
+    :param sr: (int) sample rate of the clips
+    :param duration: (float) length of fade in seconds
+    :param out: (np.array) if given, array to write the faded batch to
+                           (can be X itself, to fade in place)
+    :return: (np.array) batch with fade applied
+    """
+    if X.ndim not in (2, 3):
+        raise ValueError("Batch array can only be 2-dimensional or 3-dimensional!")
+
+    num_samples = X.shape[-1]
+    fade_length = int(duration * sr)  # length of fade in samples
+    if 2 * fade_length > num_samples:
+        raise ValueError("Clips are shorter than the fade in and fade out!")
+
+    # copy the batch to the output array
+    if out is None:
+        dtype = X.dtype if np.issubdtype(X.dtype, np.floating) else np.float64
+        out = np.array(X, dtype=dtype)
+    elif out is not X:
+        out[...] = X
+
+    # create fade curves
+    fade_in = np.linspace(0.0, 1.0, fade_length, dtype=out.dtype)
+    fade_out = np.linspace(1.0, 0.0, fade_length, dtype=out.dtype)
+
+    # apply fade curves to the beginning and end of every clip at once
+    out[..., :fade_length] *= fade_in
+    out[..., num_samples - fade_length:] *= fade_out
+
+    return out
+
+
+def process_batch(X, sr, trim_dur=20.0, normalize=False, fade=True, out=None):
+    """
+    Normalize, trim and fade a batch of equal-length clips in one call,
+    in the same order as postprocess does for each clip.
+
+    :param X: (np.array) batch of equal-length clips, of shape (num_clips, num_samples)
+                         or (num_clips, num_channels, num_samples)
+    :param sr: (int) sample rate of the clips
+    :param trim_dur: (float) if positive, the max length (in seconds) to trim the clips down to
+                             if 0.0, do not trim the clips at all
+    :param normalize: (bool) whether to normalize each clip (center, amplitude)
+    :param fade: (bool) whether to add a fade at the beginning and end of each clip
+    :param out: (np.array) if given, array to write the processed batch to, of the same shape as X
+                           (can be X itself, to process in place)
+    :return: (np.array) processed batch
+    """
+    if normalize:
+        Y = normalize_batch(X, out=out)
+    elif out is not None:
+        out[...] = X
+        Y = out
+    else:
+        Y = np.array(X, dtype=X.dtype if np.issubdtype(X.dtype, np.floating) else np.float64)
 
-    # create fade curve
-    fade_in = np.linspace(0.0, 1.0, fade_length)
-    fade_out = np.linspace(1.0, 0.0, fade_length)
-    full_amp = np.ones((num_samples - 2 * fade_length))
-    fade_curve = np.concatenate((fade_in, full_amp, fade_out))
+    if trim_dur > 0:
+        Y = trim_batch(Y, sr, trim_dur)
 
-    # apply fade curve to audio
-    y_faded = audio * fade_curve
+    if fade:
+        Y = fade_batch(Y, sr, duration=0.5, out=Y)
 
-    return y_faded
- 
\ No newline at end of file
+    return Y